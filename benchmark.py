@@ -0,0 +1,830 @@
+"""
+离线性能基准测试
+
+在本地启动模拟的 LeakRadar API 与 Telegram Bot API 服务器，驱动 tgtest_simple 的
+handle_message / main() 跑固定场景，输出延迟（p50/p99）、吞吐量和峰值内存。
+不需要真实的 Token，也不访问外网，用于在部署前验证每一次性能改动。
+
+场景：
+- lookups   N 个会话同时查询不同域名（经 UpdateDispatcher 并发处理）
+- export    /export all，分别导出 1k / 10k / 100k 条记录
+- mixed     通过 main()（长轮询）处理按固定速率到达的混合消息
+- batch     上传 N 个域名 / N 个邮箱的列表文件做批量查询（locked-exists 预检 + 命中条目的详细查询）
+- fairness  一个用户连发 10 个 /export all 的同时，其他用户陆续查询域名，只统计这些查询的延迟
+
+用法：
+    python benchmark.py                                  # 运行全部场景
+    python benchmark.py --scenario lookups --lookups 500 --latency 50
+    python benchmark.py --scenario export --export-rows 100000 --leak-rate 1000
+    python benchmark.py --error-rate 0.05 --throttle-rate 0.02
+
+每个场景在独立子进程中运行机器人（模拟服务器留在主进程），因此峰值 RSS 只包含机器人本身。
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Dict, Any, List
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+BOT_TOKEN = "bench:token"
+RESULT_MARKER = "BENCH_RESULT "
+LEAK_TYPES = ("employees", "customers", "third_parties")
+
+# ============================================================================
+# 模拟服务器
+# ============================================================================
+
+class BenchHTTPServer(ThreadingHTTPServer):
+    """允许大量并发连接的本地 HTTP 服务器"""
+    daemon_threads = True
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # 客户端中途放弃请求（如上传超过大小上限）时不打印异常
+        pass
+
+class BenchHandler(BaseHTTPRequestHandler):
+    """公共部分：Keep-Alive、读取请求体（含 chunked 编码）、返回 JSON"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # 跳过 trailer 直到空行
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, obj: Any, status: int = 200, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_server(handler_class) -> BenchHTTPServer:
+    server = BenchHTTPServer(("127.0.0.1", 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_leak(index: int, leak_type: str, domain: str) -> Dict[str, Any]:
+    """生成一条 LeakDetails 格式的记录"""
+    return {
+        "id": f"{leak_type}-{index}",
+        "url": f"https://login.{domain}/",
+        "username": f"user{index}@{domain}",
+        "password": f"P@ss{index:06d}",
+        "password_strength": index % 5,
+        "unlocked": True,
+        "is_email": True,
+        "added_at": "2025-12-23T06:35:54.841000Z",
+    }
+
+class FakeLeakRadar:
+    """
+    模拟 LeakRadar API
+
+    - latency / jitter：每个请求的服务端延迟（秒）
+    - error_rate：按概率返回 500
+    - throttle_rate：按概率返回 429（Retry-After: 1）
+    - rows：每种泄露类型的记录总数，决定分页数量
+    - unlock_time：异步解锁任务从创建到完成的时间（秒）
+    - export_time：服务端导出任务从创建到完成的时间（秒）；/exports 中预置了一批历史任务，用于覆盖翻页
+    - hit_rate：locked-exists 预检中有泄露的域名 / 邮箱比例（按哈希固定，重复运行结果一致）
+    - /password-range：password0 ~ password999 视为已泄露，每个前缀另加 800 个填充后缀
+    """
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.01,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, unlock_time: float = 1.0,
+                 export_time: float = 3.0):
+        self.latency = latency
+        self.unlock_time = unlock_time
+        self.export_time = export_time
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rows = {leak_type: 100 for leak_type in LEAK_TYPES}
+        self.rows["email"] = 50
+        self.hit_rate = 0.2
+        self.leaked_hashes: Dict[str, List[str]] = {}
+        for i in range(1000):
+            digest = hashlib.sha1(f"password{i}".encode("utf-8")).hexdigest().upper()
+            self.leaked_hashes.setdefault(digest[:5], []).append(digest[5:])
+        self.lock = threading.Lock()
+        self.reset()
+        self.server = start_server(self._make_handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def reset(self) -> None:
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+            self.throttled = 0
+            self.by_endpoint: Dict[str, int] = {}
+            self.tasks: Dict[str, Dict[str, Any]] = {}
+            # 服务端通知配置与运行记录（/watch 同步用）
+            self.notifications: List[Dict[str, Any]] = []
+            self.notification_runs: List[Dict[str, Any]] = []
+            # 历史导出任务（已完成），新任务 ID 从 151 开始
+            self.exports: List[Dict[str, Any]] = [
+                {"id": i, "created": 0.0, "filename": f"export_{i}.csv", "rows": 10} for i in range(1, 151)
+            ]
+
+    def _count(self, endpoint: str) -> None:
+        with self.lock:
+            self.requests += 1
+            self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+
+    def page(self, leak_type: str, domain: str, query: Dict[str, List[str]]) -> Dict[str, Any]:
+        page = int(query.get("page", ["1"])[0])
+        page_size = int(query.get("page_size", ["10"])[0])
+        total = self.rows.get(leak_type, 0)
+        start = (page - 1) * page_size
+        # 与真实 API 一样按新到旧排序：新增的记录出现在第一页
+        items = [make_leak(total - 1 - i, leak_type, domain) for i in range(start, min(start + page_size, total))]
+        return {"items": items, "total": total, "total_unlocked": total, "page": page, "page_size": page_size}
+
+    def create_task(self, rows: int) -> Dict[str, Any]:
+        with self.lock:
+            task_id = f"task-{len(self.tasks) + 1}"
+            self.tasks[task_id] = {"created": time.time(), "rows": rows}
+        return {"task_id": task_id}
+
+    def task_status(self, task_id: str) -> Dict[str, Any]:
+        task = self.tasks.get(task_id)
+        # 与真实 API 一致：未知任务视为已完成
+        if task is None:
+            return {"task_id": task_id, "running": False, "completed": True, "total": None, "updated": None}
+        progress = min(1.0, (time.time() - task["created"]) / self.unlock_time) if self.unlock_time > 0 else 1.0
+        return {"task_id": task_id, "running": progress < 1.0, "completed": progress >= 1.0,
+                "total": task["rows"], "updated": int(task["rows"] * progress)}
+
+    def create_export(self, filename: str, rows: int) -> Dict[str, Any]:
+        with self.lock:
+            export_id = len(self.exports) + 1
+            self.exports.append({"id": export_id, "created": time.time(), "filename": filename, "rows": rows})
+        return {"status": "ok", "message": "queued", "export_id": export_id}
+
+    def export_item(self, export: Dict[str, Any]) -> Dict[str, Any]:
+        finished = time.time() - export["created"] >= self.export_time
+        return {"id": export["id"], "user_id": 1, "filename": export["filename"], "type": "domain", "params": {},
+                "status": "COMPLETED" if finished else "IN_PROGRESS", "timestamp": "2025-12-23T06:35:54Z",
+                "finished_at": "2025-12-23T06:36:10Z" if finished else None, "from_date": None}
+
+    def is_hit(self, value: str) -> bool:
+        return zlib.crc32(value.encode("utf-8")) % 1000 < self.hit_rate * 1000
+
+    def domains_locked_exists(self, body: bytes) -> Dict[str, Any]:
+        results = []
+        for domain in json.loads(body).get("domains", [])[:100]:
+            hit = self.is_hit(domain)
+            categories = {
+                leak_type: {"has_locked": hit, "count": self.rows[leak_type] if hit else 0,
+                            "total": self.rows[leak_type] if hit else 0, "unlocked": 0}
+                for leak_type in LEAK_TYPES
+            }
+            results.append({"domain": domain, "any": hit, "categories": categories})
+        return {"results": results}
+
+    def emails_locked_exists(self, body: bytes) -> Dict[str, Any]:
+        results = []
+        for email in json.loads(body).get("emails", [])[:100]:
+            hit = self.is_hit(email)
+            count = self.rows["email"] if hit else 0
+            results.append({"email": email, "any": hit, "locked": count, "total": count, "unlocked": 0})
+        return {"results": results}
+
+    def password_range(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+        prefix = query.get("prefix", [""])[0].upper()[:5]
+        suffixes = [hashlib.sha1(f"{prefix}{i}".encode("utf-8")).hexdigest().upper()[5:] for i in range(800)]
+        suffixes += self.leaked_hashes.get(prefix, [])
+        hashes = [{"hash": suffix, "count": 1 + i % 50} for i, suffix in enumerate(suffixes)]
+        return {"prefix": prefix, "total": len(hashes), "hashes": hashes}
+
+    def route(self, method: str, path: str, query: Dict[str, List[str]], body: bytes):
+        """返回 (端点名, 状态码, 响应对象)"""
+        parts = [p for p in path.split("/") if p]
+
+        if parts == ["password-range"] and method == "GET":
+            return "password_range", 200, self.password_range(query)
+
+        if parts == ["search", "domains", "locked-exists"] and method == "POST":
+            return "domains_locked_exists", 200, self.domains_locked_exists(body)
+        if parts == ["search", "emails", "locked-exists"] and method == "POST":
+            return "emails_locked_exists", 200, self.emails_locked_exists(body)
+
+        if parts[:2] == ["search", "domain"] and len(parts) >= 3:
+            domain = parts[2]
+            if len(parts) == 3 and method == "GET":
+                return "domain_report", 200, {
+                    "employees_compromised": self.rows["employees"],
+                    "third_parties_compromised": self.rows["third_parties"],
+                    "customers_compromised": self.rows["customers"],
+                    "blacklisted_value": None,
+                }
+            sub = parts[3]
+            if len(parts) == 4 and method == "GET" and sub in ("subdomains", "urls"):
+                key = "subdomain" if sub == "subdomains" else "url"
+                items = [{key: f"{key}{i}.{domain}", "count": i} for i in range(20)]
+                return sub, 200, {"items": items, "total": len(items), "page": 1, "page_size": 20}
+            if len(parts) == 4 and method == "GET" and sub in LEAK_TYPES:
+                return "domain_leaks", 200, self.page(sub, domain, query)
+            if len(parts) == 5 and method == "POST" and parts[4] == "unlock":
+                limit = int(query.get("max", ["10000"])[0])
+                rows = min(self.rows.get(sub, 0), limit)
+                return "domain_unlock", 200, [make_leak(i, sub, domain) for i in range(rows)]
+            if len(parts) == 6 and method == "POST" and parts[4:] == ["unlock", "task"]:
+                return "domain_unlock_task", 200, self.create_task(self.rows.get(sub, 0))
+            if len(parts) == 5 and method == "POST" and parts[4] == "export":
+                return "domain_export", 200, self.create_export(f"{domain}_{sub}.csv", self.rows.get(sub, 0))
+
+        if parts[:2] == ["search", "email"] and method == "POST":
+            if len(parts) == 2:
+                return "email_search", 200, self.page("email", "example.com", query)
+            if parts[2:] == ["unlock", "task"]:
+                return "email_unlock_task", 200, self.create_task(self.rows["email"])
+            if parts[2] == "unlock":
+                return "email_unlock", 200, [make_leak(i, "email", "example.com") for i in range(self.rows["email"])]
+            if parts[2] == "export":
+                return "email_export", 200, self.create_export("email.csv", self.rows["email"])
+
+        if len(parts) == 2 and parts[0] == "tasks" and method == "GET":
+            return "tasks", 200, self.task_status(parts[1])
+
+        if parts == ["notifications"] and method == "GET":
+            return "notifications", 200, self.notifications
+        if parts == ["notification_runs"] and method == "GET":
+            return "notification_runs", 200, {"items": list(reversed(self.notification_runs)),
+                                               "total": len(self.notification_runs), "page": 1, "page_size": 50}
+
+        if parts == ["unlock"] and method == "POST":
+            return "unlock", 200, []
+
+        if parts == ["exports"] and method == "GET":
+            page = int(query.get("page", ["1"])[0])
+            page_size = int(query.get("page_size", ["20"])[0])
+            with self.lock:
+                exports = list(reversed(self.exports))
+            if (page - 1) * page_size >= len(exports):
+                return "exports", 404, {"detail": "Page out of range"}
+            items = [self.export_item(e) for e in exports[(page - 1) * page_size:page * page_size]]
+            return "exports", 200, {"items": items, "total": len(exports), "page": page, "page_size": page_size}
+
+        if len(parts) == 3 and parts[0] == "exports" and parts[2] == "download" and method == "GET":
+            export_id = int(parts[1])
+            export = self.exports[export_id - 1] if 0 < export_id <= len(self.exports) else None
+            if export is None:
+                return "download", 404, {"detail": "Not Found"}
+            rows = "".join(f"https://login.example.com/,user{i}@example.com,P@ss{i:06d}\n" for i in range(export["rows"]))
+            return "download", 200, ("url,username,password\n" + rows).encode("utf-8")
+
+        return "unknown", 404, {"detail": "Not Found"}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BenchHandler):
+            def handle_any(self, method: str):
+                url = urlparse(self.path)
+                body = self.read_body()
+                time.sleep(max(0.0, fake.latency + random.uniform(-fake.jitter, fake.jitter)))
+                endpoint, status, payload = fake.route(method, url.path, parse_qs(url.query), body)
+                fake._count(endpoint)
+                roll = random.random()
+                if roll < fake.throttle_rate:
+                    with fake.lock:
+                        fake.throttled += 1
+                    return self.send_json({"detail": "Too Many Requests"}, 429, {"Retry-After": "1"})
+                if roll < fake.throttle_rate + fake.error_rate:
+                    with fake.lock:
+                        fake.errors += 1
+                    return self.send_json({"detail": "Internal Server Error"}, 500)
+                if isinstance(payload, bytes):
+                    self.send_response(status)
+                    self.send_header("Content-Type", "text/csv")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                self.send_json(payload, status)
+
+            def do_GET(self):
+                self.handle_any("GET")
+
+            def do_POST(self):
+                self.handle_any("POST")
+
+        return Handler
+
+class FakeTelegram:
+    """
+    模拟 Telegram Bot API
+
+    getUpdates 支持长轮询（队列为空时挂起直到有新消息或超时），
+    投递消息时写入 bench_sent_at 时间戳，供子进程计算端到端延迟。
+    files 中的文件可通过 getFile + /file/bot<token>/<file_path> 下载。
+    flood_control 为 True 时模拟 Telegram 的发送限制：同一会话 1 秒内超过 3 条、或全部会话 1 秒内
+    超过 30 条时返回 429（retry_after=1）。
+    """
+
+    CHAT_LIMIT = 3
+    GLOBAL_LIMIT = 30
+
+    def __init__(self, latency: float = 0.005, flood_control: bool = True):
+        self.latency = latency
+        self.flood_control = flood_control
+        self.cond = threading.Condition()
+        self.reset()
+        self.server = start_server(self._make_handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def reset(self) -> None:
+        with self.cond:
+            self.updates: List[Dict[str, Any]] = []
+            self.requests = 0
+            self.by_method: Dict[str, int] = {}
+            self.upload_bytes = 0
+            self.next_message_id = 1
+            self.files: Dict[str, bytes] = {}
+            self.throttled = 0
+            # 最近 1 秒内的发送时间（按会话 / 全部）
+            self.recent_sends: Dict[str, List[float]] = {}
+            self.all_sends: List[float] = []
+
+    def flooded(self, chat_id: Any) -> bool:
+        """记录一次发送，超过限制时返回 True（调用方持有 cond）"""
+        now = time.time()
+        chat_sends = [t for t in self.recent_sends.get(str(chat_id), []) if now - t < 1]
+        self.all_sends = [t for t in self.all_sends if now - t < 1]
+        if len(chat_sends) >= self.CHAT_LIMIT or len(self.all_sends) >= self.GLOBAL_LIMIT:
+            self.throttled += 1
+            return True
+        chat_sends.append(now)
+        self.recent_sends[str(chat_id)] = chat_sends
+        self.all_sends.append(now)
+        return False
+
+    def push(self, update: Dict[str, Any]) -> None:
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def get_updates(self, offset: int, limit: int, timeout: float) -> List[Dict[str, Any]]:
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                pending = [u for u in self.updates if u["update_id"] >= offset][:limit]
+                # 已确认（offset 之前）的消息不再保留
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+                remaining = deadline - time.time()
+                if pending or remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+        now = time.time()
+        for update in pending:
+            update.get("message", {}).setdefault("bench_sent_at", now)
+        return pending
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BenchHandler):
+            def handle_any(self):
+                url = urlparse(self.path)
+                body = self.read_body()
+                if url.path.startswith("/file/"):
+                    data = fake.files.get(url.path.rsplit("/", 1)[-1])
+                    if data is None:
+                        return self.send_json({"ok": False, "description": "Not Found"}, 404)
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                method = url.path.rsplit("/", 1)[-1]
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                content_type = self.headers.get("Content-Type", "")
+                if body and content_type.startswith("application/json"):
+                    params.update(json.loads(body))
+                elif body and content_type.startswith("application/x-www-form-urlencoded"):
+                    params.update({k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()})
+                elif body and content_type.startswith("multipart/form-data"):
+                    match = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body[:512])
+                    if match:
+                        params["chat_id"] = match.group(1).decode()
+                with fake.cond:
+                    fake.requests += 1
+                    fake.by_method[method] = fake.by_method.get(method, 0) + 1
+                    if method == "sendDocument":
+                        fake.upload_bytes += len(body)
+
+                if method == "getUpdates":
+                    updates = fake.get_updates(int(params.get("offset", 0)), int(params.get("limit", 100)),
+                                               float(params.get("timeout", 0)))
+                    return self.send_json({"ok": True, "result": updates})
+                time.sleep(fake.latency)
+                if method == "getMe":
+                    return self.send_json({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench",
+                                                                  "username": "bench_bot"}})
+                if method == "getFile":
+                    file_id = params.get("file_id", "")
+                    if file_id not in fake.files:
+                        return self.send_json({"ok": False, "description": "Bad Request: invalid file_id"}, 400)
+                    return self.send_json({"ok": True, "result": {"file_id": file_id, "file_path": f"documents/{file_id}",
+                                                                  "file_size": len(fake.files[file_id])}})
+                if method in ("sendMessage", "sendDocument") and fake.flood_control:
+                    with fake.cond:
+                        flooded = fake.flooded(params.get("chat_id"))
+                    if flooded:
+                        return self.send_json({"ok": False, "error_code": 429,
+                                               "description": "Too Many Requests: retry after 1",
+                                               "parameters": {"retry_after": 1}}, 429)
+                if method in ("sendMessage", "sendDocument", "editMessageText"):
+                    with fake.cond:
+                        message_id = fake.next_message_id
+                        fake.next_message_id += 1
+                    return self.send_json({"ok": True, "result": {"message_id": message_id, "date": int(time.time()),
+                                                                  "chat": {"id": params.get("chat_id")}}})
+                self.send_json({"ok": True, "result": True})
+
+            def do_GET(self):
+                self.handle_any()
+
+            def do_POST(self):
+                self.handle_any()
+
+        return Handler
+
+# ============================================================================
+# 子进程：运行机器人并测量
+# ============================================================================
+
+def make_message(message_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "message_id": message_id,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "first_name": f"bench{user_id}"},
+        "date": int(time.time()),
+        "text": text,
+    }
+
+def peak_rss_mb() -> Optional[float]:
+    """当前进程的峰值常驻内存（MB），Windows 上不可用"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def child_lookups(bot, count: int, timeout: float) -> Dict[str, Any]:
+    """N 个会话同时查询不同的域名"""
+    dispatcher = bot.UpdateDispatcher(bot.handle_message)
+    latencies: List[float] = []
+    lock = threading.Lock()
+    all_done = threading.Event()
+
+    def on_done(started: float) -> None:
+        with lock:
+            latencies.append(time.perf_counter() - started)
+            if len(latencies) == count:
+                all_done.set()
+
+    start = time.perf_counter()
+    for i in range(1, count + 1):
+        started = time.perf_counter()
+        dispatcher.submit(make_message(i, i, f"bench{i}.example.com"), on_done=lambda s=started: on_done(s))
+    all_done.wait(timeout)
+    return {"latencies": latencies, "wall": time.perf_counter() - start}
+
+def child_export(bot, count: int, timeout: float) -> Dict[str, Any]:
+    """单个 /export all（记录数由父进程配置在模拟服务器上）"""
+    latencies = []
+    start = time.perf_counter()
+    for i in range(1, count + 1):
+        started = time.perf_counter()
+        bot.handle_message(make_message(i, 1, f"/export all bench{i}.example.com"))
+        latencies.append(time.perf_counter() - started)
+    return {"latencies": latencies, "wall": time.perf_counter() - start}
+
+def child_batch(bot, count: int, timeout: float) -> Dict[str, Any]:
+    """依次上传域名列表和邮箱列表文件（文件内容由父进程放在模拟 Telegram 上）做批量查询"""
+    latencies = []
+    start = time.perf_counter()
+    for i, file_id in enumerate(["bench_domains", "bench_emails"][:count], 1):
+        message = make_message(i, 1, "")
+        del message["text"]
+        message["document"] = {"file_id": file_id, "file_name": f"{file_id}.txt", "file_size": 0}
+        started = time.perf_counter()
+        bot.handle_message(message)
+        latencies.append(time.perf_counter() - started)
+    return {"latencies": latencies, "wall": time.perf_counter() - start}
+
+def child_fairness(bot, count: int, timeout: float) -> Dict[str, Any]:
+    """用户 1 先提交 10 个 /export all 占满批量通道，其他用户再以 5 条/秒提交 N 个域名查询"""
+    dispatcher = bot.UpdateDispatcher(bot.handle_message)
+    latencies: List[float] = []
+    lock = threading.Lock()
+    all_done = threading.Event()
+
+    def on_done(started: float) -> None:
+        with lock:
+            latencies.append(time.perf_counter() - started)
+            if len(latencies) == count:
+                all_done.set()
+
+    for i in range(10):
+        dispatcher.submit(make_message(i + 1, 1, f"/export all bulk{i}.example.com"))
+    start = time.perf_counter()
+    for i in range(1, count + 1):
+        started = time.perf_counter()
+        dispatcher.submit(make_message(100 + i, 1 + i, f"bench{i}.example.com"), on_done=lambda s=started: on_done(s))
+        time.sleep(0.2)
+    all_done.wait(timeout)
+    return {"latencies": latencies, "wall": time.perf_counter() - start}
+
+def child_mixed(bot, count: int, timeout: float) -> Dict[str, Any]:
+    """通过 main() 长轮询处理父进程投递的混合消息，延迟从消息投递到处理完成"""
+    sent_at: Dict[int, float] = {}
+    finished: List[float] = []
+    latencies: List[float] = []
+    lock = threading.Lock()
+    all_done = threading.Event()
+
+    # 只做计时包装，处理逻辑仍走机器人自己的代码
+    original_dispatch = bot.dispatch_update
+    original_mark_done = bot.UpdateJournal.mark_done
+
+    def dispatch_update(update, dispatcher, journal):
+        sent_at[update["update_id"]] = update.get("message", {}).get("bench_sent_at", time.time())
+        original_dispatch(update, dispatcher, journal)
+
+    def mark_done(journal, update_id):
+        original_mark_done(journal, update_id)
+        now = time.time()
+        with lock:
+            latencies.append(now - sent_at.get(update_id, now))
+            finished.append(now)
+            if len(latencies) == count:
+                all_done.set()
+
+    bot.dispatch_update = dispatch_update
+    bot.UpdateJournal.mark_done = mark_done
+
+    threading.Thread(target=bot.main, name="bot-main", daemon=True).start()
+    all_done.wait(timeout)
+    first = min(sent_at.values()) if sent_at else time.time()
+    last = max(finished) if finished else time.time()
+    return {"latencies": latencies, "wall": last - first}
+
+CHILD_SCENARIOS = {
+    "lookups": child_lookups,
+    "export": child_export,
+    "mixed": child_mixed,
+    "batch": child_batch,
+    "fairness": child_fairness,
+}
+
+def run_child(scenario: str, count: int, timeout: float) -> None:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import tgtest_simple as bot
+
+    result = CHILD_SCENARIOS[scenario](bot, count, timeout)
+    result["expected"] = count
+    result["peak_rss_mb"] = peak_rss_mb()
+    print(RESULT_MARKER + json.dumps(result), flush=True)
+    # 机器人的后台线程（轮询、调度）不会自行退出
+    os._exit(0)
+
+# ============================================================================
+# 主进程：启动模拟服务器、逐个场景运行并汇总
+# ============================================================================
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def spawn(scenario: str, count: int, args, leak: FakeLeakRadar, tg: FakeTelegram) -> Dict[str, Any]:
+    """在独立的子进程（独立工作目录）中运行一个场景"""
+    workdir = tempfile.mkdtemp(prefix="tgbench_")
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_TOKEN": BOT_TOKEN,
+        "LEAK_API_KEY": "bench",
+        "TELEGRAM_API_URL": tg.url,
+        "LEAK_API_BASE_URL": leak.url,
+        "STATE_DB_PATH": os.path.join(workdir, "bot_state.db"),
+        "HEARTBEAT_INTERVAL": "3600",
+        "POLL_TIMEOUT": "5",
+        "ALLOWED_USERS": "",
+        "METRICS_PORT": "0",
+        "NO_PROXY": "127.0.0.1,localhost",
+        "PYTHONIOENCODING": "utf-8",
+    })
+    if args.leak_rate:
+        env["LEAK_API_RATE_LIMIT"] = str(args.leak_rate)
+
+    command = [sys.executable, os.path.abspath(__file__), "--child", scenario,
+               "--count", str(count), "--timeout", str(args.timeout)]
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True, encoding="utf-8", errors="replace")
+    result = None
+    for line in process.stdout:
+        if line.startswith(RESULT_MARKER):
+            result = json.loads(line[len(RESULT_MARKER):])
+        elif args.verbose:
+            sys.stdout.write(line)
+    process.wait()
+    if result is None:
+        return {"error": f"子进程退出码 {process.returncode}，未返回结果（使用 --verbose 查看输出）"}
+
+    result["leak_requests"] = leak.requests
+    result["leak_errors"] = leak.errors + leak.throttled
+    result["tg_requests"] = tg.requests
+    result["upload_mb"] = tg.upload_bytes / (1024 * 1024)
+    return result
+
+def feed_mixed(tg: FakeTelegram, count: int, rate: float, stop: threading.Event) -> None:
+    """按固定速率投递混合消息：大部分是域名查询（部分重复，可命中缓存），其余是列表查询和导出"""
+    rng = random.Random(42)
+    domains = [f"shop{i}.example.com" for i in range(50)]
+    for update_id in range(1, count + 1):
+        if stop.is_set():
+            return
+        domain = rng.choice(domains)
+        roll = rng.random()
+        if roll < 0.6:
+            text = domain
+        elif roll < 0.75:
+            text = f"/employees {domain}"
+        elif roll < 0.85:
+            text = f"/email user{rng.randint(1, 200)}@example.com"
+        elif roll < 0.95:
+            text = f"/subdomains {domain}"
+        else:
+            text = f"/export employees {domain}"
+        user_id = rng.randint(1, 40)
+        tg.push({"update_id": update_id, "message": make_message(update_id, user_id, text)})
+        if rate > 0:
+            time.sleep(1.0 / rate)
+
+def summarize(name: str, result: Dict[str, Any], rows: Optional[int] = None) -> Dict[str, Any]:
+    if "error" in result:
+        return {"name": name, "error": result["error"]}
+    latencies = result["latencies"]
+    wall = max(result["wall"], 1e-9)
+    summary = {
+        "name": name,
+        "done": f"{len(latencies)}/{result['expected']}",
+        "wall": wall,
+        "msg_per_s": len(latencies) / wall,
+        "p50_ms": (percentile(latencies, 50) or 0) * 1000,
+        "p99_ms": (percentile(latencies, 99) or 0) * 1000,
+        "leak_rps": result["leak_requests"] / wall,
+        "leak_requests": result["leak_requests"],
+        "leak_errors": result["leak_errors"],
+        "tg_requests": result["tg_requests"],
+        "upload_mb": result["upload_mb"],
+        "peak_rss_mb": result["peak_rss_mb"],
+    }
+    if rows:
+        summary["rows_per_s"] = rows / wall
+    return summary
+
+def print_summary(summaries: List[Dict[str, Any]]) -> None:
+    print()
+    print("=" * 110)
+    print(f"{'场景':<16}{'完成':>10}{'耗时(s)':>10}{'消息/s':>10}{'p50(ms)':>10}{'p99(ms)':>10}"
+          f"{'API 请求/s':>12}{'API 错误':>10}{'TG 请求':>10}{'峰值RSS(MB)':>13}")
+    print("-" * 110)
+    for s in summaries:
+        if "error" in s:
+            print(f"{s['name']:<16}❌ {s['error']}")
+            continue
+        rss = f"{s['peak_rss_mb']:.1f}" if s["peak_rss_mb"] is not None else "N/A"
+        print(f"{s['name']:<16}{s['done']:>10}{s['wall']:>10.2f}{s['msg_per_s']:>10.1f}{s['p50_ms']:>10.0f}"
+              f"{s['p99_ms']:>10.0f}{s['leak_rps']:>12.1f}{s['leak_errors']:>10}{s['tg_requests']:>10}{rss:>13}")
+        if "rows_per_s" in s:
+            print(f"{'':<16}导出速度 {s['rows_per_s']:.0f} 条/秒，上传 {s['upload_mb']:.1f} MB")
+    print("=" * 110)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="TGBOT 离线性能基准测试")
+    parser.add_argument("--scenario", choices=["all", "lookups", "export", "mixed", "batch", "fairness"], default="all")
+    parser.add_argument("--lookups", type=int, default=200, help="并发查询的会话数")
+    parser.add_argument("--export-rows", default="1000,10000,100000", help="导出场景的记录数（逗号分隔）")
+    parser.add_argument("--mixed", type=int, default=300, help="混合场景的消息数")
+    parser.add_argument("--batch", type=int, default=1000, help="批量查询场景的域名数 / 邮箱数")
+    parser.add_argument("--fairness", type=int, default=100, help="公平性场景中导出进行时的查询数")
+    parser.add_argument("--hit-rate", type=float, default=0.05, help="批量查询中有泄露的条目比例")
+    parser.add_argument("--mixed-rate", type=float, default=30, help="混合场景每秒投递的消息数（0 为一次性投递）")
+    parser.add_argument("--latency", type=float, default=20, help="LeakRadar 服务端延迟（毫秒）")
+    parser.add_argument("--jitter", type=float, default=10, help="LeakRadar 延迟抖动（毫秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="LeakRadar 返回 500 的概率")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="LeakRadar 返回 429 的概率")
+    parser.add_argument("--unlock-time", type=float, default=1.0, help="异步解锁任务完成所需时间（秒）")
+    parser.add_argument("--export-time", type=float, default=3.0, help="服务端导出任务完成所需时间（秒）")
+    parser.add_argument("--tg-latency", type=float, default=5, help="Telegram API 延迟（毫秒）")
+    parser.add_argument("--leak-rate", type=float, default=0, help="覆盖机器人的 LEAK_API_RATE_LIMIT（0 为使用默认值）")
+    parser.add_argument("--timeout", type=float, default=900, help="单个场景的超时时间（秒）")
+    parser.add_argument("--verbose", action="store_true", help="显示机器人的日志输出")
+    parser.add_argument("--json", action="store_true", help="额外输出 JSON 格式的汇总")
+    # 内部参数：子进程模式
+    parser.add_argument("--child", choices=sorted(CHILD_SCENARIOS), help=argparse.SUPPRESS)
+    parser.add_argument("--count", type=int, default=1, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child(args.child, args.count, args.timeout)
+        return
+
+    leak = FakeLeakRadar(args.latency / 1000, args.jitter / 1000, args.error_rate, args.throttle_rate,
+                         args.unlock_time, args.export_time)
+    tg = FakeTelegram(args.tg_latency / 1000)
+    print(f"模拟 LeakRadar: {leak.url}（延迟 {args.latency:.0f}±{args.jitter:.0f}ms，"
+          f"错误率 {args.error_rate:.0%}，429 比例 {args.throttle_rate:.0%}）")
+    print(f"模拟 Telegram: {tg.url}（延迟 {args.tg_latency:.0f}ms）")
+
+    def prepare(rows_per_type: int) -> None:
+        leak.reset()
+        tg.reset()
+        for leak_type in LEAK_TYPES:
+            leak.rows[leak_type] = rows_per_type
+
+    summaries = []
+    if args.scenario in ("all", "lookups"):
+        print(f"\n[场景] {args.lookups} 个并发域名查询...")
+        prepare(100)
+        summaries.append(summarize(f"lookups x{args.lookups}", spawn("lookups", args.lookups, args, leak, tg)))
+
+    if args.scenario in ("all", "export"):
+        for rows in [int(r) for r in args.export_rows.split(",") if r.strip()]:
+            print(f"\n[场景] /export all，共 {rows} 条记录...")
+            per_type = rows // len(LEAK_TYPES)
+            prepare(per_type)
+            summaries.append(summarize(f"export {rows}", spawn("export", 1, args, leak, tg), rows=per_type * len(LEAK_TYPES)))
+
+    if args.scenario in ("all", "mixed"):
+        print(f"\n[场景] main() 处理 {args.mixed} 条混合消息（{args.mixed_rate:g} 条/秒）...")
+        prepare(1000)
+        stop = threading.Event()
+        feeder = threading.Thread(target=feed_mixed, args=(tg, args.mixed, args.mixed_rate, stop), daemon=True)
+        # 子进程启动（导入模块、连接测试）需要一点时间，投递在子进程开始轮询后进行也不影响延迟计算
+        feeder.start()
+        result = spawn("mixed", args.mixed, args, leak, tg)
+        stop.set()
+        summaries.append(summarize(f"mixed x{args.mixed}", result))
+
+    if args.scenario in ("all", "batch"):
+        print(f"\n[场景] 批量查询 {args.batch} 个域名 + {args.batch} 个邮箱（命中率 {args.hit_rate:.0%}）...")
+        prepare(100)
+        leak.hit_rate = args.hit_rate
+        tg.files["bench_domains"] = "".join(f"batch{i}.example.com\n" for i in range(args.batch)).encode("utf-8")
+        tg.files["bench_emails"] = ("email\n" + "".join(f"user{i}@example.com\n" for i in range(args.batch))).encode("utf-8")
+        summaries.append(summarize(f"batch {args.batch}x2", spawn("batch", 2, args, leak, tg)))
+
+    if args.scenario in ("all", "fairness"):
+        print(f"\n[场景] 10 个 /export all 排队时的 {args.fairness} 个域名查询...")
+        prepare(10000)
+        summaries.append(summarize(f"fairness x{args.fairness}", spawn("fairness", args.fairness, args, leak, tg)))
+
+    print_summary(summaries)
+    if args.json:
+        print(json.dumps(summaries, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,35 @@ Telegram 机器人测试程序 - 简化版本（使用 requests 直接调用 API
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import json
 import re
 import os
+import contextvars
 import csv
-from typing import Optional, Dict, Any, List, Union
+import hashlib
+import heapq
+import hmac
+import io
+import math
+import random
+import secrets
+import email.utils
+import sqlite3
+import tempfile
+import threading
+import itertools
+import traceback
+import zipfile
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Dict, Any, List, Union, Callable, Iterable, Iterator, Tuple
 
 import urllib.request
 import urllib3
@@ -49,7 +72,22 @@ if not TOKEN:
     # 为了防止程序直接崩溃，这里可以抛出异常或者让 main 函数处理
     # 但为了简单起见，如果是在 main 中检测会更好，这里先留空，main 函数会检查连接
     
-API_BASE_URL = f"https://api.telegram.org/bot{TOKEN}"
+# Telegram Bot API 服务地址（可指向本地模拟服务器做测试）
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+API_BASE_URL = f"{TELEGRAM_API_URL}/bot{TOKEN}"
+
+# Telegram 发送限速：全局约 30 条/秒（速率 + 突发容量 <= 30），单个私聊约 1 条/秒，群组约 20 条/分钟
+TELEGRAM_SEND_RATE = float(os.environ.get("TELEGRAM_SEND_RATE", "28"))
+TELEGRAM_SEND_BURST = float(os.environ.get("TELEGRAM_SEND_BURST", "2"))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.environ.get("TELEGRAM_GROUP_RATE", str(20 / 60)))
+# 单个会话的突发容量：短时间内连发几条回复不需要等待
+TELEGRAM_CHAT_BURST = float(os.environ.get("TELEGRAM_CHAT_BURST", "3"))
+# 发送线程数，以及网络错误 / 5xx 时的最大重试次数（429 按 retry_after 等待，不计入重试次数）
+TELEGRAM_SEND_WORKERS = int(os.environ.get("TELEGRAM_SEND_WORKERS", "4"))
+TELEGRAM_SEND_RETRIES = int(os.environ.get("TELEGRAM_SEND_RETRIES", "5"))
+# 单条消息的最大长度
+TELEGRAM_MESSAGE_LIMIT = 4096
 
 # 自动检测代理配置
 PROXIES = urllib.request.getproxies()
@@ -62,9 +100,25 @@ else:
 # API 配置
 # ============================================================================
 # API 速率限制：30 请求/秒
+# 所有 LeakRadar 请求共用一个令牌桶。速率 + 突发容量 <= 30，保证任意 1 秒窗口内都不会超限
+LEAK_API_RATE_LIMIT = float(os.environ.get("LEAK_API_RATE_LIMIT", "27"))
+LEAK_API_BURST = float(os.environ.get("LEAK_API_BURST", "3"))
+# 为交互查询保留的配额比例：批量通道最多使用 (1 - 该比例) 的速率
+LEAK_API_INTERACTIVE_SHARE = float(os.environ.get("LEAK_API_INTERACTIVE_SHARE", "0.3"))
+# 收到 429 后的最大重试次数
+LEAK_API_MAX_RETRIES = int(os.environ.get("LEAK_API_MAX_RETRIES", "3"))
+# 端点权重（可选），例如：set LEAK_API_WEIGHTS=domain_unlock=3,email_unlock=3
+LEAK_API_WEIGHTS = {}
+for _item in os.environ.get("LEAK_API_WEIGHTS", "").split(","):
+    if "=" in _item:
+        _name, _weight = _item.split("=", 1)
+        try:
+            LEAK_API_WEIGHTS[_name.strip()] = float(_weight)
+        except ValueError:
+            print(f"⚠ LEAK_API_WEIGHTS 中的权重无效: {_item}")
 
-# API 基础地址
-LEAK_API_BASE_URL = "https://api.leakradar.io"
+# API 基础地址（可指向本地模拟服务器做测试）
+LEAK_API_BASE_URL = os.environ.get("LEAK_API_BASE_URL", "https://api.leakradar.io").rstrip("/")
 
 # API Key（Bearer Token）
 # 优先从环境变量读取
@@ -90,19 +144,1122 @@ else:
     print("💡 提示: 未设置 ALLOWED_USERS，机器人目前为【公开访问】模式")
     ALLOWED_USERS = []
 
+# ============================================================================
+# 运行模式配置
+# ============================================================================
+# polling：长轮询 getUpdates（默认）；webhook：启动本地 HTTP 服务接收 Telegram 推送
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+# 长轮询超时（秒）：没有消息时 Telegram 最多挂起请求这么久，有消息时立即返回
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", "50"))
+# Webhook 公网地址（Telegram 推送的目标），例如 https://bot.example.com/telegram
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+# 本地监听地址 / 端口 / 路径（通常由反向代理把 WEBHOOK_URL 转发过来）
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# 校验 X-Telegram-Bot-Api-Secret-Token 头的密钥；未设置时每次启动随机生成
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# 监控指标：非 0 时在 METRICS_LISTEN:METRICS_PORT 提供 /metrics（Prometheus 文本格式）
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+# 心跳日志间隔（秒）
+HEARTBEAT_INTERVAL = int(os.environ.get("HEARTBEAT_INTERVAL", "60"))
+
+# ============================================================================
+# 并发调度配置
+# ============================================================================
+# 同时处理消息的工作线程数（其中 BULK_WORKERS 个专用于导出等批量任务，其余保留给交互查询）
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS", "16"))
+BULK_WORKERS = int(os.environ.get("BULK_WORKERS", "4"))
+# 单个会话同时在途（排队 + 处理中）的最大任务数（交互、批量通道分别计算），单个用户同时在途的最大交互任务数
+MAX_INFLIGHT_PER_CHAT = int(os.environ.get("MAX_INFLIGHT_PER_CHAT", "8"))
+MAX_INFLIGHT_PER_USER = int(os.environ.get("MAX_INFLIGHT_PER_USER", "4"))
+# 单个用户同时在途的最大批量任务数（超出的部分排队，按用户公平轮流处理）
+MAX_BULK_PER_USER = int(os.environ.get("MAX_BULK_PER_USER", "10"))
+# 批量通道的用户权重（可选），例如：set BULK_USER_WEIGHTS=12345678=2
+BULK_USER_WEIGHTS = {}
+for _item in os.environ.get("BULK_USER_WEIGHTS", "").split(","):
+    if "=" in _item:
+        _user, _weight = _item.split("=", 1)
+        try:
+            BULK_USER_WEIGHTS[int(_user.strip())] = max(float(_weight), 0.01)
+        except ValueError:
+            print(f"⚠ BULK_USER_WEIGHTS 中的权重无效: {_item}")
+# 属于批量通道的命令
+BULK_COMMANDS = ("/export", "/serverexport", "/batch")
+
+# 分页获取配置
+# 导出时每页条数（API 上限 100），以及并发抓取的线程数和单页失败重试次数
+FETCH_PAGE_SIZE = 100
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", "8"))
+FETCH_PAGE_RETRIES = int(os.environ.get("FETCH_PAGE_RETRIES", "3"))
+# 单个导出同时在途的最大页数（流式导出时内存占用与之成正比）
+FETCH_WINDOW = int(os.environ.get("FETCH_WINDOW", str(FETCH_CONCURRENCY * 2)))
+
+# 导出配置
+# 单次导出最多获取的条数、单次解锁的最大条数（解锁消耗积分）
+EXPORT_MAX_ITEMS = int(os.environ.get("EXPORT_MAX_ITEMS", "100000"))
+UNLOCK_MAX_ITEMS = int(os.environ.get("UNLOCK_MAX_ITEMS", "10000"))
+# 异步解锁任务：状态轮询间隔（API 建议 1 秒）与最长等待时间（秒）
+UNLOCK_TASK_POLL_INTERVAL = float(os.environ.get("UNLOCK_TASK_POLL_INTERVAL", "1"))
+UNLOCK_TASK_TIMEOUT = int(os.environ.get("UNLOCK_TASK_TIMEOUT", "1800"))
+# 服务端导出任务：/exports 轮询间隔在最小值和最大值之间自适应退避（秒），以及最长等待时间
+EXPORT_POLL_MIN_INTERVAL = float(os.environ.get("EXPORT_POLL_MIN_INTERVAL", "2"))
+EXPORT_POLL_MAX_INTERVAL = float(os.environ.get("EXPORT_POLL_MAX_INTERVAL", "30"))
+EXPORT_JOB_TIMEOUT = int(os.environ.get("EXPORT_JOB_TIMEOUT", "3600"))
+# CSV 导出字段
+CSV_HEADERS = ["url", "username", "password", "is_email", "password_strength", "added_at"]
+# 上传文件时合并成的数据块大小（字节）与失败重试次数
+UPLOAD_BUFFER_SIZE = int(os.environ.get("UPLOAD_BUFFER_SIZE", str(1024 * 1024)))
+UPLOAD_RETRIES = int(os.environ.get("UPLOAD_RETRIES", "2"))
+# 导出文件压缩方式：gzip（默认）/ zip / none
+EXPORT_COMPRESSION = os.environ.get("EXPORT_COMPRESSION", "gzip").lower()
+# Telegram Bot API 单个文件上传上限（字节），超过时分卷发送
+TELEGRAM_UPLOAD_LIMIT = int(os.environ.get("TELEGRAM_UPLOAD_LIMIT", str(50 * 1024 * 1024)))
+# 导出数据留作重试 / 分卷重放时在内存中保留的上限（字节），超过后才写入临时文件
+EXPORT_REPLAY_MEMORY = int(os.environ.get("EXPORT_REPLAY_MEMORY", str(32 * 1024 * 1024)))
+
+# 批量查询配置
+# 单次批量查询最多处理的条目数，以及上传列表文件的大小上限（字节）
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "5000"))
+BATCH_FILE_MAX_BYTES = int(os.environ.get("BATCH_FILE_MAX_BYTES", str(2 * 1024 * 1024)))
+# locked-exists 批量接口单次最多提交的条目数（API 上限 100）
+LOCKED_EXISTS_CHUNK = 100
+# 批量邮箱查询中，每个命中条目获取的详细记录数（汇总 CSV 中列出涉及的网站）
+BATCH_EMAIL_SAMPLE = int(os.environ.get("BATCH_EMAIL_SAMPLE", "10"))
+
+# 密码泄露检查配置
+# 每个 SHA-1 前缀最多返回的哈希数（API 上限 10000）、前缀缓存的容量与有效期（秒）、批量模式单次上限
+PWCHECK_RANGE_LIMIT = 10000
+PWCHECK_CACHE_ENTRIES = int(os.environ.get("PWCHECK_CACHE_ENTRIES", "4096"))
+PWCHECK_CACHE_TTL = int(os.environ.get("PWCHECK_CACHE_TTL", "86400"))
+PWCHECK_MAX_ITEMS = int(os.environ.get("PWCHECK_MAX_ITEMS", "1000"))
+PWCHECK_HEADERS = ["password", "sha1", "status", "count", "error"]
+
+# 本地泄露库：导出时先增量同步到该 SQLite 文件，再从本地生成 CSV；设为空字符串时关闭
+LEAK_STORE_PATH = os.environ.get("LEAK_STORE_PATH", "leak_store.db")
+
+# 域名监控配置
+# 检查间隔（秒）与随机抖动比例；服务端已配置通知的域名的兜底检查间隔
+WATCH_INTERVAL = int(os.environ.get("WATCH_INTERVAL", str(6 * 3600)))
+WATCH_JITTER = float(os.environ.get("WATCH_JITTER", "0.2"))
+WATCH_SERVER_INTERVAL = int(os.environ.get("WATCH_SERVER_INTERVAL", str(24 * 3600)))
+# 调度器检查到期域名的周期（秒）、每轮最多检查的域名数、同步服务端通知列表的间隔（秒）
+WATCH_TICK = int(os.environ.get("WATCH_TICK", "60"))
+WATCH_BATCH_SIZE = int(os.environ.get("WATCH_BATCH_SIZE", "500"))
+WATCH_NOTIFICATION_SYNC = int(os.environ.get("WATCH_NOTIFICATION_SYNC", "3600"))
+# 每个会话最多监控的域名数
+WATCH_MAX_PER_CHAT = int(os.environ.get("WATCH_MAX_PER_CHAT", "200"))
+
+# 状态存储配置
+# 保存 update offset 与更新日志（SQLite WAL 模式），重启后继续处理未完成的消息
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "bot_state.db")
+# 已完成的更新日志保留天数
+JOURNAL_RETENTION_DAYS = int(os.environ.get("JOURNAL_RETENTION_DAYS", "7"))
+
+# 结果缓存配置
+# 内存中最多缓存的结果数；CACHE_DB_PATH 非空时启用 SQLite 持久层（重启后仍有效）
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "2048"))
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", "")
+# 各端点的缓存有效期（秒），未列出的端点不缓存
+CACHE_TTLS = {
+    "domain_report": int(os.environ.get("CACHE_TTL_DOMAIN_REPORT", "600")),
+    "domain_leaks": int(os.environ.get("CACHE_TTL_DOMAIN_LEAKS", "300")),
+    "email_search": int(os.environ.get("CACHE_TTL_EMAIL_SEARCH", "300")),
+    "subdomains": int(os.environ.get("CACHE_TTL_SUBDOMAINS", "1800")),
+    "urls": int(os.environ.get("CACHE_TTL_URLS", "1800")),
+}
+# 消息末尾带上该后缀时跳过缓存，例如：example.com !fresh
+FRESH_SUFFIX = "!fresh"
+
+# 分页浏览配置
+# 最多保留的结果集数、结果集有效期（秒，过期后翻页按钮提示重新查询）、每个结果集缓存的最近页数
+PAGED_RESULTS_MAX = int(os.environ.get("PAGED_RESULTS_MAX", "500"))
+PAGED_RESULT_TTL = int(os.environ.get("PAGED_RESULT_TTL", "3600"))
+PAGED_CACHE_PAGES = int(os.environ.get("PAGED_CACHE_PAGES", "5"))
+
 # API 请求头（Bearer Token 认证）
 LEAK_API_HEADERS = {
     "Authorization": f"Bearer {LEAK_API_KEY}"
 }
 
+# ============================================================================
+# 监控指标
+# ============================================================================
+
+class Metrics:
+    """
+    进程内指标注册表，输出 Prometheus 文本格式
+
+    - counter：累计值，inc() 增加
+    - histogram：延迟分布（秒），observe() / timer() 记录
+    - gauge：采集时调用回调函数取值（如队列长度、缓存命中数）
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (类型, 说明)
+        self._meta: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        # (name, labels) -> 值
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        # (name, labels) -> [各桶计数..., 总和, 次数]
+        self._histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+        # name -> 回调函数
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1.0) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, seconds: float, labels: Optional[Dict[str, str]] = None) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0.0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    values[i] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, labels: Optional[Dict[str, str]] = None):
+        """记录代码块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def gauge(self, name: str, help_text: str, fn: Callable[[], float], kind: str = "gauge") -> None:
+        """注册采集时取值的指标（kind 可为 counter，用于外部维护的累计值）"""
+        self.describe(name, kind, help_text)
+        self._gauges[name] = fn
+
+    @staticmethod
+    def _format_labels(labels: Tuple, extra: str = "") -> str:
+        parts = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{key}="{value}"')
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        """生成 Prometheus 文本格式"""
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        for name, (kind, help_text) in list(self._meta.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self._gauges:
+                try:
+                    lines.append(f"{name} {float(self._gauges[name]())}")
+                except Exception as e:
+                    print(f"[指标] 采集 {name} 失败: {e}")
+            elif kind == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value}")
+            elif kind == "histogram":
+                for (metric, labels), values in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(self.BUCKETS, values):
+                        bucket_labels = self._format_labels(labels, 'le="%s"' % bound)
+                        lines.append(f"{name}_bucket{bucket_labels} {count}")
+                    bucket_labels = self._format_labels(labels, 'le="+Inf"')
+                    lines.append(f"{name}_bucket{bucket_labels} {values[-1]}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {values[-2]}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_commands_total", "counter", "按命令统计的已处理消息数")
+metrics.describe("bot_command_duration_seconds", "histogram", "按命令统计的消息处理耗时")
+metrics.describe("leakradar_requests_total", "counter", "按端点和状态码统计的 LeakRadar 请求数")
+metrics.describe("leakradar_request_duration_seconds", "histogram", "按端点统计的 LeakRadar 请求耗时")
+metrics.describe("telegram_requests_total", "counter", "按方法和状态码统计的 Telegram Bot API 请求数")
+metrics.describe("telegram_request_duration_seconds", "histogram", "按方法统计的 Telegram Bot API 请求耗时")
+metrics.describe("telegram_send_retries_total", "counter", "按状态码统计的 Telegram 消息重发次数")
+metrics.describe("telegram_messages_merged_total", "counter", "合并到前一条消息中发送的短消息数")
+metrics.describe("export_rows_total", "counter", "导出写入 CSV 的记录数")
+metrics.describe("export_csv_write_seconds", "histogram", "单次导出中写 CSV 的累计耗时（不含获取数据）")
+
+def start_metrics_server(host: str = METRICS_LISTEN, port: int = METRICS_PORT) -> ThreadingHTTPServer:
+    """在后台线程中启动 /metrics HTTP 服务"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"✓ 监控指标: http://{host}:{server.server_port}/metrics")
+    return server
+
+# ============================================================================
+# HTTP 客户端（连接池 + Keep-Alive）
+# ============================================================================
+# 是否校验 HTTPS 证书（部分代理环境下校验会失败，默认关闭，与原有行为一致）
+VERIFY_SSL = os.environ.get("VERIFY_SSL", "0") == "1"
+# 每个主机保持的最大连接数（应不小于并发工作线程数，否则多出的连接会被丢弃重建）
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "32"))
+# 建立 TCP 连接的超时时间（秒），读取超时按端点单独配置
+HTTP_CONNECT_TIMEOUT = 10
+
+class TokenBucket:
+    """
+    线程安全的令牌桶限速器
+
+    - 令牌按 rate 个/秒补充，最多积累 capacity 个（突发容量）
+    - acquire(weight) 阻塞直到拿到足够令牌，weight 用于给较重的端点加权
+    - penalize(seconds) 在收到 429 时暂停所有请求，遵守服务端的 Retry-After
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        # 最近 1 秒内放行的 (时间, 权重) 及权重之和，用于计算利用率；每次放行时清理过期项，长度不超过 1 秒的放行数
+        self._recent = deque()
+        self._recent_weight = 0.0
+        self.total_acquired = 0.0
+        self.total_wait = 0.0
+        self.throttled = 0
+
+    def acquire(self, weight: float = 1.0) -> float:
+        """获取令牌，返回等待的秒数"""
+        weight = min(weight, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                elif self._tokens >= weight:
+                    self._tokens -= weight
+                    self._expire(now)
+                    self._recent.append((now, weight))
+                    self._recent_weight += weight
+                    self.total_acquired += weight
+                    self.total_wait += waited
+                    return waited
+                else:
+                    delay = (weight - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def penalize(self, seconds: float) -> None:
+        """暂停发放令牌 seconds 秒（用于处理 429 / Retry-After）"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self.throttled += 1
+
+    def _expire(self, now: float) -> None:
+        """移除 1 秒之前的放行记录（调用方持有锁）"""
+        cutoff = now - 1.0
+        while self._recent and self._recent[0][0] < cutoff:
+            self._recent_weight -= self._recent.popleft()[1]
+        if not self._recent:
+            self._recent_weight = 0.0
+
+    def utilization(self) -> float:
+        """最近 1 秒内已使用的配额占速率上限的比例（0.0 ~ 1.0+）"""
+        with self._lock:
+            self._expire(time.monotonic())
+            return self._recent_weight / self.rate
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """解析 Retry-After 头（秒数或 HTTP 日期），返回需要等待的秒数"""
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(retry_at.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+leak_rate_limiter = TokenBucket(LEAK_API_RATE_LIMIT, LEAK_API_BURST)
+# 批量通道（导出、批量查询、后台监控）额外经过这个令牌桶，为交互查询保留 LEAK_API_INTERACTIVE_SHARE 的配额
+bulk_rate_limiter = TokenBucket(LEAK_API_RATE_LIMIT * (1 - LEAK_API_INTERACTIVE_SHARE), LEAK_API_BURST)
+
+# 当前代码所属的调度通道（interactive / bulk），决定 LeakRadar 请求走哪个限速器
+current_lane: contextvars.ContextVar = contextvars.ContextVar("current_lane", default="interactive")
+
+def run_in_lane(lane: str, fn: Callable[..., Any], *args) -> Any:
+    """在指定通道中执行函数"""
+    token = current_lane.set(lane)
+    try:
+        return fn(*args)
+    finally:
+        current_lane.reset(token)
+
+def build_session(headers: Optional[Dict[str, str]] = None, pool_size: int = HTTP_POOL_SIZE) -> requests.Session:
+    """
+    创建带连接池的 Session
+
+    - 复用 TCP/TLS 连接（Keep-Alive），避免每个请求都重新握手
+    - 统一应用代理与证书校验设置
+    - 仅对建立连接失败做少量重试（此时请求尚未发出，重试是安全的）
+    """
+    session = requests.Session()
+    retry = Retry(total=None, connect=2, read=0, status=0, redirect=3, backoff_factor=0.3)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    if headers:
+        session.headers.update(headers)
+    if PROXIES:
+        session.proxies.update(PROXIES)
+    session.verify = VERIFY_SSL
+    return session
+
+class LeakRadarClient:
+    """
+    LeakRadar API 客户端
+
+    持有一个带连接池的 Session，所有 LeakRadar 请求都通过它发送。
+    endpoint 为端点名称（如 "domain_report"），用于选择超时时间和限速权重，不随域名等参数变化。
+    每个请求发出前都要从全局令牌桶取令牌；收到 429 时按 Retry-After 暂停后重试。
+    """
+
+    # 各端点的读取超时（秒），未列出的端点使用 default
+    TIMEOUTS = {
+        "default": 30,
+        "domain_unlock": 60,
+        "email_unlock": 60,
+        "download": 60,
+    }
+
+    def __init__(self, base_url: str = LEAK_API_BASE_URL, headers: Optional[Dict[str, str]] = None,
+                 limiter: Optional[TokenBucket] = None):
+        self.base_url = base_url.rstrip("/")
+        self.session = build_session(headers if headers is not None else LEAK_API_HEADERS)
+        self.limiter = limiter or leak_rate_limiter
+
+    def request(self, method: str, endpoint: str, path: str, timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        """发送请求，path 可以是相对路径（拼接 base_url）或完整 URL"""
+        url = path if path.startswith(("http://", "https://")) else f"{self.base_url}{path}"
+        if timeout is None:
+            timeout = self.TIMEOUTS.get(endpoint, self.TIMEOUTS["default"])
+        weight = LEAK_API_WEIGHTS.get(endpoint, 1.0)
+
+        attempt = 0
+        while True:
+            if current_lane.get() == "bulk":
+                bulk_rate_limiter.acquire(weight)
+            self.limiter.acquire(weight)
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=(HTTP_CONNECT_TIMEOUT, timeout), **kwargs)
+            except requests.exceptions.RequestException:
+                metrics.inc("leakradar_requests_total", {"endpoint": endpoint, "status": "error"})
+                raise
+            finally:
+                metrics.observe("leakradar_request_duration_seconds", time.perf_counter() - start, {"endpoint": endpoint})
+            metrics.inc("leakradar_requests_total", {"endpoint": endpoint, "status": str(response.status_code)})
+            if response.status_code != 429 or attempt >= LEAK_API_MAX_RETRIES:
+                return response
+            attempt += 1
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            response.close()
+            print(f"[限速] {endpoint} 返回 429，{retry_after:.1f} 秒后重试 ({attempt}/{LEAK_API_MAX_RETRIES})")
+            self.limiter.penalize(retry_after)
+
+    def get(self, endpoint: str, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", endpoint, path, **kwargs)
+
+    def post(self, endpoint: str, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", endpoint, path, **kwargs)
+
+class TelegramClient:
+    """
+    Telegram Bot API 客户端
+
+    持有一个带连接池的 Session，所有 Bot API 调用都通过它发送。
+    """
+
+    # 各方法的读取超时（秒），未列出的方法使用 default
+    TIMEOUTS = {
+        "default": 10,
+        "sendDocument": 120,
+    }
+
+    def __init__(self, base_url: str = API_BASE_URL):
+        self.base_url = base_url.rstrip("/")
+        self.session = build_session()
+
+    def call(self, method: str, http_method: str = "POST", timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        """调用 Bot API 方法，例如 call("sendMessage", json={...})"""
+        if timeout is None:
+            timeout = self.TIMEOUTS.get(method, self.TIMEOUTS["default"])
+        start = time.perf_counter()
+        try:
+            response = self.session.request(http_method, f"{self.base_url}/{method}",
+                                            timeout=(HTTP_CONNECT_TIMEOUT, timeout), **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.inc("telegram_requests_total", {"method": method, "status": "error"})
+            raise
+        finally:
+            metrics.observe("telegram_request_duration_seconds", time.perf_counter() - start, {"method": method})
+        metrics.inc("telegram_requests_total", {"method": method, "status": str(response.status_code)})
+        return response
+
+leak_client = LeakRadarClient()
+telegram_client = TelegramClient()
+
+# ============================================================================
+# 发送队列（Telegram 出站消息）
+# ============================================================================
+
+class OutboundItem:
+    """
+    发送队列中的一项：一条文本消息、一次消息编辑，或需要按会话顺序执行的操作（如上传文件）
+
+    build 不为空时在发出前才调用，返回请求参数（返回 None 表示不再需要发送），用于编辑时取最新内容
+    """
+
+    def __init__(self, chat_id: int, text: Optional[str] = None, params: Optional[Dict[str, Any]] = None,
+                 action: bool = False, method: str = "sendMessage", merge: bool = True,
+                 build: Optional[Callable[[], Optional[Dict[str, Any]]]] = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.params = params or {}
+        self.action = action
+        self.method = method
+        self.build = build
+        self.mergeable = merge and not action and build is None and not self.params
+        # 带按钮（reply_markup）的消息可以作为合并的最后一条：前面排队的短文本并入其中，按钮保留
+        self.merge_last = merge and not action and build is None and set(self.params) <= {"reply_markup"}
+        self.attempts = 0
+        self.future: Future = Future()
+        # 操作类的项轮到时置位，由提交方的线程执行
+        self.turn = threading.Event()
+
+class ChatSendState:
+    """
+    单个会话的发送状态：排队的消息、会话级令牌桶和 429 暂停时间
+
+    消息编辑（进度更新）单独排队，优先级低于新消息：只在没有待发送的消息、且令牌桶已满时发出，
+    突发容量始终留给新消息，进度更新不会推迟回复和文件上传
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.not_before = 0.0
+        self.queue: deque = deque()
+        self.edits: deque = deque()
+        # 正在发送（或正在执行操作）时为 True，保证同一会话同一时间只有一个请求
+        self.busy = False
+        # 在就绪堆中的最早时间（不在堆中时为 None）
+        self.scheduled_at: Optional[float] = None
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pending(self) -> bool:
+        return bool(self.queue or self.edits)
+
+    def ready_at(self, now: float) -> float:
+        """下一条消息（或编辑）最早可以发送的时间"""
+        self.refill(now)
+        need = 1.0 if self.queue else self.burst
+        wait = 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+        return max(now + wait, self.not_before)
+
+    def idle(self, now: float) -> bool:
+        self.refill(now)
+        return not self.pending() and not self.busy and self.tokens >= self.burst and now >= self.not_before
+
+class OutboundQueue:
+    """
+    Telegram 出站消息队列
+
+    - 所有发给用户的消息和文件都经过这里：全局令牌桶保证不超过 Bot API 的总发送速率，每个会话
+      另有令牌桶（私聊约 1 条/秒，群组约 20 条/分钟），同一会话的消息严格按提交顺序发送
+    - 收到 429 时按 retry_after 暂停该会话和全局令牌桶并重新排队，不丢弃消息；网络错误和 5xx 按指数退避重试
+    - 同一会话排队中的连续短文本合并成一条发送（不超过 4096 字符），减少请求数；带按钮的消息只能作为合并的最后一条
+    - 文本消息由发送线程异步发送，返回 Future；上传文件等操作轮到时在提交方线程中执行，不占用发送线程
+    """
+
+    def __init__(self, workers: int = TELEGRAM_SEND_WORKERS, rate: float = TELEGRAM_SEND_RATE,
+                 burst: float = TELEGRAM_SEND_BURST, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 group_rate: float = TELEGRAM_GROUP_RATE, chat_burst: float = TELEGRAM_CHAT_BURST,
+                 max_retries: int = TELEGRAM_SEND_RETRIES):
+        self.workers = workers
+        self.limiter = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._chats: Dict[int, ChatSendState] = {}
+        # (可发送时间, 序号, chat_id) 小顶堆
+        self._ready: List[Tuple[float, int, int]] = []
+        self._seq = itertools.count()
+        self._threads: List[threading.Thread] = []
+        self.merged = 0
+        self.retries = 0
+
+    def send(self, chat_id: int, text: str, merge: bool = True, **params) -> Future:
+        """
+        发送文本消息，Future 的结果为 Telegram 返回的消息对象，失败时为 None
+
+        merge 为 False 时不与前后的消息合并（之后要编辑的消息）
+        """
+        item = OutboundItem(chat_id, text, params, merge=merge)
+        self._enqueue(item)
+        return item.future
+
+    def edit(self, chat_id: int, build: Callable[[], Optional[Dict[str, Any]]]) -> Future:
+        """编辑消息，发出时才调用 build 取得 editMessageText 的参数，排队期间的更新不会产生额外请求"""
+        item = OutboundItem(chat_id, method="editMessageText", build=build)
+        self._enqueue(item)
+        return item.future
+
+    def replace(self, chat_id: int, message_id: int, text: str, **params) -> Future:
+        """
+        用户操作触发的消息编辑（如翻页）：内容已确定，与新消息一样按顺序排队，
+        不像进度编辑那样等令牌桶满才发出
+        """
+        item = OutboundItem(chat_id, text, {"message_id": message_id, **params},
+                            method="editMessageText", merge=False)
+        self._enqueue(item)
+        return item.future
+
+    def run(self, chat_id: int, fn: Callable[..., Any], *args) -> Any:
+        """
+        等该会话之前排队的消息都发出后，在当前线程执行 fn（如上传文件）
+
+        fn 开始执行时即释放会话，上传大文件期间后续的文本消息照常发送
+        """
+        item = OutboundItem(chat_id, action=True)
+        self._enqueue(item)
+        item.turn.wait()
+        self.limiter.acquire()
+        with self._cond:
+            self._chats[chat_id].busy = False
+            self._schedule(chat_id)
+        return fn(*args)
+
+    def throttle(self, chat_id: int, delay: float) -> None:
+        """
+        收到 429 后暂停发送 delay 秒：该会话在此之前不会再被调度，全局令牌桶同时暂停，
+        其他会话的消息也不会继续撞上限流
+        """
+        self.limiter.penalize(delay)
+        with self._cond:
+            state = self._chats.get(chat_id)
+            if state is not None:
+                state.not_before = max(state.not_before, time.monotonic() + delay)
+                self._schedule(chat_id)
+
+    def pending(self) -> int:
+        """排队中的消息数"""
+        with self._cond:
+            return sum(len(state.queue) + len(state.edits) for state in self._chats.values())
+
+    def flush(self, timeout: float = 10) -> bool:
+        """等待排队中的消息发送完（用于退出前），返回是否已全部发送"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while any(state.pending() or state.busy for state in self._chats.values()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 0.1))
+        return True
+
+    def _enqueue(self, item: OutboundItem) -> None:
+        self._ensure_threads()
+        with self._cond:
+            state = self._chats.get(item.chat_id)
+            if state is None:
+                if len(self._chats) >= 1024:
+                    self._prune()
+                rate = self.group_rate if item.chat_id < 0 else self.chat_rate
+                state = self._chats[item.chat_id] = ChatSendState(rate, self.chat_burst)
+            (state.edits if item.build is not None else state.queue).append(item)
+            self._schedule(item.chat_id)
+
+    def _prune(self) -> None:
+        """清理空闲会话的状态（调用方持有锁）"""
+        now = time.monotonic()
+        for chat_id in [c for c, state in self._chats.items() if state.idle(now)]:
+            del self._chats[chat_id]
+
+    def _schedule(self, chat_id: int) -> None:
+        """
+        会话有待发送的消息且空闲时放入就绪堆（调用方持有锁）
+
+        已在堆中但新消息可以更早发出时（如排在进度编辑之后的新消息）再放入一个更早的时间，过时的项出堆时忽略
+        """
+        state = self._chats[chat_id]
+        if state.pending() and not state.busy:
+            ready_at = state.ready_at(time.monotonic())
+            if state.scheduled_at is None or ready_at < state.scheduled_at:
+                state.scheduled_at = ready_at
+                heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+        self._cond.notify_all()
+
+    def _ensure_threads(self) -> None:
+        with self._cond:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for _ in range(self.workers - len(self._threads)):
+                thread = threading.Thread(target=self._run, name="tg-sender", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _take(self) -> Tuple[ChatSendState, List[OutboundItem]]:
+        """取出下一个可以发送的会话及其待发送的消息（合并连续的短文本）"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    state = self._chats.get(chat_id)
+                    if state is None or not state.pending() or state.busy:
+                        continue
+                    state.scheduled_at = None
+                    # 429 暂停期间可能又被调度过，重新检查时间
+                    ready_at = state.ready_at(now)
+                    if ready_at > now:
+                        state.scheduled_at = ready_at
+                        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+                        continue
+                    break
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+            state.tokens -= 1
+            state.busy = True
+            if not state.queue:
+                return state, [state.edits.popleft()]
+            item = state.queue.popleft()
+            if item.action:
+                item.turn.set()
+                return state, []
+            batch = [item]
+            length = len(item.text or "")
+            while (batch[-1].mergeable and state.queue and state.queue[0].merge_last
+                   and length + 2 + len(state.queue[0].text) <= TELEGRAM_MESSAGE_LIMIT):
+                batch.append(state.queue.popleft())
+                length += 2 + len(batch[-1].text)
+            return state, batch
+
+    def _run(self) -> None:
+        while True:
+            state, batch = self._take()
+            if not batch:
+                continue
+            try:
+                self._deliver(state, batch)
+            except Exception as e:
+                print(f"[发送队列] 发送出错: {e}")
+                traceback.print_exc()
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_result(None)
+            finally:
+                with self._cond:
+                    state.busy = False
+                    self._schedule(batch[0].chat_id)
+
+    def _deliver(self, state: ChatSendState, batch: List[OutboundItem]) -> None:
+        """发送一条（可能是合并后的）消息，失败时按错误类型重新排队或放弃"""
+        first = batch[0]
+        if len(batch) > 1:
+            self.merged += len(batch) - 1
+            metrics.inc("telegram_messages_merged_total", value=len(batch) - 1)
+        if first.build is not None:
+            data = first.build()
+            if data is None:
+                first.future.set_result(None)
+                return
+        else:
+            data = {"chat_id": first.chat_id, "text": "\n\n".join(item.text for item in batch), **batch[-1].params}
+        self.limiter.acquire()
+        status, result = 0, {}
+        try:
+            response = telegram_client.call(first.method, json=data)
+            status = response.status_code
+            result = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"[发送队列] 发送消息失败: {e}")
+
+        if status == 200 and result.get("ok"):
+            for item in batch:
+                item.future.set_result(result.get("result"))
+            return
+
+        delay = None
+        if status == 429:
+            delay = float(result.get("parameters", {}).get("retry_after", 1))
+            print(f"[发送队列] 会话 {first.chat_id} 触发限流，{delay:g} 秒后重发")
+            self.limiter.penalize(delay)
+        elif status == 0 or status >= 500:
+            first.attempts += 1
+            if first.attempts <= self.max_retries:
+                delay = min(30.0, 0.5 * 2 ** first.attempts) * random.uniform(0.8, 1.2)
+                print(f"[发送队列] 发送消息失败（{status or '网络错误'}），{delay:.1f} 秒后第 {first.attempts} 次重试")
+        elif len(batch) > 1:
+            # 合并后的消息被拒绝（如格式问题），拆开逐条重发
+            delay = 0.0
+            for item in batch:
+                item.mergeable = item.merge_last = False
+
+        if delay is None:
+            print(f"发送消息失败: {status} {result}")
+            for item in batch:
+                item.future.set_result(None)
+            return
+
+        self.retries += 1
+        metrics.inc("telegram_send_retries_total", {"status": str(status) if status else "error"})
+        with self._cond:
+            state.not_before = max(state.not_before, time.monotonic() + delay)
+            (state.edits if first.build is not None else state.queue).extendleft(reversed(batch))
+
+outbound_queue = OutboundQueue()
+metrics.gauge("telegram_send_queue_depth", "排队等待发送的 Telegram 消息数", outbound_queue.pending)
+
+# ============================================================================
+# 进度消息
+# ============================================================================
+
+class ProgressReporter:
+    """
+    长任务的进度消息
+
+    开始时发送一条状态消息，之后的进度（已获取条数、解锁状态、上传进度）都原地编辑这一条。
+    编辑经发送队列按会话限速；同一时间最多只有一个编辑在排队，发出时取最新的进度，
+    中间状态直接跳过，因此循环中频繁调用 update() 也不会产生额外的请求。
+    """
+
+    def __init__(self, chat_id: int, title: str):
+        self.chat_id = chat_id
+        self.title = title
+        self._lock = threading.Lock()
+        # 分项 -> 进度文字（如导出全部时每个泄露类型一行）
+        self._lines: "OrderedDict[str, str]" = OrderedDict()
+        self._section = ""
+        self._footer = ""
+        self._edit_pending = False
+        self._sending: Optional[str] = None
+        self._shown = title
+        self._message = outbound_queue.send(chat_id, title, merge=False)
+
+    def section(self, name: str) -> None:
+        """之后的进度写到名为 name 的一行"""
+        with self._lock:
+            self._section = name
+
+    def update(self, text: str) -> None:
+        """更新当前分项的进度"""
+        with self._lock:
+            self._lines[self._section] = text
+        self._request_edit()
+
+    def finish(self, text: str) -> None:
+        """写入最终结果（显示在各分项之后）"""
+        with self._lock:
+            self._footer = text
+        self._request_edit()
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [f"{name}：{text}" if name else text for name, text in self._lines.items()]
+            parts = [self.title, "\n".join(lines), self._footer]
+        return "\n\n".join(part for part in parts if part)
+
+    def _request_edit(self) -> None:
+        with self._lock:
+            if self._edit_pending:
+                return
+            self._edit_pending = True
+        outbound_queue.edit(self.chat_id, self._build_edit).add_done_callback(self._edited)
+
+    def _build_edit(self) -> Optional[Dict[str, Any]]:
+        # 编辑排在状态消息之后，此时状态消息已经发出（或已失败）
+        message = self._message.result()
+        text = self.render()
+        with self._lock:
+            self._edit_pending = False
+            if message is None or text == self._shown:
+                return None
+            self._sending = text
+        return {"chat_id": self.chat_id, "message_id": message["message_id"], "text": text[:TELEGRAM_MESSAGE_LIMIT]}
+
+    def _edited(self, future: Future) -> None:
+        if future.result() is not None:
+            with self._lock:
+                self._shown = self._sending
+
+# 当前任务的进度消息（在处理消息的线程中设置，抓取线程通过 submit_fetch 继承）
+current_progress: contextvars.ContextVar = contextvars.ContextVar("current_progress", default=None)
+
+@contextmanager
+def progress_message(chat_id: int, title: str) -> Iterator[ProgressReporter]:
+    """发送进度消息，在 with 块内通过 report_progress() 更新"""
+    reporter = ProgressReporter(chat_id, title)
+    token = current_progress.set(reporter)
+    try:
+        yield reporter
+    finally:
+        current_progress.reset(token)
+
+def report_progress(text: str) -> None:
+    """更新当前任务的进度消息（没有进度消息时忽略）"""
+    reporter = current_progress.get()
+    if reporter is not None:
+        reporter.update(text)
+
+# ============================================================================
+# 结果缓存
+# ============================================================================
+
+class ResultCache:
+    """
+    LeakRadar 查询结果缓存
+
+    - 以 (端点, 范围, 规范化参数) 为键，范围一般是域名或邮箱，便于按域名整体失效
+    - 每个端点单独设置 TTL，未配置 TTL 的端点不缓存
+    - 内存层为容量有限的 LRU；配置 db_path 时增加 SQLite 持久层，重启后仍可命中
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttls: Optional[Dict[str, int]] = None,
+                 db_path: str = CACHE_DB_PATH):
+        self.max_entries = max_entries
+        self.ttls = ttls if ttls is not None else CACHE_TTLS
+        self._lock = threading.Lock()
+        # key -> (过期时间, 端点, 范围, 结果)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS cache ("
+                    "key TEXT PRIMARY KEY, endpoint TEXT, scope TEXT, expires_at REAL, value TEXT)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS cache_scope ON cache (scope)")
+                self._db.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+                self._db.commit()
+                print(f"✓ 已启用磁盘缓存: {db_path}")
+            except sqlite3.Error as e:
+                print(f"⚠ 打开磁盘缓存失败，仅使用内存缓存: {e}")
+                self._db = None
+
+    @staticmethod
+    def make_key(endpoint: str, scope: str, params: Dict[str, Any]) -> str:
+        return f"{endpoint}|{scope.lower()}|{json.dumps(params, sort_keys=True, ensure_ascii=False)}"
+
+    def get(self, endpoint: str, scope: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """查询缓存，未命中或已过期时返回 None"""
+        if endpoint not in self.ttls:
+            return None
+        key = self.make_key(endpoint, scope, params)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[3]
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT expires_at, value FROM cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[0] > now:
+                    value = json.loads(row[1])
+                    self._store(key, row[0], endpoint, scope, value)
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def set(self, endpoint: str, scope: str, params: Dict[str, Any], value: Dict[str, Any]) -> None:
+        """写入缓存（错误结果不应写入）"""
+        ttl = self.ttls.get(endpoint)
+        if not ttl:
+            return
+        key = self.make_key(endpoint, scope, params)
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._store(key, expires_at, endpoint, scope, value)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO cache (key, endpoint, scope, expires_at, value) VALUES (?, ?, ?, ?, ?)",
+                        (key, endpoint, scope.lower(), expires_at, json.dumps(value, ensure_ascii=False))
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"[缓存] 写入磁盘缓存失败: {e}")
+
+    def _store(self, key: str, expires_at: float, endpoint: str, scope: str, value: Dict[str, Any]) -> None:
+        self._entries[key] = (expires_at, endpoint, scope.lower(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, scope: str) -> None:
+        """删除某个域名 / 邮箱的全部缓存（例如解锁后数据发生变化）"""
+        scope = scope.lower()
+        with self._lock:
+            for key in [k for k, v in self._entries.items() if v[2] == scope]:
+                del self._entries[key]
+            if self._db is not None:
+                self._db.execute("DELETE FROM cache WHERE scope = ?", (scope,))
+                self._db.commit()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+result_cache = ResultCache()
+metrics.gauge("bot_cache_hits_total", "结果缓存命中次数", lambda: result_cache.hits, kind="counter")
+metrics.gauge("bot_cache_misses_total", "结果缓存未命中次数", lambda: result_cache.misses, kind="counter")
+metrics.gauge("leakradar_rate_limit_utilization", "最近 1 秒 LeakRadar 配额利用率", leak_rate_limiter.utilization)
+metrics.gauge("leakradar_rate_limited_total", "收到 429 的次数", lambda: leak_rate_limiter.throttled, kind="counter")
+
+class SingleFlight:
+    """
+    相同请求合并（single-flight）
+
+    同一个 key 的调用在途时，后到的调用方不再重复发送请求，而是等待并共享第一个调用的结果。
+    用于多人几乎同时查询 / 解锁同一域名的场景，既节省时间也避免重复消耗积分。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+        self.shared = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+            else:
+                self.shared += 1
+
+        if not leader:
+            print(f"[合并] 等待相同的在途请求: {key}")
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+single_flight = SingleFlight()
+
+def cached_request(endpoint: str, scope: str, params: Dict[str, Any],
+                   load: Callable[[], Dict[str, Any]], fresh: bool = False) -> Dict[str, Any]:
+    """
+    带缓存和请求合并的 API 查询
+
+    - 先查缓存（fresh=True 时跳过）
+    - 未命中时，相同 (端点, 范围, 参数) 的并发请求只发送一次，其余调用方共享结果
+    - 成功的结果写入缓存
+
+    Args:
+        endpoint: 端点名称
+        scope: 范围（域名或邮箱）
+        params: 影响结果的参数
+        load: 实际发送请求的函数，返回 API 结果或包含 'error' 的字典
+        fresh: 是否跳过缓存
+
+    Returns:
+        API 返回的 JSON 数据
+    """
+    if not fresh:
+        cached = result_cache.get(endpoint, scope, params)
+        if cached is not None:
+            return cached
+
+    # fresh 请求只与 fresh 请求合并，避免拿到解锁前发出的旧请求结果
+    key = ResultCache.make_key(endpoint, scope, params) + ("|fresh" if fresh else "")
+
+    def load_and_store() -> Dict[str, Any]:
+        result = load()
+        if "error" not in result:
+            result_cache.set(endpoint, scope, params, result)
+        return result
+
+    return single_flight.do(key, load_and_store)
+
+# 分页抓取线程池（所有导出共用，整体速率由令牌桶控制）
+fetch_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="fetch")
+
+def submit_fetch(fn: Callable[..., Any], *args) -> Future:
+    """提交到抓取线程池，任务沿用调用方的通道（批量任务发出的请求仍按批量限速）"""
+    return fetch_executor.submit(contextvars.copy_context().run, fn, *args)
+
 # 全局变量
 last_update_id = 0
 
 def delete_webhook() -> bool:
     """删除 Webhook 配置，确保 getUpdates 可用"""
-    url = f"{API_BASE_URL}/deleteWebhook"
     try:
-        response = requests.get(url, timeout=10, proxies=PROXIES, verify=False)
+        response = telegram_client.call("deleteWebhook", http_method="GET")
         result = response.json()
         if result.get("ok"):
             print("✓ Webhook 已清除")
@@ -114,31 +1271,53 @@ def delete_webhook() -> bool:
         print(f"⚠ 清除 Webhook 出错: {e}")
         return False
 
+def set_webhook(url: str, secret_token: str) -> bool:
+    """设置 Webhook，Telegram 会把更新推送到 url，并在请求头中带上 secret_token"""
+    try:
+        response = telegram_client.call("setWebhook", json={"url": url, "secret_token": secret_token})
+        result = response.json()
+        if result.get("ok"):
+            print(f"✓ Webhook 已设置: {url}")
+            return True
+        else:
+            print(f"⚠ 设置 Webhook 失败: {result}")
+            return False
+    except Exception as e:
+        print(f"⚠ 设置 Webhook 出错: {e}")
+        return False
+
+def get_me() -> Dict[str, Any]:
+    """获取机器人自身信息（也用于测试 Token 与网络连接）"""
+    try:
+        response = telegram_client.call("getMe", http_method="GET")
+        return response.json()
+    except Exception as e:
+        print(f"获取机器人信息失败: {e}")
+        return {"ok": False}
+
 def get_updates(timeout: int = 30, offset: Optional[int] = None) -> Dict[str, Any]:
     """获取更新消息"""
     print(f"[DEBUG] 开始获取更新... timeout={timeout}", flush=True)
-    url = f"{API_BASE_URL}/getUpdates"
     params = {
         "timeout": timeout
     }
     if offset:
         params["offset"] = offset
         # print(f"[DEBUG] 使用 offset: {offset}")
-    else:
-        # 如果没有 offset，尝试获取所有未确认的消息
-        params["offset"] = -1
-        # print(f"[DEBUG] 使用默认 offset: -1")
+    # 没有 offset 时不传该参数，Telegram 会返回所有未确认的消息
+    # （offset=-1 只返回最后一条，机器人停机期间收到的其他消息会丢失）
     
     try:
         # 增加 verify=False 避免某些证书问题，但会由警告
         # 也可以尝试自动检测代理，这里先保持简单
-        response = requests.get(url, params=params, timeout=timeout + 10, proxies=PROXIES, verify=False)
+        response = telegram_client.call("getUpdates", http_method="GET", params=params, timeout=timeout + 10)
         response.raise_for_status()
         data = response.json()
         if not data.get("result"):
              print(f"[DEBUG] 暂无新消息", flush=True)
         else:
-             print(f"[DEBUG] 收到消息: {json.dumps(data, ensure_ascii=False)}", flush=True)
+             # 消息内容由 handle_message 记录（其中会隐去密码），这里只记录数量
+             print(f"[DEBUG] 收到 {len(data['result'])} 条更新", flush=True)
         return data
     except requests.exceptions.RequestException as e:
         print(f"获取更新失败: {e}")
@@ -147,69 +1326,175 @@ def get_updates(timeout: int = 30, offset: Optional[int] = None) -> Dict[str, An
             print("💡 提示: 请检查网络连接或代理设置 (Telegram API 需要翻墙)")
         return {"ok": False, "result": []}
 
-def send_message(chat_id: int, text: str) -> bool:
-    """发送消息"""
-    url = f"{API_BASE_URL}/sendMessage"
-    data = {
-        "chat_id": chat_id,
-        "text": text
-    }
-    
+def send_message(chat_id: int, text: str, wait: bool = False) -> bool:
+    """
+    发送消息（经发送队列限速、失败重试，同一会话按顺序发出）
+
+    wait 为 False 时放入队列即返回 True；为 True 时等待发送完成并返回是否成功
+    """
+    future = outbound_queue.send(chat_id, text)
+    if not wait:
+        return True
+    return future.result() is not None
+
+def delete_message(chat_id: int, message_id: int) -> bool:
+    """删除消息（群组中需要机器人有删除权限，失败时忽略）"""
     try:
-        response = requests.post(url, json=data, timeout=10, proxies=PROXIES, verify=False)
-        response.raise_for_status()
+        response = telegram_client.call("deleteMessage", json={"chat_id": chat_id, "message_id": message_id})
         return response.json().get("ok", False)
-    except requests.exceptions.RequestException as e:
-        print(f"发送消息失败: {e}")
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"删除消息失败: {e}")
+        return False
+
+def answer_callback_query(callback_query_id: str, text: str = "") -> bool:
+    """应答按钮回调（结束客户端按钮上的加载状态），text 非空时以提示条显示"""
+    try:
+        response = telegram_client.call("answerCallbackQuery",
+                                        json={"callback_query_id": callback_query_id, "text": text})
+        return response.json().get("ok", False)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"应答按钮回调失败: {e}")
         return False
 
 def send_document(chat_id: int, file_path: str, caption: str = "") -> bool:
     """发送文件（文档）"""
-    url = f"{API_BASE_URL}/sendDocument"
     
-    try:
+    def read_file() -> Iterator[bytes]:
         with open(file_path, 'rb') as f:
-            files = {'document': (os.path.basename(file_path), f, 'text/csv')}
-            data = {
-                'chat_id': chat_id,
-                'caption': caption[:1024] if caption else ""  # Telegram 限制 caption 长度
-            }
-            response = requests.post(url, files=files, data=data, timeout=120, proxies=PROXIES, verify=False)
-            response.raise_for_status()
-            result = response.json()
-            if not result.get("ok"):
-                print(f"发送文件失败: {result}")
-                return False
-            return True
-    except requests.exceptions.RequestException as e:
-        print(f"发送文件失败: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                error_detail = e.response.json()
-                print(f"错误详情: {error_detail}")
-            except:
-                pass
-        return False
+            yield from iter(lambda: f.read(UPLOAD_BUFFER_SIZE), b"")
+    
+    return send_document_stream(chat_id, os.path.basename(file_path), read_file, caption, replayable=True)
+
+def _multipart_field(boundary: str, name: str, value: Any) -> bytes:
+    return (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n").encode("utf-8")
+
+def iter_multipart_document(boundary: str, chat_id: int, filename: str, chunks: Iterable[bytes],
+                            caption: Union[str, Callable[[], str]], content_type: str) -> Iterator[bytes]:
+    """
+    生成 sendDocument 的 multipart 请求体
+
+    文件内容合并成 UPLOAD_BUFFER_SIZE 大小的块再发出，减少分块数量。
+    caption 放在文件之后，可以是函数：在文件内容全部产出后才调用（此时记录数等信息已知）。
+    """
+    yield _multipart_field(boundary, "chat_id", chat_id)
+    safe_name = filename.replace('"', "_")
+    yield (f"--{boundary}\r\nContent-Disposition: form-data; name=\"document\"; filename=\"{safe_name}\"\r\n"
+           f"Content-Type: {content_type}\r\n\r\n").encode("utf-8")
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= UPLOAD_BUFFER_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+    yield b"\r\n"
+    text = caption() if callable(caption) else caption
+    if text:
+        # Telegram 限制 caption 长度
+        yield _multipart_field(boundary, "caption", text[:1024])
+    yield f"--{boundary}--\r\n".encode("utf-8")
+
+def _post_document(chat_id: int, filename: str, chunks: Iterable[bytes],
+                   caption: Union[str, Callable[[], str]], content_type: str) -> Optional[bool]:
+    """
+    以分块传输上传一次文件
+
+    Returns:
+        True 成功；False 可重试的失败（网络错误、5xx、429）；None 不可重试的失败（如 400）
+    """
+    boundary = secrets.token_hex(16)
+    try:
+        response = telegram_client.call(
+            "sendDocument",
+            data=iter_multipart_document(boundary, chat_id, filename, chunks, caption, content_type),
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}
+        )
+    except UploadTooLarge:
+        raise
+    except Exception as e:
+        print(f"发送文件失败: {e}")
+        return False
+    
+    try:
+        result = response.json()
+    except ValueError:
+        result = {}
+    if response.status_code == 200 and result.get("ok"):
+        return True
+    print(f"发送文件失败: {response.status_code} {result}")
+    if response.status_code == 429:
+        # 不在这里等待：暂停该会话和全局令牌桶，重试时经发送队列排队
+        outbound_queue.throttle(chat_id, float(result.get("parameters", {}).get("retry_after", 1)))
+        return False
+    return False if response.status_code >= 500 else None
+
+def send_document_stream(chat_id: int, filename: str, open_source: Callable[[], Iterable[bytes]],
+                         caption: Union[str, Callable[[], str]] = "", content_type: str = "text/csv",
+                         replayable: bool = False) -> bool:
+    """
+    流式发送文件：数据源的内容直接写入上传请求，不落地临时文件
+
+    每次上传（包括重试）都经发送队列排队：之前排队的文本消息（如"正在导出"）发出后再上传，
+    429 后的重试等该会话和全局的限流暂停结束再轮到，不在上传线程中 sleep。
+
+    Args:
+        chat_id: 聊天 ID
+        filename: Telegram 中显示的文件名
+        open_source: 返回文件内容（字节块）的函数，如 LeakRadar 下载的响应体或 CSV 生成器
+        caption: 说明文字，或返回说明文字的函数（在文件内容产出后调用）
+        content_type: 文件 MIME 类型
+        replayable: 数据源能否廉价地重新打开（如本地文件）。否则重试时重新生成一次数据并写入
+                    临时文件（关闭即删除），之后的重试都从临时文件读取
+
+    Returns:
+        是否发送成功
+    """
+    spool = None
+    try:
+        for attempt in range(UPLOAD_RETRIES + 1):
+            if attempt == 0 or replayable:
+                chunks = open_source()
+            else:
+                if spool is None:
+                    print(f"[上传] {filename} 上传失败，生成临时文件后重试")
+                    spool = tempfile.TemporaryFile()
+                    for chunk in open_source():
+                        spool.write(chunk)
+                spool.seek(0)
+                chunks = iter(lambda: spool.read(UPLOAD_BUFFER_SIZE), b"")
+            
+            result = outbound_queue.run(chat_id, _post_document, chat_id, filename, chunks, caption, content_type)
+            if result:
+                return True
+            if result is None:
+                return False
+        return False
+    except UploadTooLarge:
+        raise
     except Exception as e:
         print(f"发送文件出错: {e}")
-        import traceback
         traceback.print_exc()
         return False
+    finally:
+        if spool is not None:
+            spool.close()
+
+# 域名格式与规范化用的正则（模块加载时编译一次）
+DOMAIN_PATTERN = re.compile(
+    r'^(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}$'
+)
+DOMAIN_PREFIX_PATTERN = re.compile(r'^(?:https?://)?(?:www\.)?')
 
 def is_valid_domain(domain: str) -> bool:
     """验证域名格式是否有效"""
-    domain_pattern = re.compile(
-        r'^(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}$'
-    )
-    return bool(domain_pattern.match(domain.strip()))
+    return bool(DOMAIN_PATTERN.match(domain.strip()))
 
 def normalize_domain(domain: str) -> str:
     """规范化域名（去除协议、路径等）"""
     domain = domain.strip()
-    # 移除 http:// 或 https://
-    domain = re.sub(r'^https?://', '', domain)
-    # 移除 www.
-    domain = re.sub(r'^www\.', '', domain)
+    # 移除 http:// 或 https:// 和 www.
+    domain = DOMAIN_PREFIX_PATTERN.sub('', domain, count=1)
     # 移除路径和查询参数
     domain = domain.split('/')[0]
     domain = domain.split('?')[0]
@@ -217,7 +1502,7 @@ def normalize_domain(domain: str) -> str:
     domain = domain.split(':')[0]
     return domain.strip().lower()
 
-def query_leak_api(domain: str) -> Dict[str, Any]:
+def query_leak_api(domain: str, fresh: bool = False) -> Dict[str, Any]:
     """
     调用 API 查询域名泄露情况
     
@@ -226,62 +1511,62 @@ def query_leak_api(domain: str) -> Dict[str, Any]:
     
     Args:
         domain: 要查询的域名
+        fresh: 为 True 时跳过缓存，直接请求 API
         
     Returns:
         API 返回的 JSON 数据，如果出错则返回包含 'error' 键的字典
     """
-    try:
-        # API: GET /search/domain/{domain}
-        url = f"{LEAK_API_BASE_URL}/search/domain/{domain}"
-        
-        # 可选参数：light=true 返回简化版本（不需要认证）
-        # light=false 返回完整版本（需要认证，包括密码统计）
-        params = {"light": False}  # 使用完整版本（需要 API Key）
-        
-        response = requests.get(
-            url,
-            params=params,
-            headers=LEAK_API_HEADERS,
-            timeout=30
-        )
-        
-        # 检查 HTTP 状态码
-        if response.status_code == 401:
-            return {"error": "API 认证失败，请检查 API Key 是否正确"}
-        elif response.status_code == 404:
-            return {"error": "域名未找到或没有相关数据"}
-        elif response.status_code == 422:
-            return {"error": "域名格式验证失败"}
-        
-        response.raise_for_status()
-        result = response.json()
-        print(f"[API] 查询域名 {domain} 成功")
-        return result
-        
-    except requests.exceptions.Timeout:
-        print(f"[API] 查询域名 {domain} 超时")
-        return {"error": "请求超时，请稍后重试"}
-    except requests.exceptions.HTTPError as e:
-        error_msg = f"API 返回错误: {e.response.status_code}"
+    # API: GET /search/domain/{domain}
+    path = f"/search/domain/{domain}"
+    
+    # 可选参数：light=true 返回简化版本（不需要认证）
+    # light=false 返回完整版本（需要认证，包括密码统计）
+    params = {"light": False}  # 使用完整版本（需要 API Key）
+    
+    def load() -> Dict[str, Any]:
         try:
-            error_detail = e.response.json()
-            if "detail" in error_detail:
-                error_msg += f" - {error_detail['detail']}"
-        except:
-            pass
-        print(f"[API] {error_msg}")
-        return {"error": error_msg}
-    except requests.exceptions.RequestException as e:
-        print(f"[API] 查询域名 {domain} 失败: {e}")
-        return {"error": f"API 请求失败: {str(e)}"}
-    except json.JSONDecodeError as e:
-        print(f"[API] 解析响应失败: {e}")
-        return {"error": "API 返回格式错误，无法解析 JSON"}
-    except Exception as e:
-        print(f"[API] 未知错误: {e}")
-        return {"error": f"查询时发生错误: {str(e)}"}
+            response = leak_client.get("domain_report", path, params=params)
+            
+            # 检查 HTTP 状态码
+            if response.status_code == 401:
+                return {"error": "API 认证失败，请检查 API Key 是否正确"}
+            elif response.status_code == 404:
+                return {"error": "域名未找到或没有相关数据"}
+            elif response.status_code == 422:
+                return {"error": "域名格式验证失败"}
+            
+            response.raise_for_status()
+            result = response.json()
+            print(f"[API] 查询域名 {domain} 成功")
+            return result
+            
+        except requests.exceptions.Timeout:
+            print(f"[API] 查询域名 {domain} 超时")
+            return {"error": "请求超时，请稍后重试"}
+        except requests.exceptions.HTTPError as e:
+            error_msg = f"API 返回错误: {e.response.status_code}"
+            try:
+                error_detail = e.response.json()
+                if "detail" in error_detail:
+                    error_msg += f" - {error_detail['detail']}"
+            except:
+                pass
+            print(f"[API] {error_msg}")
+            return {"error": error_msg}
+        except requests.exceptions.RequestException as e:
+            print(f"[API] 查询域名 {domain} 失败: {e}")
+            return {"error": f"API 请求失败: {str(e)}"}
+        except json.JSONDecodeError as e:
+            print(f"[API] 解析响应失败: {e}")
+            return {"error": "API 返回格式错误，无法解析 JSON"}
+        except Exception as e:
+            print(f"[API] 未知错误: {e}")
+            return {"error": f"查询时发生错误: {str(e)}"}
+    
+    return cached_request("domain_report", domain, params, load, fresh)
 
-def query_domain_leaks(domain: str, leak_type: str, page: int = 1, page_size: int = 10) -> Dict[str, Any]:
+def query_domain_leaks(domain: str, leak_type: str, page: int = 1, page_size: int = 10,
+                       fresh: bool = False) -> Dict[str, Any]:
     """
     查询域名的详细泄露列表
     
@@ -293,37 +1578,36 @@ def query_domain_leaks(domain: str, leak_type: str, page: int = 1, page_size: in
         leak_type: 泄露类型 (employees/customers/third_parties)
         page: 页码（从1开始）
         page_size: 每页数量（1-1000）
+        fresh: 为 True 时跳过缓存，直接请求 API
         
     Returns:
         API 返回的 JSON 数据
     """
-    try:
-        url = f"{LEAK_API_BASE_URL}/search/domain/{domain}/{leak_type}"
-        params = {
-            "page": page,
-            "page_size": min(page_size, 100)  # 限制最大100条，避免消息过长
-        }
-        
-        response = requests.get(
-            url,
-            params=params,
-            headers=LEAK_API_HEADERS,
-            timeout=30
-        )
-        
-        if response.status_code == 401:
-            return {"error": "API 认证失败，请检查 API Key"}
-        elif response.status_code == 404:
-            return {"error": "未找到相关数据"}
-        
-        response.raise_for_status()
-        return response.json()
-        
-    except Exception as e:
-        print(f"[API] 查询 {leak_type} 泄露失败: {e}")
-        return {"error": f"查询失败: {str(e)}"}
+    path = f"/search/domain/{domain}/{leak_type}"
+    params = {
+        "page": page,
+        "page_size": min(page_size, 100)  # 限制最大100条，避免消息过长
+    }
+    
+    def load() -> Dict[str, Any]:
+        try:
+            response = leak_client.get("domain_leaks", path, params=params)
+            
+            if response.status_code == 401:
+                return {"error": "API 认证失败，请检查 API Key"}
+            elif response.status_code == 404:
+                return {"error": "未找到相关数据"}
+            
+            response.raise_for_status()
+            return response.json()
+            
+        except Exception as e:
+            print(f"[API] 查询 {leak_type} 泄露失败: {e}")
+            return {"error": f"查询失败: {str(e)}"}
+    
+    return cached_request("domain_leaks", domain, {"leak_type": leak_type, **params}, load, fresh)
 
-def query_email_leaks(email: str, page: int = 1, page_size: int = 10) -> Dict[str, Any]:
+def query_email_leaks(email: str, page: int = 1, page_size: int = 10, fresh: bool = False) -> Dict[str, Any]:
     """
     通过邮箱或用户名查询泄露
     
@@ -333,62 +1617,61 @@ def query_email_leaks(email: str, page: int = 1, page_size: int = 10) -> Dict[st
         email: 邮箱地址或用户名
         page: 页码
         page_size: 每页数量
+        fresh: 为 True 时跳过缓存，直接请求 API
         
     Returns:
         API 返回的 JSON 数据
     """
-    try:
-        url = f"{LEAK_API_BASE_URL}/search/email"
-        params = {
-            "page": page,
-            "page_size": min(page_size, 100)
-        }
-        payload = {
-            "email": email
-        }
-        
-        response = requests.post(
-            url,
-            params=params,
-            json=payload,
-            headers=LEAK_API_HEADERS,
-            timeout=30
-        )
-        
-        if response.status_code == 401:
-            return {"error": "API 认证失败，请检查 API Key"}
-        elif response.status_code == 404:
-            return {"error": "未找到相关数据"}
-        
-        response.raise_for_status()
-        return response.json()
-        
-    except Exception as e:
-        print(f"[API] 查询邮箱泄露失败: {e}")
-        return {"error": f"查询失败: {str(e)}"}
+    path = "/search/email"
+    params = {
+        "page": page,
+        "page_size": min(page_size, 100)
+    }
+    payload = {
+        "email": email
+    }
+
+    def load() -> Dict[str, Any]:
+        try:
+            response = leak_client.post("email_search", path, params=params, json=payload)
+            
+            if response.status_code == 401:
+                return {"error": "API 认证失败，请检查 API Key"}
+            elif response.status_code == 404:
+                return {"error": "未找到相关数据"}
+            
+            response.raise_for_status()
+            return response.json()
+            
+        except Exception as e:
+            print(f"[API] 查询邮箱泄露失败: {e}")
+            return {"error": f"查询失败: {str(e)}"}
+    
+    return cached_request("email_search", email, params, load, fresh)
 
-def unlock_domain_leaks(domain: str, leak_type: str, max_items: int = 10000) -> Union[List[Any], Dict[str, Any]]:
+def unlock_domain_leaks(domain: str, leak_type: str, max_items: int = UNLOCK_MAX_ITEMS) -> Union[List[Any], Dict[str, Any]]:
     """
     解锁域名泄露数据
     
     API 端点: POST /search/domain/{domain}/{leak_type}/unlock
+    
+    解锁消耗积分：同一域名 / 类型的解锁请求在途时，重复的请求会等待并共享其结果，不会重复扣费
     """
+    return single_flight.do(
+        f"domain_unlock|{domain.lower()}|{leak_type}|{max_items}",
+        lambda: _unlock_domain_leaks(domain, leak_type, max_items)
+    )
+
+def _unlock_domain_leaks(domain: str, leak_type: str, max_items: int) -> Union[List[Any], Dict[str, Any]]:
+    """发送域名解锁请求（由 unlock_domain_leaks 合并调用）"""
     try:
-        url = f"{LEAK_API_BASE_URL}/search/domain/{domain}/{leak_type}/unlock"
-        print(f"[API] 正在尝试解锁: {url}")
+        path = f"/search/domain/{domain}/{leak_type}/unlock"
+        print(f"[API] 正在尝试解锁: {path}")
         
         # 增加 max 参数
         params = {"max": max_items}
         
-        response = requests.post(
-            url,
-            headers=LEAK_API_HEADERS,
-            params=params,
-            timeout=60,
-            proxies=PROXIES,
-            verify=False
-        )
-
+        response = leak_client.post("domain_unlock", path, params=params)
         
         if response.status_code == 401:
             return {"error": "API 认证失败"}
@@ -401,33 +1684,37 @@ def unlock_domain_leaks(domain: str, leak_type: str, max_items: int = 10000) ->
              return []
 
         response.raise_for_status()
+        # 解锁后列表中的密码等字段会变化，旧缓存失效
+        result_cache.invalidate(domain)
         return response.json()
         
     except Exception as e:
         print(f"[API] 解锁失败: {e}")
         return {"error": str(e)}
 
-def unlock_email_leaks(email: str, max_items: int = 10000) -> Union[List[Any], Dict[str, Any]]:
+def unlock_email_leaks(email: str, max_items: int = UNLOCK_MAX_ITEMS) -> Union[List[Any], Dict[str, Any]]:
     """
     解锁邮箱泄露数据
     
     API 端点: POST /search/email/unlock
+    
+    与 unlock_domain_leaks 相同，重复的在途解锁请求会被合并
     """
+    return single_flight.do(
+        f"email_unlock|{email.lower()}|{max_items}",
+        lambda: _unlock_email_leaks(email, max_items)
+    )
+
+def _unlock_email_leaks(email: str, max_items: int) -> Union[List[Any], Dict[str, Any]]:
+    """发送邮箱解锁请求（由 unlock_email_leaks 合并调用）"""
     try:
-        url = f"{LEAK_API_BASE_URL}/search/email/unlock"
+        path = "/search/email/unlock"
         payload = {
             "email": email,
             "max": max_items
         }
         
-        response = requests.post(
-            url,
-            json=payload,
-            headers=LEAK_API_HEADERS,
-            timeout=60,
-            proxies=PROXIES,
-            verify=False
-        )
+        response = leak_client.post("email_unlock", path, json=payload)
         
         if response.status_code == 401:
             return {"error": "API 认证失败"}
@@ -437,13 +1724,248 @@ def unlock_email_leaks(email: str, max_items: int = 10000) -> Union[List[Any], D
              return []
 
         response.raise_for_status()
+        result_cache.invalidate(email)
         return response.json()
         
     except Exception as e:
         print(f"[API] 解锁失败: {e}")
         return {"error": str(e)}
 
-def query_domain_subdomains(domain: str, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+# ============================================================================
+# 异步解锁任务
+# ============================================================================
+
+class UnlockTask:
+    """
+    一个在途的解锁任务
+
+    由 TaskPoller 在任务完成（或失败、超时）时调用 finish()，等待方通过 wait() 取得结果。
+    """
+
+    def __init__(self, key: str, label: str, on_complete: Optional[Callable[[], None]] = None):
+        self.key = key
+        self.label = label
+        self.task_id: Optional[str] = None
+        self.created_at = time.time()
+        self.poll_failures = 0
+        # 最近一次查询到的任务状态（进行中时包含已解锁数 updated / total）
+        self.status: Dict[str, Any] = {}
+        self._on_complete = on_complete
+        self._result: Dict[str, Any] = {}
+        self._done = threading.Event()
+
+    def finish(self, status: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        if self._done.is_set():
+            return
+        self._result = {"error": error} if error else (status or {"completed": True})
+        if not error and self._on_complete:
+            self._on_complete()
+        self._done.set()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = UNLOCK_TASK_TIMEOUT, report: bool = False) -> Dict[str, Any]:
+        """
+        等待任务结束，返回任务状态（TaskStatusOut）或包含 'error' 键的字典
+
+        report 为 True 时在等待期间把解锁进度写入当前任务的进度消息
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._done.is_set():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return {"error": "等待解锁任务超时"}
+            if report:
+                total = self.status.get("total")
+                report_progress(f"🔓 正在解锁 {self.status.get('updated') or 0}/{total if total is not None else '?'} 条")
+            self._done.wait(UNLOCK_TASK_POLL_INTERVAL if remaining is None else min(remaining, UNLOCK_TASK_POLL_INTERVAL))
+        return self._result
+
+class TaskPoller:
+    """
+    共享的解锁任务轮询器
+
+    解锁任务在服务端异步执行。所有在途任务由同一个后台线程每隔 interval 秒查询一次
+    GET /tasks/{task_id}，完成后唤醒等待方，不会为每个任务占用一个线程或一个长时间的请求。
+    同一目标的解锁任务在途时，重复提交直接共享已有任务。
+    """
+
+    def __init__(self, interval: float = UNLOCK_TASK_POLL_INTERVAL, timeout: float = UNLOCK_TASK_TIMEOUT,
+                 max_poll_failures: int = 5):
+        self.interval = interval
+        self.timeout = timeout
+        self.max_poll_failures = max_poll_failures
+        self._lock = threading.Lock()
+        self._tasks: Dict[str, UnlockTask] = {}
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, key: str, label: str, start: Callable[[], Dict[str, Any]],
+               fallback: Optional[Callable[[], Union[List[Any], Dict[str, Any]]]] = None,
+               on_complete: Optional[Callable[[], None]] = None) -> UnlockTask:
+        """
+        创建解锁任务
+
+        Args:
+            key: 任务去重键
+            label: 日志中显示的名称
+            start: 创建服务端任务，返回包含 task_id 的字典或包含 'error' 键的字典
+            fallback: 创建任务失败时改用的同步解锁（在后台线程执行）
+            on_complete: 任务成功完成后的回调（如使缓存失效）
+        """
+        with self._lock:
+            task = self._tasks.get(key)
+            if task and not task.done():
+                print(f"[解锁任务] 共享进行中的任务: {label}")
+                return task
+            task = self._tasks[key] = UnlockTask(key, label, on_complete)
+
+        result = start()
+        if "error" not in result:
+            task.task_id = str(result["task_id"])
+            print(f"[解锁任务] 已创建 {label}: {task.task_id}")
+            self._ensure_thread()
+            self._wake.set()
+        elif fallback:
+            print(f"[解锁任务] 创建 {label} 失败（{result['error']}），改用同步解锁")
+            threading.Thread(target=contextvars.copy_context().run, args=(self._run_fallback, task, fallback),
+                             name="unlock-fallback", daemon=True).start()
+        else:
+            task.finish(error=result["error"])
+            self._forget(task)
+        return task
+
+    def _run_fallback(self, task: UnlockTask, fallback: Callable[[], Union[List[Any], Dict[str, Any]]]) -> None:
+        result = fallback()
+        if isinstance(result, dict) and "error" in result:
+            task.finish(error=result["error"])
+        else:
+            count = len(result) if isinstance(result, list) else None
+            task.finish({"completed": True, "running": False, "total": count, "updated": count})
+        self._forget(task)
+
+    def _forget(self, task: UnlockTask) -> None:
+        with self._lock:
+            if self._tasks.get(task.key) is task:
+                del self._tasks[task.key]
+
+    def _ensure_thread(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="task-poller", daemon=True)
+                self._thread.start()
+
+    def active(self) -> int:
+        with self._lock:
+            return sum(1 for task in self._tasks.values() if task.task_id and not task.done())
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                tasks = [task for task in self._tasks.values() if task.task_id and not task.done()]
+            if not tasks:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            time.sleep(self.interval)
+            for task in tasks:
+                self._poll(task)
+
+    def _poll(self, task: UnlockTask) -> None:
+        status = get_task_status(task.task_id)
+        if "error" in status:
+            task.poll_failures += 1
+            if task.poll_failures >= self.max_poll_failures:
+                print(f"[解锁任务] {task.label} 状态查询连续失败: {status['error']}")
+                task.finish(error=status["error"])
+                self._forget(task)
+            return
+        task.poll_failures = 0
+        task.status = status
+        # 任务不存在或已过期时服务端同样返回 completed=true，视为已完成
+        if status.get("completed"):
+            print(f"[解锁任务] {task.label} 已完成 (解锁 {status.get('updated')} / {status.get('total')})")
+            task.finish(status)
+            self._forget(task)
+        elif time.time() - task.created_at > self.timeout:
+            print(f"[解锁任务] {task.label} 超时")
+            task.finish(error="解锁任务超时")
+            self._forget(task)
+
+task_poller = TaskPoller()
+metrics.gauge("leakradar_unlock_tasks_active", "正在轮询的异步解锁任务数", task_poller.active)
+
+def get_task_status(task_id: str) -> Dict[str, Any]:
+    """
+    查询后台任务状态
+
+    API 端点: GET /tasks/{task_id}
+    返回 TaskStatusOut: running, completed, total, updated
+    """
+    try:
+        response = leak_client.get("tasks", f"/tasks/{task_id}")
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        return {"error": f"查询任务状态失败: {str(e)}"}
+
+def _queue_unlock_task(endpoint: str, path: str, **kwargs) -> Dict[str, Any]:
+    """创建异步解锁任务，返回 {"task_id": ...} 或包含 'error' 键的字典"""
+    try:
+        response = leak_client.post(endpoint, path, **kwargs)
+        if response.status_code == 401:
+            return {"error": "API 认证失败"}
+        elif response.status_code == 403:
+            return {"error": "权限不足或积分不够"}
+        response.raise_for_status()
+        result = response.json()
+        task_id = result.get("task_id") or result.get("id")
+        if not task_id:
+            return {"error": f"响应中没有 task_id: {result}"}
+        return {"task_id": task_id}
+    except Exception as e:
+        return {"error": str(e)}
+
+def start_domain_unlock(domain: str, leak_type: str, max_items: int = UNLOCK_MAX_ITEMS) -> UnlockTask:
+    """
+    异步解锁域名泄露数据
+
+    API 端点: POST /search/domain/{domain}/{leak_type}/unlock/task
+    立即返回 UnlockTask，调用 wait() 等待解锁完成；创建任务失败时回退到同步解锁
+    """
+    return task_poller.submit(
+        f"domain_unlock|{domain.lower()}|{leak_type}|{max_items}",
+        f"{domain} {leak_type}",
+        lambda: _queue_unlock_task("domain_unlock_task", f"/search/domain/{domain}/{leak_type}/unlock/task",
+                                   params={"max": max_items}),
+        fallback=lambda: unlock_domain_leaks(domain, leak_type, max_items),
+        on_complete=lambda: result_cache.invalidate(domain)
+    )
+
+def start_email_unlock(email: str, max_items: int = UNLOCK_MAX_ITEMS) -> UnlockTask:
+    """
+    异步解锁邮箱泄露数据
+
+    API 端点: POST /search/email/unlock/task
+    """
+    return task_poller.submit(
+        f"email_unlock|{email.lower()}|{max_items}",
+        email,
+        lambda: _queue_unlock_task("email_unlock_task", "/search/email/unlock/task",
+                                   params={"max": max_items}, json={"email": email}),
+        fallback=lambda: unlock_email_leaks(email, max_items),
+        on_complete=lambda: result_cache.invalidate(email)
+    )
+
+def log_unlock_result(status: Dict[str, Any], type_name: str) -> None:
+    """打印解锁任务结果"""
+    if "error" in status:
+        print(f"[解锁] {type_name} 解锁失败: {status['error']}")
+    else:
+        print(f"[解锁] {type_name} 解锁完成，新解锁 {status.get('updated') or 0} 条")
+
+def query_domain_subdomains(domain: str, page: int = 1, page_size: int = 20, fresh: bool = False) -> Dict[str, Any]:
     """
     查询域名的子域名列表
     
@@ -453,37 +1975,36 @@ def query_domain_subdomains(domain: str, page: int = 1, page_size: int = 20) ->
         domain: 域名
         page: 页码
         page_size: 每页数量
+        fresh: 为 True 时跳过缓存，直接请求 API
         
     Returns:
         API 返回的 JSON 数据
     """
-    try:
-        url = f"{LEAK_API_BASE_URL}/search/domain/{domain}/subdomains"
-        params = {
-            "page": page,
-            "page_size": min(page_size, 100)
-        }
-        
-        response = requests.get(
-            url,
-            params=params,
-            headers=LEAK_API_HEADERS,
-            timeout=30
-        )
-        
-        if response.status_code == 401:
-            return {"error": "API 认证失败，请检查 API Key"}
-        elif response.status_code == 404:
-            return {"error": "未找到相关数据"}
-        
-        response.raise_for_status()
-        return response.json()
-        
-    except Exception as e:
-        print(f"[API] 查询子域名失败: {e}")
-        return {"error": f"查询失败: {str(e)}"}
+    path = f"/search/domain/{domain}/subdomains"
+    params = {
+        "page": page,
+        "page_size": min(page_size, 100)
+    }
+
+    def load() -> Dict[str, Any]:
+        try:
+            response = leak_client.get("subdomains", path, params=params)
+            
+            if response.status_code == 401:
+                return {"error": "API 认证失败，请检查 API Key"}
+            elif response.status_code == 404:
+                return {"error": "未找到相关数据"}
+            
+            response.raise_for_status()
+            return response.json()
+            
+        except Exception as e:
+            print(f"[API] 查询子域名失败: {e}")
+            return {"error": f"查询失败: {str(e)}"}
+    
+    return cached_request("subdomains", domain, params, load, fresh)
 
-def query_domain_urls(domain: str, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+def query_domain_urls(domain: str, page: int = 1, page_size: int = 20, fresh: bool = False) -> Dict[str, Any]:
     """
     查询域名相关的 URL 列表
     
@@ -493,116 +2014,271 @@ def query_domain_urls(domain: str, page: int = 1, page_size: int = 20) -> Dict[s
         domain: 域名
         page: 页码
         page_size: 每页数量
+        fresh: 为 True 时跳过缓存，直接请求 API
         
     Returns:
         API 返回的 JSON 数据
     """
-    try:
-        url = f"{LEAK_API_BASE_URL}/search/domain/{domain}/urls"
-        params = {
-            "page": page,
-            "page_size": min(page_size, 100)
-        }
-        
-        response = requests.get(
-            url,
-            params=params,
-            headers=LEAK_API_HEADERS,
-            timeout=30
-        )
-        
-        if response.status_code == 401:
-            return {"error": "API 认证失败，请检查 API Key"}
-        elif response.status_code == 404:
-            return {"error": "未找到相关数据"}
-        
-        response.raise_for_status()
-        return response.json()
-        
-    except Exception as e:
-        print(f"[API] 查询 URL 失败: {e}")
-        return {"error": f"查询失败: {str(e)}"}
+    path = f"/search/domain/{domain}/urls"
+    params = {
+        "page": page,
+        "page_size": min(page_size, 100)
+    }
 
-def fetch_all_domain_leaks(domain: str, leak_type: str, max_items: int = 10000) -> List[Dict[str, Any]]:
-    """
-    获取所有域名泄露数据（自动翻页）
-    """
-    all_items = []
-    page = 1
-    page_size = 100
-    
-    print(f"[Fetch] 开始获取 {domain} 的 {leak_type} 数据...")
-    
-    while True:
-        if len(all_items) >= max_items:
-            break
-            
-        result = query_domain_leaks(domain, leak_type, page, page_size)
-        if "error" in result:
-            print(f"[Fetch] 获取第 {page} 页失败: {result['error']}")
-            break
+    def load() -> Dict[str, Any]:
+        try:
+            response = leak_client.get("urls", path, params=params)
             
-        items = result.get("items", [])
-        if not items:
-            break
+            if response.status_code == 401:
+                return {"error": "API 认证失败，请检查 API Key"}
+            elif response.status_code == 404:
+                return {"error": "未找到相关数据"}
             
-        all_items.extend(items)
-        print(f"[Fetch] 已获取 {len(all_items)} 条数据 (Page {page})")
-        
-        if len(items) < page_size:
-            break
+            response.raise_for_status()
+            return response.json()
             
-        page += 1
-        time.sleep(0.5)  # 避免过快请求
-        
-    return all_items
+        except Exception as e:
+            print(f"[API] 查询 URL 失败: {e}")
+            return {"error": f"查询失败: {str(e)}"}
+    
+    return cached_request("urls", domain, params, load, fresh)
 
-def fetch_all_email_leaks(email: str, max_items: int = 10000) -> List[Dict[str, Any]]:
+def fetch_page_with_retry(fetch_page: Callable[[int], Dict[str, Any]], page: int) -> Dict[str, Any]:
     """
-    获取所有邮箱泄露数据（自动翻页）
-    """
-    all_items = []
-    page = 1
-    page_size = 100
-    
+    获取单页数据，失败时按指数退避重试
+
+    Args:
+        fetch_page: 接收页码并返回 API 结果的函数
+        page: 页码
+
+    Returns:
+        API 返回的 JSON 数据，重试全部失败时返回最后一次的错误
+    """
+    result: Dict[str, Any] = {}
+    for attempt in range(FETCH_PAGE_RETRIES + 1):
+        result = fetch_page(page)
+        if "error" not in result:
+            return result
+        if attempt < FETCH_PAGE_RETRIES:
+            delay = 0.5 * (2 ** attempt)
+            print(f"[Fetch] 第 {page} 页失败: {result['error']}，{delay:.1f} 秒后重试")
+            time.sleep(delay)
+    return result
+
+class FetchError(Exception):
+    """分页获取失败：第 1 页重试后仍出错，无法判断有没有数据"""
+
+class PageStream:
+    """
+    iter_pages 的返回值：可逐页迭代，迭代结束后 failed_pages 为重试后仍失败（被跳过）的页码，
+    summary 为第 1 页结果中除记录以外的字段（total、total_unlocked 等）
+    """
+
+    def __init__(self):
+        self.failed_pages: List[int] = []
+        self.summary: Dict[str, Any] = {}
+        self._pages: Iterator[List[Dict[str, Any]]] = iter(())
+
+    def __iter__(self) -> Iterator[List[Dict[str, Any]]]:
+        return self._pages
+
+def describe_failed_pages(failed_pages: List[int]) -> str:
+    """数据不完整时附在文件说明 / 进度消息中的提示"""
+    shown = ", ".join(str(page) for page in failed_pages[:10])
+    more = f" 等 {len(failed_pages)} 页" if len(failed_pages) > 10 else ""
+    return f"⚠️ 第 {shown}{more} 页获取失败，数据不完整"
+
+def iter_pages(fetch_page: Callable[[int], Dict[str, Any]], max_items: int = EXPORT_MAX_ITEMS,
+               parallel: bool = True) -> PageStream:
+    """
+    逐页产出分页数据，调用方拿到一页就可以立即处理，无需等待全部数据
+
+    并行模式：先取第 1 页读取 total，再把后续页提交到抓取线程池，
+    同时在途的页数不超过 FETCH_WINDOW，按页码顺序产出，内存占用与窗口大小成正比。
+    串行模式：逐页获取，直到某页不足 FETCH_PAGE_SIZE 条为止。
+    单页失败会重试，重试仍失败的页会被跳过，不会截断后续数据；跳过的页记在返回值的 failed_pages 中，
+    并写入当前任务的进度消息。第 1 页失败时迭代抛出 FetchError（不能当作没有数据）。
+
+    Args:
+        fetch_page: 接收页码并返回 API 结果的函数
+        max_items: 最多获取的条数
+        parallel: 是否并行获取
+
+    Returns:
+        PageStream，迭代产出每页的数据条目列表
+    """
+    stream = PageStream()
+    stream._pages = _iter_pages(fetch_page, max_items, parallel, stream)
+    return stream
+
+def _iter_pages(fetch_page: Callable[[int], Dict[str, Any]], max_items: int, parallel: bool,
+                stream: PageStream) -> Iterator[List[Dict[str, Any]]]:
+    failed_pages = stream.failed_pages
+    first = fetch_page_with_retry(fetch_page, 1)
+    if "error" in first:
+        print(f"[Fetch] 获取第 1 页失败: {first['error']}")
+        raise FetchError(first["error"])
+    stream.summary = {key: value for key, value in first.items() if key != "items"}
+
+    items = first.get("items", [])[:max_items]
+    fetched = len(items)
+    total = first.get("total")
+    expected = f"/{min(total, max_items)}" if isinstance(total, int) else ""
+    print(f"[Fetch] 已获取 {fetched} 条数据 (Page 1)")
+    report_progress(f"⬇️ 已获取 {fetched}{expected} 条")
+    yield items
+
+    if parallel and isinstance(total, int):
+        last_page = math.ceil(min(total, max_items) / FETCH_PAGE_SIZE)
+        pending = deque()
+        next_page = 2
+        try:
+            while next_page <= last_page or pending:
+                while next_page <= last_page and len(pending) < FETCH_WINDOW:
+                    pending.append((next_page, submit_fetch(fetch_page_with_retry, fetch_page, next_page)))
+                    next_page += 1
+                page, future = pending.popleft()
+                result = future.result()
+                if "error" in result:
+                    failed_pages.append(page)
+                    continue
+                items = result.get("items", [])[:max_items - fetched]
+                fetched += len(items)
+                print(f"[Fetch] 已获取 {fetched} 条数据 (Page {page}/{last_page})")
+                report_progress(f"⬇️ 已获取 {fetched}{expected} 条")
+                yield items
+        finally:
+            # 调用方提前结束时，取消尚未开始的页
+            for _, future in pending:
+                future.cancel()
+    else:
+        page = 1
+        while items and len(items) >= FETCH_PAGE_SIZE and fetched < max_items:
+            page += 1
+            result = fetch_page_with_retry(fetch_page, page)
+            if "error" in result:
+                failed_pages.append(page)
+                break
+            items = result.get("items", [])[:max_items - fetched]
+            fetched += len(items)
+            print(f"[Fetch] 已获取 {fetched} 条数据 (Page {page})")
+            report_progress(f"⬇️ 已获取 {fetched}{expected} 条")
+            yield items
+
+    if failed_pages:
+        print(f"[Fetch] ⚠ 以下页重试后仍失败，数据不完整: {failed_pages}")
+        report_progress(describe_failed_pages(failed_pages))
+
+def iter_domain_leak_pages(domain: str, leak_type: str, max_items: int = EXPORT_MAX_ITEMS,
+                           parallel: bool = True) -> PageStream:
+    """逐页获取域名泄露数据"""
+    print(f"[Fetch] 开始获取 {domain} 的 {leak_type} 数据...")
+    return iter_pages(
+        lambda page: query_domain_leaks(domain, leak_type, page, FETCH_PAGE_SIZE, fresh=True),
+        max_items, parallel
+    )
+
+def iter_email_leak_pages(email: str, max_items: int = EXPORT_MAX_ITEMS,
+                          parallel: bool = True) -> PageStream:
+    """逐页获取邮箱泄露数据"""
     print(f"[Fetch] 开始获取 {email} 的数据...")
-    
-    while True:
-        if len(all_items) >= max_items:
-            break
-            
-        result = query_email_leaks(email, page, page_size)
-        if "error" in result:
-            print(f"[Fetch] 获取第 {page} 页失败: {result['error']}")
-            break
-            
-        items = result.get("items", [])
-        if not items:
-            break
-            
-        all_items.extend(items)
-        print(f"[Fetch] 已获取 {len(all_items)} 条数据 (Page {page})")
-        
-        if len(items) < page_size:
-            break
-            
-        page += 1
-        time.sleep(0.5)
-        
-    return all_items
+    return iter_pages(
+        lambda page: query_email_leaks(email, page, FETCH_PAGE_SIZE, fresh=True),
+        max_items, parallel
+    )
 
-def create_csv_file(data: List[Dict[str, Any]], filename_prefix: str) -> Optional[str]:
+def fetch_all_domain_leaks(domain: str, leak_type: str, max_items: int = EXPORT_MAX_ITEMS,
+                           parallel: bool = True) -> List[Dict[str, Any]]:
     """
-    创建 CSV 文件
+    获取所有域名泄露数据（自动翻页）
     """
-    if not data:
-        return None
-        
+    return [item for page in iter_domain_leak_pages(domain, leak_type, max_items, parallel) for item in page]
+
+def fetch_all_email_leaks(email: str, max_items: int = EXPORT_MAX_ITEMS, parallel: bool = True) -> List[Dict[str, Any]]:
+    """
+    获取所有邮箱泄露数据（自动翻页）
+    """
+    return [item for page in iter_email_leak_pages(email, max_items, parallel) for item in page]
+
+def normalize_leak_row(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    把一条泄露记录整理成 CSV 行（只保留 CSV_HEADERS 中的字段）
+    """
+    row = {key: item.get(key) for key in CSV_HEADERS}
+    # 格式化 added_at 字段，只保留到秒
+    added_at = row.get("added_at")
+    if isinstance(added_at, str):
+        # 去除微秒和时区，只保留到秒
+        # ISO 8601格式: 2025-12-23T06:35:54.841000Z -> 2025-12-23T06:35:54
+        if '.' in added_at and 'Z' in added_at:
+            row['added_at'] = added_at.split('.')[0]
+        elif 'Z' in added_at:
+            row['added_at'] = added_at[:-1]  # 去除Z
+    return row
+
+def peek_pages(pages: Iterable[List[Dict[str, Any]]]) -> Optional[Iterator[List[Dict[str, Any]]]]:
+    """取出第一页判断是否有数据：没有数据返回 None，否则返回包含第一页在内的完整迭代器"""
+    pages = iter(pages)
+    for page in pages:
+        if page:
+            return itertools.chain([page], pages)
+    return None
+
+class CsvExport:
+    """
+    把逐页数据编码成 CSV 字节流（UTF-8 BOM，Excel 可直接打开）
+
+    open() 只能调用一次（数据边获取边产出）；上传重试和分卷发送由 send_export_file 从临时文件重放。
+    count 为已产出的记录数。
+    产出的第一块是表头，之后每块对应一页数据，都在行边界上结束（分卷时按块切分）。
+    已知总记录数 total 时（如从本地库导出），把上传进度写入当前任务的进度消息。
+    """
+
+    def __init__(self, pages: Iterable[List[Dict[str, Any]]], total: Optional[int] = None):
+        self._pages: Optional[Iterable[List[Dict[str, Any]]]] = pages
+        self.total = total
+        self.count = 0
+
+    def open(self) -> Iterator[bytes]:
+        if self._pages is None:
+            raise RuntimeError("CSV 数据源不能重复读取")
+        pages, self._pages = self._pages, None
+        
+        self.count = 0
+        write_seconds = 0.0
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=CSV_HEADERS, extrasaction='ignore')
+        writer.writeheader()
+        yield b"\xef\xbb\xbf" + buffer.getvalue().encode("utf-8")
+        for page in pages:
+            start = time.perf_counter()
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(normalize_leak_row(item) for item in page)
+            data = buffer.getvalue().encode("utf-8")
+            write_seconds += time.perf_counter() - start
+            self.count += len(page)
+            if self.total:
+                report_progress(f"⬆️ 正在上传 {min(100, self.count * 100 // self.total)}%（{self.count}/{self.total} 条）")
+            yield data
+        
+        metrics.observe("export_csv_write_seconds", write_seconds)
+        metrics.inc("export_rows_total", value=self.count)
+
+def write_csv_stream(pages: Iterable[List[Dict[str, Any]]], filename_prefix: str) -> Tuple[Optional[str], int]:
+    """
+    把逐页产出的数据直接写入 CSV 文件，每到一页就写一页，内存中不保留全部数据
+
+    Args:
+        pages: 逐页产出数据条目的可迭代对象（如 iter_domain_leak_pages 的返回值）
+        filename_prefix: 文件名前缀
+
+    Returns:
+        (文件路径, 写入的记录数)；没有数据或失败时文件路径为 None
+    """
+    file_path = None
+    count = 0
     try:
-        # 确定字段
-        # 根据实际数据调整字段
-        headers = ["url", "username", "password", "is_email", "password_strength", "added_at"]
-        
         # 创建临时目录
         temp_dir = "temp_exports"
         if not os.path.exists(temp_dir):
@@ -611,32 +2287,325 @@ def create_csv_file(data: List[Dict[str, Any]], filename_prefix: str) -> Optiona
         filename = f"{filename_prefix}_{int(time.time())}.csv"
         file_path = os.path.join(temp_dir, filename)
         
-        # 处理时间格式，只保留到秒
-        processed_data = []
-        for item in data:
-            processed_item = item.copy()
-            # 格式化 added_at 字段，只保留到秒
-            if 'added_at' in processed_item:
-                added_at = processed_item['added_at']
-                if isinstance(added_at, str):
-                    # 去除微秒和时区，只保留到秒
-                    # ISO 8601格式: 2025-12-23T06:35:54.841000Z -> 2025-12-23T06:35:54
-                    if '.' in added_at and 'Z' in added_at:
-                        processed_item['added_at'] = added_at.split('.')[0]
-                    elif 'Z' in added_at:
-                        processed_item['added_at'] = added_at[:-1]  # 去除Z
-            processed_data.append(processed_item)
-        
-        with open(file_path, 'w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.DictWriter(f, fieldnames=headers, extrasaction='ignore')
-            writer.writeheader()
-            writer.writerows(processed_data)
-            
-        print(f"[CSV] 文件已创建: {file_path}")
-        return file_path
+        export = CsvExport(pages)
+        with open(file_path, 'wb') as f:
+            for chunk in export.open():
+                f.write(chunk)
+        count = export.count
+        
+        if count == 0:
+            os.remove(file_path)
+            return None, 0
+        
+        print(f"[CSV] 文件已创建: {file_path} ({count} 条)")
+        return file_path, count
     except Exception as e:
         print(f"[CSV] 创建失败: {e}")
+        if file_path and os.path.exists(file_path):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        return None, count
+
+def send_csv_export(chat_id: int, make_pages: Callable[[], Iterable[List[Dict[str, Any]]]],
+                    filename_prefix: str, describe: Callable[[int], str],
+                    total: Optional[int] = None) -> Optional[int]:
+    """
+    边获取数据边生成 CSV，直接上传到 Telegram（不写临时文件）
+
+    Args:
+        chat_id: 聊天 ID
+        make_pages: 返回逐页数据迭代器的函数（只调用一次，上传重试时从临时文件重放）
+        filename_prefix: 文件名前缀
+        describe: 根据记录数生成文件说明
+        total: 总记录数（已知时在进度消息中显示上传百分比）
+
+    Returns:
+        发送的记录数；没有数据返回 0；发送失败返回 None
+
+    Raises:
+        FetchError: 第 1 页获取失败
+    """
+    source = make_pages()
+    pages = peek_pages(source)
+    if pages is None:
+        return 0
+    
+    def caption() -> str:
+        # 有页获取失败时在文件说明中提示数据不完整
+        failed_pages = getattr(source, "failed_pages", None)
+        return describe(export.count) + (f"\n\n{describe_failed_pages(failed_pages)}" if failed_pages else "")
+    
+    export = CsvExport(pages, total)
+    filename = f"{filename_prefix}_{int(time.time())}.csv"
+    if not send_export_file(chat_id, filename, export.open, caption):
+        return None
+    print(f"[CSV] 已发送 {filename} ({export.count} 条)")
+    return export.count
+
+# ============================================================================
+# 导出打包（压缩 / 分卷）
+# ============================================================================
+
+class UploadTooLarge(Exception):
+    """打包后的文件超过 Telegram 上传上限"""
+
+class _ZipSink(io.RawIOBase):
+    """不可 seek 的内存输出，让 zipfile 以流式（data descriptor）方式写入"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+class Packager:
+    """
+    流式压缩器：compress() 输入原始数据块、返回已产生的压缩数据，finish() 返回剩余部分
+
+    method: gzip / zip / none；zip 包内只有一个文件 inner_name
+    """
+
+    def __init__(self, method: str, inner_name: str):
+        self.method = method
+        if method == "gzip":
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif method == "zip":
+            self._sink = _ZipSink()
+            self._zip = zipfile.ZipFile(self._sink, "w", zipfile.ZIP_DEFLATED)
+            self._entry = self._zip.open(inner_name, "w", force_zip64=True)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.method == "gzip":
+            return self._compressor.compress(data)
+        if self.method == "zip":
+            self._entry.write(data)
+            return self._sink.drain()
+        return data
+
+    def finish(self) -> bytes:
+        if self.method == "gzip":
+            return self._compressor.flush()
+        if self.method == "zip":
+            self._entry.close()
+            self._zip.close()
+            return self._sink.drain()
+        return b""
+
+def packaged_filename(filename: str, method: str = EXPORT_COMPRESSION) -> Tuple[str, str, str]:
+    """返回 (打包后的文件名, MIME 类型, 实际使用的压缩方式)；已经是压缩文件的不再压缩"""
+    if filename.lower().endswith((".gz", ".zip")):
+        method = "none"
+    if method == "gzip":
+        return f"{filename}.gz", "application/gzip", method
+    if method == "zip":
+        return f"{os.path.splitext(filename)[0]}.zip", "application/zip", method
+    content_type = "text/csv" if filename.lower().endswith(".csv") else "application/octet-stream"
+    return filename, content_type, "none"
+
+def iter_packaged(chunks: Iterable[bytes], packager: Packager, limit: int = TELEGRAM_UPLOAD_LIMIT) -> Iterator[bytes]:
+    """压缩数据块；累计输出超过 limit 时抛出 UploadTooLarge"""
+    size = 0
+    for chunk in chunks:
+        data = packager.compress(chunk)
+        if data:
+            size += len(data)
+            if size > limit:
+                raise UploadTooLarge(f"打包后超过 {limit // (1024 * 1024)} MB")
+            yield data
+    data = packager.finish()
+    if size + len(data) > limit:
+        raise UploadTooLarge(f"打包后超过 {limit // (1024 * 1024)} MB")
+    yield data
+
+def iter_row_blocks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    把任意切分的文本数据重新切成在行边界结束的块，第一块为首行（表头）
+
+    用于下载的导出文件，使其可以和 CsvExport 的输出一样按行分卷
+    """
+    pending = b""
+    header_sent = False
+    for chunk in chunks:
+        pending += chunk
+        if not header_sent:
+            newline = pending.find(b"\n")
+            if newline < 0:
+                continue
+            yield pending[:newline + 1]
+            pending = pending[newline + 1:]
+            header_sent = True
+        cut = pending.rfind(b"\n")
+        if cut >= 0:
+            yield pending[:cut + 1]
+            pending = pending[cut + 1:]
+    if pending or not header_sent:
+        yield pending
+
+class ReplayableSource:
+    """
+    只生成一次的数据源
+
+    第一次读取时边产出边保留一份副本（同时记录每块的大小）；之后再打开时按原来的分块重放，
+    上一次读取中途中断时，重放完已保留的部分再接着生成剩余部分。
+    副本不超过 EXPORT_REPLAY_MEMORY 时只在内存中，超过后才写入临时文件，常见大小的导出不落盘。
+    上传重试、改为分卷发送时都不会重新向 LeakRadar 获取数据，重发的内容与第一次完全一致。
+    """
+
+    def __init__(self, open_source: Callable[[], Iterable[bytes]]):
+        self._open_source = open_source
+        self._source: Optional[Iterator[bytes]] = None
+        self._spool = None
+        self._sizes: List[int] = []
+        self._exhausted = False
+
+    def open(self) -> Iterator[bytes]:
+        if self._spool is None:
+            self._spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_REPLAY_MEMORY)
+            self._source = iter(self._open_source())
+        self._spool.seek(0)
+        for size in list(self._sizes):
+            yield self._spool.read(size)
+        if self._exhausted:
+            return
+        self._spool.seek(0, io.SEEK_END)
+        for chunk in self._source:
+            self._spool.write(chunk)
+            self._sizes.append(len(chunk))
+            yield chunk
+        self._exhausted = True
+
+    def close(self) -> None:
+        if self._spool is not None:
+            self._spool.close()
+
+def send_export_file(chat_id: int, filename: str, open_source: Callable[[], Iterable[bytes]],
+                     caption: Union[str, Callable[[], str]] = "") -> bool:
+    """
+    压缩后发送导出文件；超过 Telegram 上传上限时改为分卷发送
+
+    数据源只读取一次（见 ReplayableSource），重试和分卷都重放第一次读取时保留的副本
+
+    Args:
+        chat_id: 聊天 ID
+        filename: 原始文件名（如 xxx.csv）
+        open_source: 返回文件内容的函数；第一块为表头，其余各块在行边界结束
+        caption: 说明文字或返回说明文字的函数
+
+    Returns:
+        是否全部发送成功
+    """
+    packaged_name, content_type, method = packaged_filename(filename)
+    source = ReplayableSource(open_source)
+    
+    def open_packaged() -> Iterator[bytes]:
+        return iter_packaged(source.open(), Packager(method, filename))
+    
+    try:
+        return send_document_stream(chat_id, packaged_name, open_packaged, caption, content_type,
+                                    replayable=True)
+    except UploadTooLarge as e:
+        print(f"[打包] {packaged_name} {e}，改为分卷发送")
+        return send_export_parts(chat_id, filename, source.open, caption)
+    finally:
+        source.close()
+
+def send_export_parts(chat_id: int, filename: str, open_source: Callable[[], Iterable[bytes]],
+                      caption: Union[str, Callable[[], str]] = "",
+                      part_limit: Optional[int] = None) -> bool:
+    """
+    分卷发送：按行切分，每卷都是带表头的完整文件，单独压缩后写入临时文件再上传（各自重试），
+    最后发送一个清单（各卷文件名、大小、SHA-256），便于核对是否收齐
+    """
+    if part_limit is None:
+        # 留出余量：压缩器内部缓冲的数据在 finish() 时才输出
+        part_limit = TELEGRAM_UPLOAD_LIMIT - min(1024 * 1024, TELEGRAM_UPLOAD_LIMIT // 10)
+    base, ext = os.path.splitext(filename)
+    method = packaged_filename(filename)[2]
+    blocks = iter(open_source())
+    header = next(blocks, b"")
+    manifest = []
+    exhausted = False
+    
+    while not exhausted:
+        part_name = f"{base}.part{len(manifest) + 1:03d}{ext}"
+        packaged_name, content_type, _ = packaged_filename(part_name, method)
+        packager = Packager(method, part_name)
+        digest = hashlib.sha256()
+        raw_size = 0
+        size = 0
+        
+        with tempfile.TemporaryFile() as spool:
+            def write(data: bytes) -> None:
+                nonlocal size
+                if data:
+                    spool.write(data)
+                    digest.update(data)
+                    size += len(data)
+            
+            # deflate 会缓冲一部分尚未输出的数据，其压缩后大小不超过原始大小，
+            # 也不超过一个压缩块（约 100 KB），按两者中较小的值计入
+            write(packager.compress(header))
+            buffered = len(header)
+            exhausted = True
+            for block in blocks:
+                before = size
+                write(packager.compress(block))
+                raw_size += len(block)
+                buffered = 0 if size > before else buffered + len(block)
+                if size + min(buffered, 256 * 1024) >= part_limit:
+                    exhausted = False
+                    break
+            write(packager.finish())
+            
+            if raw_size == 0:
+                break
+            
+            def read_spool() -> Iterator[bytes]:
+                spool.seek(0)
+                return iter(lambda: spool.read(UPLOAD_BUFFER_SIZE), b"")
+            
+            part_caption = f"📦 {filename} 分卷 {len(manifest) + 1}"
+            report_progress(f"⬆️ 正在上传分卷 {len(manifest) + 1}（{size // 1024} KB）")
+            if not send_document_stream(chat_id, packaged_name, read_spool, part_caption,
+                                        content_type, replayable=True):
+                print(f"[打包] 分卷 {packaged_name} 发送失败")
+                return False
+        
+        manifest.append({"file": packaged_name, "bytes": size, "raw_bytes": raw_size,
+                         "sha256": digest.hexdigest()})
+        print(f"[打包] 已发送分卷 {packaged_name} ({size} 字节)")
+    
+    text = caption() if callable(caption) else caption
+    manifest_data = json.dumps({"file": filename, "parts": manifest}, ensure_ascii=False, indent=2).encode("utf-8")
+    return send_document_stream(
+        chat_id, f"{base}.manifest.json", lambda: [manifest_data],
+        f"{text}\n分卷: {len(manifest)} 个（见清单）".strip(), "application/json", replayable=True
+    )
+
+def create_csv_file(data: List[Dict[str, Any]], filename_prefix: str) -> Optional[str]:
+    """
+    创建 CSV 文件
+    """
+    if not data:
         return None
+    file_path, _ = write_csv_stream([data], filename_prefix)
+    return file_path
 
 def format_api_result(api_result: Dict[str, Any], domain: str) -> str:
     """
@@ -782,8 +2751,10 @@ def format_leaks_list(api_result: Dict[str, Any], leak_type: str, domain: str =
         message_parts.append(f"• 每页: {page_size} 条")
         
         if items:
-            message_parts.append(f"\n📝 泄露记录（显示前 {len(items)} 条）:")
-            for i, item in enumerate(items[:10], 1):  # 最多显示10条
+            # 翻页时序号接着上一页
+            start = (page - 1) * page_size
+            message_parts.append(f"\n📝 泄露记录（第 {start + 1}-{start + len(items[:10])} 条）:")
+            for i, item in enumerate(items[:10], start + 1):  # 最多显示10条
                 url = item.get("url", "N/A")
                 username = item.get("username", "N/A")
                 unlocked = item.get("unlocked", False)
@@ -871,8 +2842,9 @@ def format_subdomains_result(api_result: Dict[str, Any], domain: str) -> str:
         message_parts.append(f"• 子域名总数: {total} 个")
         
         if items:
-            message_parts.append(f"\n📝 子域名列表（显示前 {min(len(items), 20)} 个）:")
-            for i, item in enumerate(items[:20], 1):
+            start = (api_result.get("page", 1) - 1) * api_result.get("page_size", 20)
+            message_parts.append(f"\n📝 子域名列表（第 {start + 1}-{start + len(items[:20])} 个）:")
+            for i, item in enumerate(items[:20], start + 1):
                 subdomain = item.get("subdomain", "N/A")
                 occurrences = item.get("occurrences", 0)
                 message_parts.append(f"{i}. {subdomain} (出现 {occurrences} 次)")
@@ -904,15 +2876,10 @@ def create_domain_export(domain: str, leak_type: str) -> Dict[str, Any]:
         API 返回的 JSON 数据，包含 export_id
     """
     try:
-        url = f"{LEAK_API_BASE_URL}/search/domain/{domain}/{leak_type}/export"
+        path = f"/search/domain/{domain}/{leak_type}/export"
         params = {"format": "csv"}
         
-        response = requests.post(
-            url,
-            params=params,
-            headers=LEAK_API_HEADERS,
-            timeout=30
-        )
+        response = leak_client.post("domain_export", path, params=params)
         
         if response.status_code == 401:
             return {"error": "API 认证失败，请检查 API Key"}
@@ -941,17 +2908,11 @@ def create_email_export(email: str) -> Dict[str, Any]:
         API 返回的 JSON 数据，包含 export_id
     """
     try:
-        url = f"{LEAK_API_BASE_URL}/search/email/export"
+        path = "/search/email/export"
         params = {"format": "csv"}
         payload = {"email": email}
         
-        response = requests.post(
-            url,
-            params=params,
-            json=payload,
-            headers=LEAK_API_HEADERS,
-            timeout=30
-        )
+        response = leak_client.post("email_export", path, params=params, json=payload)
         
         if response.status_code == 401:
             return {"error": "API 认证失败，请检查 API Key"}
@@ -979,18 +2940,13 @@ def get_exports_list(page: int = 1, page_size: int = 20) -> Dict[str, Any]:
         API 返回的导出任务列表
     """
     try:
-        url = f"{LEAK_API_BASE_URL}/exports"
+        path = "/exports"
         params = {
             "page": page,
             "page_size": page_size
         }
         
-        response = requests.get(
-            url,
-            params=params,
-            headers=LEAK_API_HEADERS,
-            timeout=30
-        )
+        response = leak_client.get("exports", path, params=params)
         
         if response.status_code == 401:
             return {"error": "API 认证失败，请检查 API Key"}
@@ -1002,11 +2958,40 @@ def get_exports_list(page: int = 1, page_size: int = 20) -> Dict[str, Any]:
         print(f"[API] 获取导出列表失败: {e}")
         return {"error": f"获取导出列表失败: {str(e)}"}
 
+def scan_exports(export_ids: Iterable[int], page_size: int = 100) -> Dict[Any, Dict[str, Any]]:
+    """
+    翻页查找一组导出任务，返回 {export_id: 任务信息}
+    
+    /exports 按创建时间倒序返回。找齐全部任务、翻到最后一页，
+    或者已经翻过了待查任务中最早的一个时停止，因此通常只需要请求第一页。
+    出错时返回包含 'error' 键的字典
+    """
+    wanted = set(export_ids)
+    found: Dict[Any, Dict[str, Any]] = {}
+    page = 1
+    while True:
+        result = get_exports_list(page=page, page_size=page_size)
+        if "error" in result:
+            return result
+        items = result.get("items", [])
+        for item in items:
+            if item.get("id") in wanted:
+                found[item["id"]] = item
+        if wanted <= found.keys() or not items or page * page_size >= result.get("total", 0):
+            return found
+        # ID 递增时，本页最小的 ID 已经小于所有未找到的 ID，后面的页不会再有
+        try:
+            if min(item["id"] for item in items) < min(wanted - found.keys()):
+                return found
+        except (KeyError, TypeError):
+            pass
+        page += 1
+
 def get_export_status(export_id: int) -> Dict[str, Any]:
     """
     获取导出任务状态
     
-    通过 /exports 端点获取特定导出任务的状态
+    通过 /exports 端点获取特定导出任务的状态（会按需翻页，不限于前 100 个任务）
     
     Args:
         export_id: 导出任务 ID
@@ -1015,16 +3000,13 @@ def get_export_status(export_id: int) -> Dict[str, Any]:
         导出任务状态信息
     """
     try:
-        # 获取导出列表，查找指定的 export_id
-        exports_result = get_exports_list(page=1, page_size=100)
+        found = scan_exports([export_id])
         
-        if "error" in exports_result:
-            return exports_result
+        if "error" in found:
+            return found
         
-        items = exports_result.get("items", [])
-        for item in items:
-            if item.get("id") == export_id:
-                return item
+        if export_id in found:
+            return found[export_id]
         
         return {"error": f"未找到导出任务 ID: {export_id}"}
         
@@ -1032,28 +3014,61 @@ def get_export_status(export_id: int) -> Dict[str, Any]:
         print(f"[API] 获取导出状态失败: {e}")
         return {"error": f"获取导出状态失败: {str(e)}"}
 
-def download_export_file(export_id: int, download_path: str = None) -> Optional[str]:
+def open_export_download(export_id: Any, status: Dict[str, Any]) -> Optional[requests.Response]:
+    """
+    打开导出文件的下载流（调用方负责关闭响应）
+    
+    依次尝试：
+    1. 导出状态中的 download_url
+    2. /exports/{export_id}/download 端点
+    3. /exports/{export_id}/file 端点
+    
+    Returns:
+        状态码正常的流式响应，全部失败时返回 None
     """
-    下载导出文件
+    download_url = status.get("download_url") or status.get("url")
+    candidates = [download_url] if download_url else []
+    candidates += [f"/exports/{export_id}/download", f"/exports/{export_id}/file"]
     
-    尝试多种方式下载文件：
-    1. 从导出状态中获取 download_url
-    2. 尝试通过 /exports/{export_id}/download 端点下载
-    3. 尝试通过 /exports/{export_id}/file 端点下载
+    for i, url in enumerate(candidates, 1):
+        response = None
+        try:
+            response = leak_client.get("download", url, stream=True)
+            response.raise_for_status()
+            return response
+        except Exception as e:
+            print(f"[下载] 方式 {i} ({url}) 失败: {e}")
+            if response is not None:
+                response.close()
+    
+    print(f"[下载] 所有下载方法都失败，无法下载文件")
+    return None
+
+def iter_export_download(export_id: Any, status: Dict[str, Any]) -> Iterator[bytes]:
+    """逐块产出导出文件内容，下载失败时抛出异常"""
+    response = open_export_download(export_id, status)
+    if response is None:
+        raise IOError(f"无法下载导出文件 {export_id}")
+    with response:
+        yield from response.iter_content(chunk_size=UPLOAD_BUFFER_SIZE)
+
+def download_export_file(export_id: int, download_path: str = None,
+                         status: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """
+    下载导出文件到本地
     
     Args:
         export_id: 导出任务 ID
         download_path: 下载保存路径（可选）
+        status: 已知的导出任务状态（可选，省去一次查询）
         
     Returns:
         下载的文件路径，如果失败返回 None
     """
     try:
         # 先检查导出状态
-        status = get_export_status(export_id)
-        
-        # 打印完整状态用于调试
-        print(f"[下载调试] 导出状态详情: {json.dumps(status, ensure_ascii=False)}")
+        if status is None:
+            status = get_export_status(export_id)
         
         if "error" in status:
             print(f"[下载] {status['error']}")
@@ -1074,93 +3089,177 @@ def download_export_file(export_id: int, download_path: str = None) -> Optional[
                 os.makedirs(temp_dir)
             download_path = os.path.join(temp_dir, filename)
         
-        # 方法1: 尝试从状态中获取 download_url
-        download_url = status.get("download_url") or status.get("url")
-        
-        if download_url:
-            try:
-                response = requests.get(download_url, headers=LEAK_API_HEADERS, timeout=60, stream=True)
-                response.raise_for_status()
-                
-                with open(download_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                
-                print(f"[下载] 文件已下载: {download_path}")
-                return download_path
-            except Exception as e:
-                print(f"[下载] 方法1失败: {e}")
-        
-        # 方法2: 尝试通过 /exports/{export_id}/download 端点
-        try:
-            download_url = f"{LEAK_API_BASE_URL}/exports/{export_id}/download"
-            response = requests.get(download_url, headers=LEAK_API_HEADERS, timeout=60, stream=True)
-            response.raise_for_status()
-            
-            with open(download_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
-            print(f"[下载] 文件已下载: {download_path}")
-            return download_path
-        except Exception as e:
-            print(f"[下载] 方法2失败: {e}")
-        
-        # 方法3: 尝试通过 /exports/{export_id}/file 端点
-        try:
-            download_url = f"{LEAK_API_BASE_URL}/exports/{export_id}/file"
-            response = requests.get(download_url, headers=LEAK_API_HEADERS, timeout=60, stream=True)
-            response.raise_for_status()
-            
-            with open(download_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
-            print(f"[下载] 文件已下载: {download_path}")
-            return download_path
-        except Exception as e:
-            print(f"[下载] 方法3失败: {e}")
+        response = open_export_download(export_id, status)
+        if response is None:
+            return None
+        with response, open(download_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=UPLOAD_BUFFER_SIZE):
+                f.write(chunk)
         
-        # 如果所有方法都失败，返回 None
-        print(f"[下载] 所有下载方法都失败，无法下载文件")
-        return None
+        print(f"[下载] 文件已下载: {download_path}")
+        return download_path
         
     except Exception as e:
         print(f"[下载] 下载文件失败: {e}")
-        import traceback
         traceback.print_exc()
         return None
 
+class ExportJob:
+    """一个被跟踪的服务端导出任务，完成后通知所有等待方"""
+
+    def __init__(self, export_id: Any):
+        self.export_id = export_id
+        self.created_at = time.time()
+        self.status: Dict[str, Any] = {}
+        self.callbacks: List[Callable[[Dict[str, Any]], None]] = []
+        self._result: Dict[str, Any] = {}
+        self._done = threading.Event()
+
+    def finish(self, result: Dict[str, Any]) -> None:
+        self._result = result
+        self._done.set()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """等待任务结束，返回任务信息（ExportBase）或包含 'error' 键的字典"""
+        if not self._done.wait(timeout):
+            return {"error": "等待超时，导出任务可能仍在处理中"}
+        return self._result
+
+class ExportJobTracker:
+    """
+    服务端导出任务跟踪器
+
+    所有待完成的导出任务共用一个后台线程：每轮只翻页拉取一次 /exports（通常一页即可），
+    按 ID 建立索引后统一更新状态，流量与在途任务数无关。
+    状态没有变化时轮询间隔逐步加倍（直到 max_interval），有变化或新任务时恢复为 min_interval。
+    任务完成后在 delivery_executor 中执行回调（如下载并发送文件），不阻塞轮询线程。
+    """
+
+    FAILED_STATUSES = ("FAILED", "ERROR")
+
+    def __init__(self, min_interval: float = EXPORT_POLL_MIN_INTERVAL,
+                 max_interval: float = EXPORT_POLL_MAX_INTERVAL, timeout: float = EXPORT_JOB_TIMEOUT):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.interval = min_interval
+        self._lock = threading.Lock()
+        self._jobs: Dict[Any, ExportJob] = {}
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.delivery_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="export-delivery")
+
+    def track(self, export_id: Any, callback: Optional[Callable[[Dict[str, Any]], None]] = None) -> ExportJob:
+        """开始跟踪导出任务；callback 在任务结束时以任务信息（或错误）调用"""
+        with self._lock:
+            job = self._jobs.get(export_id)
+            if job is None:
+                job = self._jobs[export_id] = ExportJob(export_id)
+            if callback:
+                job.callbacks.append(callback)
+            self.interval = self.min_interval
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="export-tracker", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return job
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                has_jobs = bool(self._jobs)
+                interval = self.interval
+            if not has_jobs:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            # 新任务加入时提前唤醒
+            if self._wake.wait(interval):
+                self._wake.clear()
+            try:
+                self._tick()
+            except Exception as e:
+                print(f"[导出跟踪] 轮询出错: {e}")
+                traceback.print_exc()
+
+    def _tick(self) -> None:
+        with self._lock:
+            jobs = dict(self._jobs)
+        if not jobs:
+            return
+
+        found = scan_exports(jobs.keys())
+        changed = False
+        if "error" in found:
+            print(f"[导出跟踪] 获取导出列表失败: {found['error']}")
+            found = {}
+
+        now = time.time()
+        for export_id, job in jobs.items():
+            item = found.get(export_id)
+            if item is not None and item.get("status") != job.status.get("status"):
+                changed = True
+                job.status = item
+            status = (job.status.get("status") or "").upper()
+            if status == "COMPLETED":
+                print(f"[导出跟踪] 导出任务 {export_id} 已完成")
+                self._complete(job, job.status)
+            elif status in self.FAILED_STATUSES:
+                self._complete(job, {"error": f"导出任务失败，状态: {status}"})
+            elif now - job.created_at > self.timeout:
+                self._complete(job, {"error": "等待超时，导出任务可能仍在处理中"})
+
+        with self._lock:
+            if changed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+
+    def _complete(self, job: ExportJob, result: Dict[str, Any]) -> None:
+        with self._lock:
+            self._jobs.pop(job.export_id, None)
+        job.finish(result)
+        for callback in job.callbacks:
+            # 下载并发送导出文件属于批量任务
+            self.delivery_executor.submit(run_in_lane, "bulk", callback, result)
+
+export_tracker = ExportJobTracker()
+metrics.gauge("leakradar_export_jobs_pending", "等待完成的服务端导出任务数", export_tracker.pending)
+
 def wait_for_export_completion(export_id: int, max_wait_time: int = 300, check_interval: int = 5) -> Dict[str, Any]:
     """
     等待导出任务完成
     
+    状态由 export_tracker 统一轮询，这里只是等待结果
+    
     Args:
         export_id: 导出任务 ID
         max_wait_time: 最大等待时间（秒）
-        check_interval: 检查间隔（秒）
+        check_interval: 已不再使用，轮询间隔由 export_tracker 自适应调整
         
     Returns:
         导出任务状态
     """
-    start_time = time.time()
-    
-    while time.time() - start_time < max_wait_time:
-        status = get_export_status(export_id)
-        
-        if "error" in status:
-            return status
-        
-        export_status = status.get("status", "").upper()
-        
-        if export_status == "COMPLETED":
-            return status
-        elif export_status in ["FAILED", "ERROR"]:
-            return {"error": f"导出任务失败，状态: {export_status}"}
-        
-        time.sleep(check_interval)
+    return export_tracker.track(export_id).wait(max_wait_time)
+
+def deliver_server_export(chat_id: int, export_id: Any, description: str, result: Dict[str, Any]) -> None:
+    """服务端导出完成后下载文件并发送给用户（由 export_tracker 回调）"""
+    if "error" in result:
+        send_message(chat_id, f"❌ 导出失败\n\n{description}\n错误: {result['error']}")
+        return
     
-    return {"error": f"等待超时，导出任务可能仍在处理中"}
+    # 下载的响应体压缩后直接写入上传请求，不经过本地文件
+    filename = result.get("filename") or f"export_{export_id}.csv"
+    caption = f"📥 服务端导出文件\n\n{description}\n导出 ID: {export_id}"
+    if not send_export_file(chat_id, filename, lambda: iter_row_blocks(iter_export_download(export_id, result)), caption):
+        send_message(chat_id, f"❌ 导出已完成但文件发送失败\n\n{description}\n导出 ID: {export_id}")
 
 def format_urls_result(api_result: Dict[str, Any], domain: str) -> str:
     """格式化 URL 查询结果"""
@@ -1177,8 +3276,9 @@ def format_urls_result(api_result: Dict[str, Any], domain: str) -> str:
         message_parts.append(f"• URL 总数: {total} 个")
         
         if items:
-            message_parts.append(f"\n📝 URL 列表（显示前 {min(len(items), 20)} 个）:")
-            for i, item in enumerate(items[:20], 1):
+            start = (api_result.get("page", 1) - 1) * api_result.get("page_size", 20)
+            message_parts.append(f"\n📝 URL 列表（第 {start + 1}-{start + len(items[:20])} 个）:")
+            for i, item in enumerate(items[:20], start + 1):
                 url = item.get("url", "N/A")
                 occurrences = item.get("occurrences", 0)
                 url_display = url[:60] + "..." if len(url) > 60 else url
@@ -1197,421 +3297,2578 @@ def format_urls_result(api_result: Dict[str, Any], domain: str) -> str:
         print(f"[格式化] 格式化 URL 结果失败: {e}")
         return f"📋 域名: {domain}\n\n原始响应:\n{json.dumps(api_result, indent=2, ensure_ascii=False)}"
 
-def handle_message(message: Dict[str, Any]) -> None:
-    """处理接收到的消息"""
-    chat_id = message["chat"]["id"]
-    text = message.get("text", "")
-    user = message.get("from", {})
-    user_name = user.get("first_name", "用户")
-    user_id = user.get("id", 0)
-    
-    # 权限检查
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        print(f"[拒绝] 未授权用户尝试访问: {user_name} ({user_id})")
-        # 只在用户发送命令或消息时回复，避免在群组中过于频繁
-        if text.startswith("/"):
-            send_message(chat_id, "❌ 抱歉，您没有使用此机器人的权限。\n请联系管理员授权。")
-        return
+# ============================================================================
+# 本地泄露库（增量同步）
+# ============================================================================
+
+class LeakStore:
+    """
+    本地泄露记录库（SQLite WAL 模式）
+
+    - 以 (域名, 类型, 记录 ID) 为主键保存泄露记录，导出时从本地库生成 CSV
+    - updated_at 为记录首次写入或解锁状态变化的时间，用于"上次导出后新增"的增量导出
+    - export_marks 记录每个会话对每个域名 / 类型最近一次导出对应的同步时间
+    - 上游删除的记录不会从本地库中删除
+    """
 
-    print(f"[消息] 用户 {user_name} ({user_id}): {text}")
-    
-    # 移除 @bot_username 部分，以便在群组中处理命令
-    if "@" in text:
-        # 获取机器人用户名（这里简单处理，假设是命令后的第一个 @）
-        # 更好的方式是在启动时获取 getMe 信息
-        text = re.sub(r'@\w+', '', text).strip()
-        print(f"[处理] 去除 @ 后命令: {text}")
-
-    # 处理 /start 命令
-    if text == "/start":
-        welcome_message = (
-            f"你好 {user_name}！我是lysir_bot账密泄露查询机器人🔍\n\n"
-            "📋 使用说明：\n"
-            "• 直接发送域名即可查询账密泄露情况\n"
-            "• 例如：example.com 或 www.example.com\n\n"
-            "💡 提示：\n"
-            "• 我会自动处理域名格式，支持带 http:// 或 www. 的域名\n"
-            "• 查询结果包括员工、第三方和客户的泄露统计\n"
-            "• 完整版本会显示密码强度统计信息\n\n"
-            "📖 输入 /help 查看详细帮助"
+    COLUMNS = ["id", "url", "username", "password", "is_email", "password_strength", "unlocked", "added_at"]
+
+    def __init__(self, db_path: str = LEAK_STORE_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS leaks ("
+            "scope TEXT NOT NULL, leak_type TEXT NOT NULL, id TEXT NOT NULL, "
+            "url TEXT, username TEXT, password TEXT, is_email INTEGER, password_strength INTEGER, "
+            "unlocked INTEGER NOT NULL DEFAULT 0, added_at TEXT, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (scope, leak_type, id))"
         )
-        send_message(chat_id, welcome_message)
-        print(f"[回复] 发送欢迎消息给用户 {user_name}")
-    
-    # 处理 /help 命令
-    elif text == "/help":
-        help_message = (
-            "📖 lysir_bot 账密泄露查询机器人帮助\n\n"
-            "🔍 查询方式：\n\n"
-            "1️⃣ 域名泄露报告（默认）\n"
-            "直接发送域名即可查询，例如：\n"
-            "• example.com\n"
-            "• www.example.com\n\n"
-            "2️⃣ 查询详细泄露列表\n"
-            "• /employees <domain> - 查询员工泄露列表\n"
-            "• /customers <domain> - 查询客户泄露列表\n"
-            "• /thirdparties <domain> - 查询第三方泄露列表\n\n"
-            "3️⃣ 邮箱/用户名查询\n"
-            "• /email <邮箱或用户名> - 查询邮箱泄露\n"
-            "例如：/email user@example.com\n\n"
-            "4️⃣ 子域名查询\n"
-            "• /subdomains <domain> - 查询子域名列表\n\n"
-            "5️⃣ URL 查询\n"
-            "• /urls <domain> - 查询相关 URL 列表\n\n"
-            "6️⃣ CSV 导出功能\n"
-            "• /export <domain> - 导出全部泄露 CSV\n"
-            "• /export email <email> - 导出邮箱泄露 CSV\n\n"
-            "⚙️ 命令列表：\n"
-            "/start - 开始使用\n"
-            "/help - 显示帮助信息\n\n"
-            "💡 提示：\n"
-            "• 导出任务完成后会自动发送 CSV 文件\n"
-            "• 查询结果可能包含敏感信息，请谨慎使用"
+        self._db.execute("CREATE INDEX IF NOT EXISTS leaks_updated ON leaks (scope, leak_type, updated_at)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state ("
+            "scope TEXT NOT NULL, leak_type TEXT NOT NULL, total INTEGER, total_unlocked INTEGER, synced_at REAL, "
+            "PRIMARY KEY (scope, leak_type))"
         )
-        send_message(chat_id, help_message)
-        print(f"[回复] 发送帮助信息给用户 {user_name}")
-    
-    # 处理 /employees 命令
-    elif text.startswith("/employees "):
-        domain = text.replace("/employees ", "").strip()
-        normalized_domain = normalize_domain(domain)
-        
-        if not is_valid_domain(normalized_domain):
-            send_message(chat_id, f"❌ 域名格式无效: {domain}")
-            return
-        
-        send_message(chat_id, f"🔍 正在查询员工泄露: {normalized_domain}\n请稍候...")
-        result = query_domain_leaks(normalized_domain, "employees")
-        formatted = format_leaks_list(result, "employees", normalized_domain)
-        send_message(chat_id, formatted)
-        print(f"[查询] 用户 {user_name} 查询员工泄露: {normalized_domain}")
-    
-    # 处理 /customers 命令
-    elif text.startswith("/customers "):
-        domain = text.replace("/customers ", "").strip()
-        normalized_domain = normalize_domain(domain)
-        
-        if not is_valid_domain(normalized_domain):
-            send_message(chat_id, f"❌ 域名格式无效: {domain}")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS export_marks ("
+            "chat_id INTEGER NOT NULL, scope TEXT NOT NULL, leak_type TEXT NOT NULL, exported_at REAL NOT NULL, "
+            "PRIMARY KEY (chat_id, scope, leak_type))"
+        )
+        self._db.commit()
+        print(f"✓ 已启用本地泄露库: {db_path}")
+
+    def upsert(self, scope: str, leak_type: str, items: List[Dict[str, Any]], now: float) -> Tuple[int, int]:
+        """
+        写入一页记录，只有新记录和解锁状态变化的记录会被写入
+
+        Returns:
+            (新增数, 更新数)
+        """
+        ids = [item["id"] for item in items]
+        new = updated = 0
+        with self._lock:
+            known = dict(self._db.execute(
+                f"SELECT id, unlocked FROM leaks WHERE scope = ? AND leak_type = ? AND id IN ({','.join('?' * len(ids))})",
+                (scope, leak_type, *ids)
+            ).fetchall()) if ids else {}
+            with self._db:
+                for item in items:
+                    unlocked = 1 if item.get("unlocked") else 0
+                    previous = known.get(item["id"])
+                    if previous is None:
+                        new += 1
+                    elif previous != unlocked:
+                        updated += 1
+                    else:
+                        continue
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO leaks (scope, leak_type, id, url, username, password, is_email, "
+                        "password_strength, unlocked, added_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (scope, leak_type, item["id"], item.get("url"), item.get("username"), item.get("password"),
+                         item.get("is_email"), item.get("password_strength"), unlocked, item.get("added_at"), now)
+                    )
+        return new, updated
+
+    def counts(self, scope: str, leak_type: str) -> Tuple[int, int]:
+        """返回本地库中的 (记录数, 已解锁数)"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(unlocked), 0) FROM leaks WHERE scope = ? AND leak_type = ?",
+                (scope, leak_type)
+            ).fetchone()
+        return row[0], row[1]
+
+    def sync_state(self, scope: str, leak_type: str) -> Optional[Dict[str, Any]]:
+        """最近一次完整同步的状态；从未完整同步过（包括首次同步中途失败）时返回 None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT total, total_unlocked, synced_at FROM sync_state WHERE scope = ? AND leak_type = ?",
+                (scope, leak_type)
+            ).fetchone()
+        return {"total": row[0], "total_unlocked": row[1], "synced_at": row[2]} if row else None
+
+    def set_sync_state(self, scope: str, leak_type: str, total: int, total_unlocked: int, synced_at: float) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sync_state (scope, leak_type, total, total_unlocked, synced_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (scope, leak_type, total, total_unlocked, synced_at)
+                )
+
+    def iter_rows(self, scope: str, leak_type: str, since: Optional[float] = None,
+                  batch_size: int = 1000) -> Iterator[List[Dict[str, Any]]]:
+        """按写入顺序逐批产出记录；since 不为空时只产出该时间之后新增或解锁的记录"""
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    f"SELECT rowid, {', '.join(self.COLUMNS)} FROM leaks "
+                    "WHERE scope = ? AND leak_type = ? AND updated_at > ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (scope, leak_type, since if since is not None else -1, last_rowid, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [self._row_item(row[1:]) for row in rows]
+
+    def _row_item(self, row: tuple) -> Dict[str, Any]:
+        """数据库行转回 API 记录的形式：布尔字段按 True / False 输出，与直接从 API 导出的 CSV 一致"""
+        item = dict(zip(self.COLUMNS, row))
+        for key in ("is_email", "unlocked"):
+            if item[key] is not None:
+                item[key] = bool(item[key])
+        return item
+
+    def last_export(self, chat_id: int, scope: str, leak_type: str) -> Optional[float]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT exported_at FROM export_marks WHERE chat_id = ? AND scope = ? AND leak_type = ?",
+                (chat_id, scope, leak_type)
+            ).fetchone()
+        return row[0] if row else None
+
+    def mark_exported(self, chat_id: int, scope: str, leak_type: str, synced_at: float) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO export_marks (chat_id, scope, leak_type, exported_at) VALUES (?, ?, ?, ?)",
+                    (chat_id, scope, leak_type, synced_at)
+                )
+
+_leak_store: Optional[LeakStore] = None
+_leak_store_lock = threading.Lock()
+
+def get_leak_store() -> Optional[LeakStore]:
+    """本地泄露库（第一次导出时才打开）；未配置 LEAK_STORE_PATH 或打开失败时返回 None"""
+    global _leak_store
+    if not LEAK_STORE_PATH:
+        return None
+    with _leak_store_lock:
+        if _leak_store is None:
+            try:
+                _leak_store = LeakStore()
+            except sqlite3.Error as e:
+                print(f"⚠ 打开本地泄露库失败，导出时直接获取数据: {e}")
+                return None
+        return _leak_store
+
+def sync_domain_leaks(domain: str, leak_type: str, max_items: int = EXPORT_MAX_ITEMS) -> Dict[str, Any]:
+    """
+    把域名某类型的泄露记录增量同步到本地库
+
+    从未完整同步过时并行获取全部分页；否则逐页获取，遇到整页都是已知且未变化的记录时提前结束
+    （API 按添加时间从新到旧分页，新记录只会出现在前面的页）。解锁不改变记录位置，
+    所以 total_unlocked 与上次同步不同时不提前结束，而是检查全部分页。
+    本地库只增不删，因此不用本地记录数判断是否同步完整。
+    API 未返回记录 ID（套餐不含 domain_search）时无法同步，返回错误。
+
+    Returns:
+        {"synced_at", "pages", "new", "updated", "total"}，出错时返回包含 'error' 键的字典
+    """
+    leak_store = get_leak_store()
+    if leak_store is None:
+        return {"error": "未启用本地泄露库"}
+    now = time.time()
+    stats = {"synced_at": now, "pages": 0, "new": 0, "updated": 0, "total": 0}
+    
+    def store_page(items: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if any(not item.get("id") for item in items):
+            return {"error": "API 未返回记录 ID，无法同步到本地库"}
+        new, updated = leak_store.upsert(domain, leak_type, items, now)
+        stats["pages"] += 1
+        stats["new"] += new
+        stats["updated"] += updated
+        return None
+    
+    last_sync = leak_store.sync_state(domain, leak_type)
+    if last_sync is None:
+        # 首次同步：并行获取全部分页
+        pages = iter_domain_leak_pages(domain, leak_type, max_items)
+        try:
+            for items in pages:
+                error = store_page(items)
+                if error:
+                    return error
+        except FetchError as e:
+            return {"error": str(e)}
+        if pages.failed_pages:
+            # 不记录同步状态，导出改为直接获取（文件说明中会提示不完整）
+            return {"error": describe_failed_pages(pages.failed_pages)}
+        # 记录 API 返回的数量，下次增量同步据此判断是否有新解锁的记录
+        stats["total"] = min(pages.summary.get("total", 0), max_items)
+        total_unlocked = min(pages.summary.get("total_unlocked", 0), max_items)
+        leak_store.set_sync_state(domain, leak_type, stats["total"], total_unlocked, now)
+        print(f"[同步] {domain} {leak_type} 首次同步 {stats['new']} 条")
+        return stats
+    
+    page = 1
+    while True:
+        result = fetch_page_with_retry(
+            lambda page: query_domain_leaks(domain, leak_type, page, FETCH_PAGE_SIZE, fresh=True), page
+        )
+        if "error" in result:
+            return result
+        items = result.get("items", [])
+        total = min(result.get("total", 0), max_items)
+        total_unlocked = min(result.get("total_unlocked", 0), max_items)
+        stats["total"] = total
+        changed_before = stats["new"] + stats["updated"]
+        error = store_page(items)
+        if error:
+            return error
+        report_progress(f"🔄 正在同步第 {page} 页（新增 {stats['new']}，更新 {stats['updated']}）")
+        
+        if len(items) < FETCH_PAGE_SIZE or page * FETCH_PAGE_SIZE >= max_items:
+            break
+        if stats["new"] + stats["updated"] == changed_before and total_unlocked == last_sync["total_unlocked"]:
+            break
+        page += 1
+    
+    leak_store.set_sync_state(domain, leak_type, total, total_unlocked, now)
+    print(f"[同步] {domain} {leak_type} 增量同步: {stats['pages']} 页，新增 {stats['new']}，更新 {stats['updated']}")
+    return stats
+
+def count_locked_leaks(domain: str, leak_type: str) -> Optional[int]:
+    """查询域名某类型中仍未解锁的记录数（只取 1 条记录），失败返回 None"""
+    result = query_domain_leaks(domain, leak_type, page=1, page_size=1, fresh=True)
+    if "error" in result:
+        return None
+    return max(0, result.get("total", 0) - result.get("total_unlocked", 0))
+
+def start_domain_unlock_if_needed(domain: str, leak_type: str) -> Optional[UnlockTask]:
+    """有未解锁的记录时才提交解锁任务（没有时返回 None，省去解锁和轮询请求）"""
+    locked = count_locked_leaks(domain, leak_type)
+    if locked == 0:
+        print(f"[解锁] {domain} {leak_type} 没有未解锁的记录，跳过解锁")
+        return None
+    return start_domain_unlock(domain, leak_type, max_items=UNLOCK_MAX_ITEMS)
+
+def export_domain_type(chat_id: int, domain: str, leak_type: str, type_name: str,
+                       unlock: Optional[UnlockTask], delta: bool = False) -> Optional[int]:
+    """
+    导出域名某一类型的泄露 CSV
+
+    启用本地库时先增量同步再从本地库生成 CSV；delta=True 时只导出该会话上次导出后新增或新解锁的记录。
+    本地库不可用时直接边获取边上传。
+
+    Returns:
+        发送的记录数；没有数据返回 0；发送失败返回 None
+
+    Raises:
+        FetchError: 直接导出时第 1 页获取失败
+    """
+    if unlock is not None:
+        log_unlock_result(unlock.wait(report=True), type_name)
+    
+    def describe(count: int, note: str = "") -> str:
+        return f"📥 CSV 导出文件\n\n域名: {domain}\n类型: {type_name}\n记录数: {count}{note}"
+    
+    prefix = f"{domain}_{leak_type}"
+    leak_store = get_leak_store()
+    sync = sync_domain_leaks(domain, leak_type) if leak_store is not None else {"error": "未启用本地库"}
+    if "error" in sync:
+        if leak_store is not None:
+            print(f"[同步] {domain} {leak_type} 同步失败，改为直接导出: {sync['error']}")
+        return send_csv_export(chat_id, lambda: iter_domain_leak_pages(domain, leak_type), prefix, describe)
+    
+    note = ""
+    since = None
+    if delta:
+        since = leak_store.last_export(chat_id, domain, leak_type)
+        note = "（上次导出后新增）" if since is not None else "（首次导出，包含全部记录）"
+        prefix += "_new"
+    total = leak_store.counts(domain, leak_type)[0] if since is None else None
+    count = send_csv_export(chat_id, lambda: leak_store.iter_rows(domain, leak_type, since), prefix,
+                            lambda count: describe(count, note), total)
+    if count is not None:
+        leak_store.mark_exported(chat_id, domain, leak_type, sync["synced_at"])
+    return count
+
+# ============================================================================
+# 批量查询
+# ============================================================================
+
+# 列表文件中条目之间的分隔符：空白、逗号、分号
+BATCH_SPLIT_PATTERN = re.compile(r'[\s,;]+')
+
+# 批量域名汇总 CSV 的字段
+BATCH_DOMAIN_HEADERS = [
+    "domain", "status",
+    "employees_compromised", "customers_compromised", "third_parties_compromised", "total_compromised",
+    "employees_locked", "customers_locked", "third_parties_locked",
+    "error",
+]
+
+# 批量邮箱汇总 CSV 的字段
+BATCH_EMAIL_HEADERS = ["email", "status", "total", "locked", "unlocked", "sample_urls", "error"]
+
+# 列表文件中常见的表头单词，解析时跳过
+BATCH_HEADER_WORDS = {"email", "emails", "e-mail", "mail", "username", "user", "login"}
+
+def download_telegram_file(file_id: str, max_bytes: int = BATCH_FILE_MAX_BYTES) -> Union[bytes, Dict[str, Any]]:
+    """
+    下载用户上传的文件（先 getFile 取得 file_path，再从文件服务器下载）
+
+    Returns:
+        文件内容；失败或超过 max_bytes 时返回包含 'error' 键的字典
+    """
+    try:
+        response = telegram_client.call("getFile", json={"file_id": file_id})
+        result = response.json()
+        if not result.get("ok"):
+            return {"error": result.get("description", "获取文件信息失败")}
+        file_path = result.get("result", {}).get("file_path")
+        if not file_path:
+            return {"error": "文件过大或已过期，无法下载"}
+        
+        url = f"{TELEGRAM_API_URL}/file/bot{TOKEN}/{file_path}"
+        with telegram_client.session.get(url, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, 60)) as response:
+            response.raise_for_status()
+            data = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                data.extend(chunk)
+                if len(data) > max_bytes:
+                    return {"error": f"文件超过 {max_bytes // 1024} KB 上限"}
+        return bytes(data)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"[批量] 下载文件失败: {e}")
+        return {"error": f"下载文件失败: {e}"}
+
+def parse_batch_domains(content: str) -> Tuple[List[str], List[str]]:
+    """
+    从 .txt / .csv 内容或多行消息中提取域名
+
+    按空白、逗号、分号切分，逐个规范化；重复的域名只保留第一次出现的位置。
+
+    Returns:
+        (有效域名列表, 无法识别的条目列表)
+    """
+    domains: List[str] = []
+    invalid: List[str] = []
+    seen = set()
+    for token in BATCH_SPLIT_PATTERN.split(content):
+        token = token.strip().strip("\"'")
+        if not token:
+            continue
+        domain = normalize_domain(token)
+        if domain in seen:
+            continue
+        seen.add(domain)
+        if is_valid_domain(domain):
+            domains.append(domain)
+        else:
+            invalid.append(token)
+    return domains, invalid
+
+def _locked_exists_chunk(endpoint: str, path: str, key: str, chunk: List[str]) -> Dict[str, Any]:
+    """提交一批（最多 100 条）locked-exists 检查"""
+    try:
+        response = leak_client.post(endpoint, path, json={key: chunk, "include_counts": True})
+        if response.status_code == 401:
+            return {"error": "API 认证失败，请检查 API Key 是否正确"}
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        print(f"[批量] {endpoint} 请求失败: {e}")
+        return {"error": f"API 请求失败: {str(e)}"}
+    except json.JSONDecodeError:
+        return {"error": "API 返回格式错误，无法解析 JSON"}
+
+def check_locked_exists(endpoint: str, path: str, key: str, field: str,
+                        values: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    通过 locked-exists 接口批量预检，每 100 条一批，按顺序提交到抓取线程池，
+    同时在途的批次不超过 FETCH_CONCURRENCY 个（大列表不会一次占满线程池队列），并受全局令牌桶限速
+
+    Args:
+        endpoint: 端点名称（用于限速和指标）
+        path: API 路径
+        key: 请求体中的列表字段名（domains / emails）
+        field: 结果条目中的键字段名（domain / email）
+        values: 要检查的条目
+
+    Returns:
+        条目 -> 检查结果；重试后仍失败的批次中的条目对应 {"error": ...}
+    """
+    chunks = [values[i:i + LOCKED_EXISTS_CHUNK] for i in range(0, len(values), LOCKED_EXISTS_CHUNK)]
+    fetch_chunk = lambda index: _locked_exists_chunk(endpoint, path, key, chunks[index])
+    pending = deque()
+    next_index = 0
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        for index, chunk in enumerate(chunks, 1):
+            while next_index < len(chunks) and len(pending) < FETCH_CONCURRENCY:
+                pending.append(submit_fetch(fetch_page_with_retry, fetch_chunk, next_index))
+                next_index += 1
+            result = pending.popleft().result()
+            report_progress(f"🔍 正在预检 {min(index * LOCKED_EXISTS_CHUNK, len(values))}/{len(values)}")
+            if "error" in result:
+                for value in chunk:
+                    results[value] = {"error": result["error"]}
+                continue
+            for item in result.get("results", []):
+                value = item.get(field)
+                if value is not None:
+                    results[value.lower()] = item
+    finally:
+        for future in pending:
+            future.cancel()
+    return results
+
+def check_domains_locked_exists(domains: List[str]) -> Dict[str, Dict[str, Any]]:
+    """批量预检域名：POST /search/domains/locked-exists"""
+    return check_locked_exists("domains_locked_exists", "/search/domains/locked-exists", "domains", "domain", domains)
+
+def domain_has_hits(check: Dict[str, Any]) -> bool:
+    """预检结果中任一类别有泄露（包括已解锁的）即视为命中"""
+    if check.get("any"):
+        return True
+    return any(
+        info.get("has_locked") or (info.get("total") or 0) > 0
+        for info in (check.get("categories") or {}).values()
+    )
+
+def iter_csv_blocks(fieldnames: List[str], rows: Iterable[Dict[str, Any]], block_rows: int = 500) -> Iterator[bytes]:
+    """
+    把行数据编码成 CSV 字节块（UTF-8 BOM）
+
+    第一块是表头，之后每 block_rows 行一块，都在行边界上结束，可直接交给 send_export_file
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+    writer.writeheader()
+    yield b"\xef\xbb\xbf" + buffer.getvalue().encode("utf-8")
+    rows = iter(rows)
+    while True:
+        block = list(itertools.islice(rows, block_rows))
+        if not block:
+            break
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(block)
+        yield buffer.getvalue().encode("utf-8")
+
+def batch_domain_row(domain: str, check: Dict[str, Any], report: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """合并预检结果和完整报告，生成汇总 CSV 的一行"""
+    row: Dict[str, Any] = {"domain": domain}
+    if "error" in check:
+        row.update(status="error", error=check["error"])
+        return row
+    
+    categories = check.get("categories") or {}
+    for leak_type in ("employees", "customers", "third_parties"):
+        row[f"{leak_type}_locked"] = (categories.get(leak_type) or {}).get("count") or 0
+    
+    if report is None:
+        row["status"] = "clean"
+        return row
+    if "error" in report:
+        row.update(status="error", error=report["error"])
+        return row
+    
+    counts = [report.get(f"{leak_type}_compromised", 0) or 0 for leak_type in ("employees", "customers", "third_parties")]
+    row.update(
+        status="leaked" if sum(counts) else "clean",
+        employees_compromised=counts[0],
+        customers_compromised=counts[1],
+        third_parties_compromised=counts[2],
+        total_compromised=sum(counts),
+    )
+    return row
+
+def parse_batch_emails(content: str) -> Tuple[List[str], List[str]]:
+    """
+    从 .txt / .csv 内容或多行消息中提取邮箱或用户名
+
+    按空白、逗号、分号切分，统一转为小写后去重（保持原顺序），跳过常见的表头单词。
+
+    Returns:
+        (条目列表, 无法识别的条目列表)
+    """
+    emails: List[str] = []
+    invalid: List[str] = []
+    seen = set()
+    for token in BATCH_SPLIT_PATTERN.split(content):
+        token = token.strip().strip("\"'<>")
+        value = token.lower()
+        if not value or value in seen or value in BATCH_HEADER_WORDS:
+            continue
+        seen.add(value)
+        if value.startswith("@") or value.endswith("@") or value.count("@") > 1:
+            invalid.append(token)
+        else:
+            emails.append(value)
+    return emails, invalid
+
+def check_emails_locked_exists(emails: List[str]) -> Dict[str, Dict[str, Any]]:
+    """批量预检邮箱：POST /search/emails/locked-exists"""
+    return check_locked_exists("emails_locked_exists", "/search/emails/locked-exists", "emails", "email", emails)
+
+def email_has_hits(check: Dict[str, Any]) -> bool:
+    """预检结果中有泄露（包括已解锁的）即视为命中"""
+    return bool(check.get("any") or (check.get("total") or 0) > 0)
+
+def batch_email_row(email: str, check: Dict[str, Any], detail: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """合并预检结果和第一页详细记录，生成邮箱汇总 CSV 的一行"""
+    row: Dict[str, Any] = {"email": email}
+    if "error" in check:
+        row.update(status="error", error=check["error"])
+        return row
+    
+    row.update(locked=check.get("locked") or 0, total=check.get("total") or 0, unlocked=check.get("unlocked") or 0)
+    if detail is None:
+        row["status"] = "clean"
+        return row
+    if "error" in detail:
+        row.update(status="error", error=detail["error"])
+        return row
+    
+    items = detail.get("items", [])
+    sites = list(dict.fromkeys(item.get("url", "") for item in items if item.get("url")))
+    row.update(
+        status="leaked" if items or detail.get("total") else "clean",
+        total=detail.get("total", row["total"]),
+        unlocked=detail.get("total_unlocked", row["unlocked"]),
+        sample_urls=" | ".join(sites[:BATCH_EMAIL_SAMPLE]),
+    )
+    return row
+
+def run_batch(kind: str, values: List[str], precheck: Callable[[List[str]], Dict[str, Dict[str, Any]]],
+              has_hits: Callable[[Dict[str, Any]], bool], fetch: Callable[[str], Dict[str, Any]],
+              make_row: Callable[[str, Dict[str, Any], Optional[Dict[str, Any]]], Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    批量查询：先用 locked-exists 批量预检，只对有泄露的条目并发获取详细结果
+
+    详细查询走结果缓存，按输入顺序提交到抓取线程池，同时在途的不超过 FETCH_CONCURRENCY 个，
+    不会一次占满与导出共用的线程池队列；并发同时受全局令牌桶限制。
+
+    Args:
+        kind: 条目类型（用于日志）
+        values: 要查询的条目
+        precheck: 批量预检函数，返回 条目 -> 预检结果
+        has_hits: 根据预检结果判断是否需要详细查询
+        fetch: 单个条目的详细查询
+        make_row: 根据 (条目, 预检结果, 详细结果或 None) 生成汇总行
+
+    Returns:
+        按输入顺序排列的汇总行
+    """
+    start = time.time()
+    checks = precheck(values)
+    hits = [value for value in values if has_hits(checks.get(value, {}))]
+    print(f"[批量] 预检 {len(values)} 个{kind}完成，{len(hits)} 个有泄露，耗时 {time.time() - start:.1f} 秒")
+    
+    pending = deque()
+    next_hit = 0
+    rows = []
+    fetched = 0
+    try:
+        for value in values:
+            check = checks.get(value, {"error": "预检结果缺失"})
+            detail = None
+            if has_hits(checks.get(value, {})):
+                while next_hit < len(hits) and len(pending) < FETCH_CONCURRENCY:
+                    pending.append(submit_fetch(fetch, hits[next_hit]))
+                    next_hit += 1
+                detail = pending.popleft().result()
+                fetched += 1
+                report_progress(f"📄 {len(hits)} 个有泄露，已获取详细结果 {fetched}/{len(hits)}")
+            rows.append(make_row(value, check, detail))
+    finally:
+        for future in pending:
+            future.cancel()
+    print(f"[批量] {len(values)} 个{kind}处理完成，耗时 {time.time() - start:.1f} 秒")
+    return rows
+
+def run_domain_batch(domains: List[str], fresh: bool = False) -> List[Dict[str, Any]]:
+    """批量查询域名，有泄露的域名获取完整报告"""
+    return run_batch("域名", domains, check_domains_locked_exists, domain_has_hits,
+                     lambda domain: query_leak_api(domain, fresh), batch_domain_row)
+
+def run_email_batch(emails: List[str], fresh: bool = False) -> List[Dict[str, Any]]:
+    """批量查询邮箱/用户名，有泄露的条目获取第一页详细记录"""
+    return run_batch("邮箱", emails, check_emails_locked_exists, email_has_hits,
+                     lambda email: query_email_leaks(email, page_size=BATCH_EMAIL_SAMPLE, fresh=fresh),
+                     batch_email_row)
+
+def read_batch_input(chat_id: int, document: Optional[Dict[str, Any]], text: str) -> Optional[str]:
+    """读取批量查询的输入：上传的文件内容或消息正文，失败时提示用户并返回 None"""
+    if not document:
+        return text
+    
+    filename = document.get("file_name", "")
+    if not filename.lower().endswith((".txt", ".csv")):
+        send_message(chat_id, "❌ 仅支持 .txt 或 .csv 文件，每行一个条目")
+        return None
+    if (document.get("file_size") or 0) > BATCH_FILE_MAX_BYTES:
+        send_message(chat_id, f"❌ 文件过大，最大支持 {BATCH_FILE_MAX_BYTES // 1024} KB")
+        return None
+    
+    data = download_telegram_file(document["file_id"])
+    if isinstance(data, dict):
+        send_message(chat_id, f"❌ 读取文件失败\n\n错误: {data['error']}")
+        return None
+    return data.decode("utf-8-sig", errors="replace")
+
+def batch_mode(text: str) -> str:
+    """从 /batch 命令中取出查询类型（domain / email），未指定时返回空字符串"""
+    parts = text.split()
+    if len(parts) > 1 and parts[0] == "/batch" and parts[1].lower() in ("domain", "domains", "email", "emails"):
+        return "email" if parts[1].lower().startswith("email") else "domain"
+    return ""
+
+def looks_like_email_list(content: str) -> bool:
+    """未指定类型时，多数条目包含 @ 则按邮箱列表处理"""
+    tokens = [token for token in BATCH_SPLIT_PATTERN.split(content) if token]
+    return bool(tokens) and sum(1 for token in tokens if "@" in token) * 2 > len(tokens)
+
+def handle_batch(chat_id: int, content: str, mode: str = "", fresh: bool = False) -> None:
+    """
+    /batch：批量查询并发送汇总 CSV
+
+    mode 为 "domain" 或 "email"；为空时根据内容自动判断
+    """
+    if not mode:
+        mode = "email" if looks_like_email_list(content) else "domain"
+    if mode == "email":
+        kind, values, invalid = "邮箱/用户名", *parse_batch_emails(content)
+    else:
+        kind, values, invalid = "域名", *parse_batch_domains(content)
+    
+    if not values:
+        send_message(chat_id, f"❌ 没有找到有效的{kind}\n请上传 .txt/.csv 文件，或在 /batch 后每行输入一个条目")
+        return
+    
+    skipped = 0
+    if len(values) > BATCH_MAX_ITEMS:
+        skipped = len(values) - BATCH_MAX_ITEMS
+        values = values[:BATCH_MAX_ITEMS]
+    
+    notice = f"🔍 正在批量查询 {len(values)} 个{kind}，完成后发送汇总 CSV..."
+    if invalid:
+        notice += f"\n⚠️ 已忽略 {len(invalid)} 个无效条目（如 {invalid[0]}）"
+    if skipped:
+        notice += f"\n⚠️ 超出单次上限 {BATCH_MAX_ITEMS}，已忽略 {skipped} 个{kind}"
+    with progress_message(chat_id, notice) as progress:
+        if mode == "email":
+            rows = run_email_batch(values, fresh)
+            headers, prefix = BATCH_EMAIL_HEADERS, "batch_emails"
+        else:
+            rows = run_domain_batch(values, fresh)
+            headers, prefix = BATCH_DOMAIN_HEADERS, "batch_domains"
+        progress.update("⬆️ 正在发送汇总 CSV")
+    
+    leaked = sum(1 for row in rows if row.get("status") == "leaked")
+    errors = sum(1 for row in rows if row.get("status") == "error")
+    caption = (
+        f"📊 批量{kind}查询结果\n\n"
+        f"{kind}数: {len(rows)}\n"
+        f"有泄露: {leaked}\n"
+        f"无泄露: {len(rows) - leaked - errors}"
+        + (f"\n查询失败: {errors}" if errors else "")
+    )
+    filename = f"{prefix}_{int(time.time())}.csv"
+    if send_export_file(chat_id, filename, lambda: iter_csv_blocks(headers, rows), caption):
+        progress.finish("✅ 汇总 CSV 已发送")
+    else:
+        progress.finish("❌ 汇总文件发送失败，请稍后重试")
+
+# ============================================================================
+# 密码泄露检查（k-匿名）
+# ============================================================================
+# 密码只在本地做 SHA-1，发送给 API 的只有前 5 位前缀；同一前缀的结果缓存后可供所有密码复用
+
+PASSWORD_PREFIX_LENGTH = 5
+# 后缀 35 个十六进制字符，补一位 0 后按 18 字节存储
+PASSWORD_RECORD_SIZE = 18
+
+class PasswordRange:
+    """
+    单个前缀下的泄露哈希（紧凑存储）
+
+    后缀按字节排序后拼接成一个 bytes，出现次数存放在对应位置的 array 中，
+    查找用二分法，内存占用约为字典存储的 1/5。
+    """
+
+    __slots__ = ("records", "counts", "complete", "expires_at")
+
+    def __init__(self, items: List[Tuple[bytes, int]], complete: bool, expires_at: float):
+        items.sort()
+        self.records = b"".join(record for record, _ in items)
+        self.counts = array("L", (count for _, count in items))
+        self.complete = complete
+        self.expires_at = expires_at
+
+    @staticmethod
+    def pack_suffix(suffix: str) -> bytes:
+        return bytes.fromhex(suffix + "0")
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def lookup(self, suffix: str) -> int:
+        """返回后缀的出现次数，未找到返回 0"""
+        target = self.pack_suffix(suffix)
+        low, high = 0, len(self.counts)
+        while low < high:
+            middle = (low + high) // 2
+            record = self.records[middle * PASSWORD_RECORD_SIZE:(middle + 1) * PASSWORD_RECORD_SIZE]
+            if record < target:
+                low = middle + 1
+            elif record > target:
+                high = middle
+            else:
+                return self.counts[middle]
+        return 0
+
+class PasswordRangeCache:
+    """按前缀缓存 /password-range 的结果（容量有限的 LRU，带有效期）"""
+
+    def __init__(self, max_entries: int = PWCHECK_CACHE_ENTRIES, ttl: int = PWCHECK_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, PasswordRange]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prefix: str) -> Optional[PasswordRange]:
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry is not None and entry.expires_at > time.time():
+                self._entries.move_to_end(prefix)
+                self.hits += 1
+                return entry
+            self._entries.pop(prefix, None)
+            self.misses += 1
+            return None
+
+    def set(self, prefix: str, entry: PasswordRange) -> None:
+        with self._lock:
+            self._entries[prefix] = entry
+            self._entries.move_to_end(prefix)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+password_range_cache = PasswordRangeCache()
+metrics.gauge("bot_password_cache_hits_total", "密码前缀缓存命中次数", lambda: password_range_cache.hits, kind="counter")
+metrics.gauge("bot_password_cache_misses_total", "密码前缀缓存未命中次数", lambda: password_range_cache.misses, kind="counter")
+
+def hash_password(password: str) -> str:
+    """返回密码的 SHA-1（大写十六进制）"""
+    return hashlib.sha1(password.encode("utf-8")).hexdigest().upper()
+
+def query_password_range(prefix: str) -> Union[PasswordRange, Dict[str, Any]]:
+    """
+    查询某个 SHA-1 前缀下的泄露哈希
+
+    API 端点: GET /password-range?prefix=XXXXX&suffix_only=true
+    结果缓存在 password_range_cache 中，相同前缀的并发查询只发送一次请求。
+
+    Returns:
+        PasswordRange，出错时返回包含 'error' 键的字典
+    """
+    cached = password_range_cache.get(prefix)
+    if cached is not None:
+        return cached
+
+    def load() -> Union[PasswordRange, Dict[str, Any]]:
+        params = {"prefix": prefix, "limit": PWCHECK_RANGE_LIMIT, "suffix_only": "true"}
+        try:
+            response = leak_client.get("password_range", "/password-range", params=params)
+            if response.status_code == 401:
+                return {"error": "API 认证失败，请检查 API Key 是否正确"}
+            response.raise_for_status()
+            result = response.json()
+        except requests.exceptions.RequestException as e:
+            print(f"[密码] 查询前缀 {prefix} 失败: {e}")
+            return {"error": f"API 请求失败: {str(e)}"}
+        except json.JSONDecodeError:
+            return {"error": "API 返回格式错误，无法解析 JSON"}
+        
+        items = []
+        for item in result.get("hashes", []):
+            suffix = item.get("hash", "").upper()
+            # 兼容返回完整哈希的情况
+            if len(suffix) == 40:
+                suffix = suffix[PASSWORD_PREFIX_LENGTH:]
+            if len(suffix) == 40 - PASSWORD_PREFIX_LENGTH:
+                items.append((PasswordRange.pack_suffix(suffix), item.get("count", 0)))
+        total = result.get("total", len(items))
+        entry = PasswordRange(items, complete=total <= len(items), expires_at=time.time() + PWCHECK_CACHE_TTL)
+        password_range_cache.set(prefix, entry)
+        return entry
+
+    return single_flight.do(f"password_range|{prefix}", load)
+
+def check_password_hashes(hashes: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    批量检查 SHA-1 哈希
+
+    先对前缀去重，未缓存的前缀并发查询（受全局令牌桶限速），每个前缀只请求一次。
+
+    Returns:
+        哈希 -> {"count": 出现次数, "complete": 前缀结果是否完整} 或 {"error": ...}
+    """
+    prefixes = list(dict.fromkeys(h[:PASSWORD_PREFIX_LENGTH] for h in hashes))
+    if len(prefixes) == 1:
+        # 单个密码直接在当前线程查询，不排在抓取线程池的批量任务后面
+        ranges = {prefixes[0]: query_password_range(prefixes[0])}
+    else:
+        futures = {prefix: submit_fetch(query_password_range, prefix) for prefix in prefixes}
+        ranges = {prefix: future.result() for prefix, future in futures.items()}
+    print(f"[密码] 检查 {len(hashes)} 个哈希，共 {len(prefixes)} 个不同前缀")
+    
+    results: Dict[str, Dict[str, Any]] = {}
+    for password_hash in hashes:
+        entry = ranges[password_hash[:PASSWORD_PREFIX_LENGTH]]
+        if isinstance(entry, dict):
+            results[password_hash] = entry
+        else:
+            results[password_hash] = {"count": entry.lookup(password_hash[PASSWORD_PREFIX_LENGTH:]),
+                                      "complete": entry.complete}
+    return results
+
+def mask_password(password: str) -> str:
+    """只保留首尾各一个字符，其余用 * 代替"""
+    if len(password) <= 2:
+        return "*" * len(password)
+    return password[0] + "*" * (len(password) - 2) + password[-1]
+
+def format_password_result(result: Dict[str, Any]) -> str:
+    """格式化单个密码的检查结果"""
+    if "error" in result:
+        return f"❌ 检查失败\n\n错误: {result['error']}"
+    if result["count"]:
+        return (
+            f"⚠️ 该密码已泄露\n\n"
+            f"在泄露数据中出现 {result['count']} 次，请立即停止使用并更换"
+        )
+    if not result["complete"]:
+        return "❓ 未在返回结果中找到该密码，但该前缀的结果不完整，无法确认"
+    return "✅ 未在泄露数据中发现该密码"
+
+def handle_password_batch(chat_id: int, content: str) -> None:
+    """/pwcheck 批量模式：每行一个密码，发送汇总 CSV（密码已打码，附 SHA-1）"""
+    passwords = list(dict.fromkeys(line.rstrip("\r") for line in content.split("\n") if line.strip()))
+    if not passwords:
+        send_message(chat_id, "❌ 没有找到要检查的密码，请每行输入一个")
+        return
+    if len(passwords) > PWCHECK_MAX_ITEMS:
+        send_message(chat_id, f"⚠️ 超出单次上限 {PWCHECK_MAX_ITEMS}，只检查前 {PWCHECK_MAX_ITEMS} 个")
+        passwords = passwords[:PWCHECK_MAX_ITEMS]
+    
+    hashes = [hash_password(password) for password in passwords]
+    results = check_password_hashes(hashes)
+    rows = []
+    for password, password_hash in zip(passwords, hashes):
+        result = results[password_hash]
+        row = {"password": mask_password(password), "sha1": password_hash}
+        if "error" in result:
+            row.update(status="error", error=result["error"])
+        else:
+            status = "leaked" if result["count"] else ("clean" if result["complete"] else "unknown")
+            row.update(status=status, count=result["count"])
+        rows.append(row)
+    
+    leaked = sum(1 for row in rows if row["status"] == "leaked")
+    caption = f"🔑 批量密码检查结果\n\n密码数: {len(rows)}\n已泄露: {leaked}\n未发现: {len(rows) - leaked}"
+    filename = f"pwcheck_{int(time.time())}.csv"
+    if not send_export_file(chat_id, filename, lambda: iter_csv_blocks(PWCHECK_HEADERS, rows), caption):
+        send_message(chat_id, "❌ 结果文件发送失败，请稍后重试")
+
+# ============================================================================
+# 域名监控（/watch）
+# ============================================================================
+
+WATCH_COUNT_FIELDS = [
+    ("employees", "employees_compromised", "员工"),
+    ("customers", "customers_compromised", "客户"),
+    ("third_parties", "third_parties_compromised", "第三方"),
+]
+
+class Watchlist:
+    """
+    监控列表（与更新日志共用 SQLite 文件）
+
+    每个 (会话, 域名) 一行，保存上次检查到的各类泄露数量和下次检查时间。
+    同一域名被多个会话监控时只检查一次，结果分别与各会话保存的数量比较。
+
+    两组数量单位不同，分开保存：employees 等来自域名报告（泄露账号数），用于提醒中的变化；
+    pre_employees 等来自 locked-exists 预检（泄露记录数），只与下一次预检比较，判断是否需要获取报告。
+    """
+
+    def __init__(self, db_path: str = STATE_DB_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS watches ("
+            "chat_id INTEGER NOT NULL, domain TEXT NOT NULL, created_at REAL, "
+            "employees INTEGER, customers INTEGER, third_parties INTEGER, "
+            "pre_employees INTEGER, pre_customers INTEGER, pre_third_parties INTEGER, "
+            "last_checked REAL, next_check REAL NOT NULL, PRIMARY KEY (chat_id, domain))"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(watches)").fetchall()}
+        for column in ("pre_employees", "pre_customers", "pre_third_parties"):
+            if column not in columns:
+                # 旧版本创建的表没有预检数量，下次检查时获取一次报告后补上
+                self._db.execute(f"ALTER TABLE watches ADD COLUMN {column} INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS watches_next_check ON watches (next_check)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS watch_state (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+
+    def add(self, chat_id: int, domain: str, counts: Dict[str, int], next_check: float) -> bool:
+        """添加监控并保存基线数量，已存在时返回 False"""
+        now = time.time()
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    "INSERT OR IGNORE INTO watches (chat_id, domain, created_at, employees, customers, third_parties, "
+                    "last_checked, next_check) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (chat_id, domain, now, counts.get("employees"), counts.get("customers"),
+                     counts.get("third_parties"), now, next_check)
+                )
+        return cursor.rowcount > 0
+
+    def remove(self, chat_id: int, domain: str) -> bool:
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute("DELETE FROM watches WHERE chat_id = ? AND domain = ?", (chat_id, domain))
+        return cursor.rowcount > 0
+
+    def count(self, chat_id: int) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM watches WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+
+    def list(self, chat_id: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT domain, employees, customers, third_parties, last_checked, next_check "
+                "FROM watches WHERE chat_id = ? ORDER BY domain", (chat_id,)
+            ).fetchall()
+        keys = ["domain", "employees", "customers", "third_parties", "last_checked", "next_check"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def domains(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT DISTINCT domain FROM watches").fetchall()]
+
+    def due(self, now: float, limit: int) -> List[str]:
+        """返回到期需要检查的域名（去重，最早到期的优先）"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT domain FROM watches WHERE next_check <= ? GROUP BY domain ORDER BY MIN(next_check) LIMIT ?",
+                (now, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def watchers(self, domain: str) -> List[Dict[str, Any]]:
+        """返回监控该域名的会话及其保存的报告数量，预检数量在 "precheck" 中（未保存过时为 None）"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chat_id, employees, customers, third_parties, pre_employees, pre_customers, pre_third_parties "
+                "FROM watches WHERE domain = ?", (domain,)
+            ).fetchall()
+        watchers = []
+        for row in rows:
+            watcher = dict(zip(["chat_id", "employees", "customers", "third_parties"], row[:4]))
+            precheck = dict(zip(["employees", "customers", "third_parties"], row[4:]))
+            watcher["precheck"] = None if None in precheck.values() else precheck
+            watchers.append(watcher)
+        return watchers
+
+    def update(self, domain: str, counts: Optional[Dict[str, int]], next_check: float,
+               precheck: Optional[Dict[str, int]] = None) -> None:
+        """
+        保存最新的报告数量和预检数量，为 None 的一组保持不变；两者都为 None 时只推迟下次检查
+        """
+        assignments = ["next_check = ?"]
+        values: List[Any] = [next_check]
+        if counts is not None:
+            assignments.append("employees = ?, customers = ?, third_parties = ?")
+            values += [counts["employees"], counts["customers"], counts["third_parties"]]
+        if precheck is not None:
+            assignments.append("pre_employees = ?, pre_customers = ?, pre_third_parties = ?")
+            values += [precheck["employees"], precheck["customers"], precheck["third_parties"]]
+        if counts is not None or precheck is not None:
+            assignments.append("last_checked = ?")
+            values.append(time.time())
+        with self._lock:
+            with self._db:
+                self._db.execute(f"UPDATE watches SET {', '.join(assignments)} WHERE domain = ?", (*values, domain))
+
+    def schedule_now(self, domain: str) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute("UPDATE watches SET next_check = 0 WHERE domain = ?", (domain,))
+
+    def get_state(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM watch_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key: str, value: str) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO watch_state (key, value) VALUES (?, ?)", (key, value))
+
+_watchlist: Optional[Watchlist] = None
+_watchlist_lock = threading.Lock()
+
+def get_watchlist() -> Watchlist:
+    """监控列表（第一次使用时才打开 STATE_DB_PATH）"""
+    global _watchlist
+    with _watchlist_lock:
+        if _watchlist is None:
+            _watchlist = Watchlist()
+        return _watchlist
+
+def report_counts(report: Dict[str, Any]) -> Dict[str, int]:
+    """从域名报告中取出各类泄露数量"""
+    return {leak_type: report.get(field, 0) or 0 for leak_type, field, _ in WATCH_COUNT_FIELDS}
+
+def precheck_counts(check: Dict[str, Any]) -> Optional[Dict[str, int]]:
+    """从 locked-exists 预检结果中取出各类泄露总数，缺少数量时返回 None"""
+    categories = check.get("categories") or {}
+    counts = {}
+    for leak_type, _, _ in WATCH_COUNT_FIELDS:
+        total = (categories.get(leak_type) or {}).get("total")
+        if total is None:
+            return None
+        counts[leak_type] = total
+    return counts
+
+def next_watch_time(interval: float) -> float:
+    """下次检查时间：在间隔基础上加 ±WATCH_JITTER 的随机抖动，避免所有域名同时到期"""
+    return time.time() + interval * (1 + random.uniform(-WATCH_JITTER, WATCH_JITTER))
+
+def format_watch_alert(domain: str, old: Dict[str, Any], new: Dict[str, int]) -> str:
+    """生成数量变化提醒"""
+    lines = [f"🔔 监控提醒: {domain}", "=" * 30]
+    for leak_type, _, type_name in WATCH_COUNT_FIELDS:
+        before = old.get(leak_type) or 0
+        after = new[leak_type]
+        change = f"（{after - before:+d}）" if after != before else ""
+        lines.append(f"{type_name}泄露: {after} 条{change}")
+    lines.append(f"\n发送 {domain} 查看报告，或 /export new {domain} 导出新增记录")
+    return "\n".join(lines)
+
+def get_notifications() -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+    """获取账户在 LeakRadar 上配置的通知（GET /notifications）"""
+    try:
+        response = leak_client.get("notifications", "/notifications")
+        response.raise_for_status()
+        return response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return {"error": f"获取通知列表失败: {e}"}
+
+def get_notification_runs(page: int = 1, page_size: int = 50) -> Dict[str, Any]:
+    """获取通知运行记录（GET /notification_runs，按时间倒序）"""
+    try:
+        response = leak_client.get("notification_runs", "/notification_runs",
+                                   params={"page": page, "page_size": page_size})
+        if response.status_code == 404:
+            return {"items": [], "total": 0}
+        response.raise_for_status()
+        return response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return {"error": f"获取通知运行记录失败: {e}"}
+
+class WatchScheduler:
+    """
+    监控调度器（单个后台线程）
+
+    - 每 WATCH_TICK 秒取出到期的域名，按 100 个一批用 locked-exists 预检，
+      数量与上次不同（或预检没有返回数量）的域名再获取完整报告确认，只在数量变化时推送提醒
+    - 已在 LeakRadar 配置了域名通知的域名由服务端跟踪：定期读取 /notification_runs，
+      有新运行记录时才立即检查，平时只按 WATCH_SERVER_INTERVAL 做兜底检查
+    """
+
+    def __init__(self, interval: float = WATCH_INTERVAL, tick: float = WATCH_TICK):
+        self.interval = interval
+        self.tick = tick
+        self._server_tracked: set = set()
+        self._notifications_synced_at = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="watch-scheduler", daemon=True)
+            self._thread.start()
+            print(f"✓ 域名监控已启动: 检查间隔 {self.interval / 3600:g} 小时")
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def interval_for(self, domain: str) -> float:
+        return WATCH_SERVER_INTERVAL if domain in self._server_tracked else self.interval
+
+    def _run(self) -> None:
+        # 后台监控的请求按批量通道限速
+        current_lane.set("bulk")
+        while True:
+            try:
+                self.sync_server_notifications()
+                self.check_due()
+            except Exception as e:
+                print(f"[监控] 检查出错: {e}")
+                traceback.print_exc()
+            if self._wake.wait(self.tick):
+                self._wake.clear()
+
+    def sync_server_notifications(self) -> None:
+        """同步服务端通知：记录哪些域名已由服务端跟踪，并把有新运行记录的域名提前到现在检查"""
+        watchlist = get_watchlist()
+        watched = set(watchlist.domains())
+        if not watched:
+            return
+        now = time.time()
+        if now - self._notifications_synced_at >= WATCH_NOTIFICATION_SYNC:
+            notifications = get_notifications()
+            if isinstance(notifications, dict):
+                print(f"[监控] {notifications['error']}")
+            else:
+                self._server_tracked = {
+                    normalize_domain(item.get("value") or "") for item in notifications
+                    if str(item.get("type", "")).lower() == "domain" and item.get("is_active")
+                }
+                print(f"[监控] 服务端已跟踪 {len(self._server_tracked & watched)} 个监控域名")
+            self._notifications_synced_at = now
+        if not self._server_tracked & watched:
             return
         
-        send_message(chat_id, f"🔍 正在查询客户泄露: {normalized_domain}\n请稍候...")
-        result = query_domain_leaks(normalized_domain, "customers")
-        formatted = format_leaks_list(result, "customers", normalized_domain)
-        send_message(chat_id, formatted)
-        print(f"[查询] 用户 {user_name} 查询客户泄露: {normalized_domain}")
-    
-    # 处理 /thirdparties 命令
-    elif text.startswith("/thirdparties ") or text.startswith("/third_parties "):
-        domain = text.replace("/thirdparties ", "").replace("/third_parties ", "").strip()
-        normalized_domain = normalize_domain(domain)
+        last_run_id = int(watchlist.get_state("last_run_id") or 0)
+        newest = last_run_id
+        page = 1
+        while page <= 5:
+            result = get_notification_runs(page)
+            if "error" in result:
+                print(f"[监控] {result['error']}")
+                return
+            items = result.get("items", [])
+            for run in items:
+                run_id = run.get("id", 0)
+                newest = max(newest, run_id)
+                if run_id <= last_run_id or not last_run_id:
+                    continue
+                domain = normalize_domain(run.get("notification_value") or "")
+                if domain in watched and run.get("new_leaks_count"):
+                    print(f"[监控] 服务端通知 {domain} 有 {run['new_leaks_count']} 条新泄露，立即检查")
+                    watchlist.schedule_now(domain)
+            # 首次同步只记录最新的运行 ID；之后翻页直到遇到已处理过的记录
+            if not last_run_id or not items or items[-1].get("id", 0) <= last_run_id:
+                break
+            page += 1
+        if newest != last_run_id:
+            watchlist.set_state("last_run_id", str(newest))
+
+    def check_due(self) -> None:
+        """检查到期的域名"""
+        watchlist = get_watchlist()
+        domains = watchlist.due(time.time(), WATCH_BATCH_SIZE)
+        if not domains:
+            return
+        checks = check_domains_locked_exists(domains)
+        
+        # 预检数量与所有监控者上次保存的预检数量一致时无需获取报告（报告数量与预检数量单位不同，不能互相比较）
+        confirm = {}
+        for domain in domains:
+            check = checks.get(domain, {"error": "预检结果缺失"})
+            precheck = None if "error" in check else precheck_counts(check)
+            if precheck is not None and all(
+                watcher["precheck"] == precheck for watcher in watchlist.watchers(domain)
+            ):
+                watchlist.update(domain, None, next_watch_time(self.interval_for(domain)), precheck)
+            elif "error" in check:
+                # 预检失败时稍后重试，不推送提醒
+                watchlist.update(domain, None, next_watch_time(min(self.interval_for(domain), 3600)))
+            else:
+                confirm[domain] = precheck
         
-        if not is_valid_domain(normalized_domain):
-            send_message(chat_id, f"❌ 域名格式无效: {domain}")
+        futures = {domain: submit_fetch(query_leak_api, domain, True) for domain in confirm}
+        for domain, future in futures.items():
+            report = future.result()
+            if "error" in report:
+                watchlist.update(domain, None, next_watch_time(min(self.interval_for(domain), 3600)))
+                continue
+            counts = report_counts(report)
+            for watcher in watchlist.watchers(domain):
+                if any((watcher[leak_type] or 0) != counts[leak_type] for leak_type in counts):
+                    send_message(watcher["chat_id"], format_watch_alert(domain, watcher, counts))
+            watchlist.update(domain, counts, next_watch_time(self.interval_for(domain)), confirm[domain])
+        print(f"[监控] 检查 {len(domains)} 个域名，{len(confirm)} 个需要获取报告")
+
+watch_scheduler = WatchScheduler()
+
+# ============================================================================
+# 分页浏览（内联键盘翻页）
+# ============================================================================
+
+class PagedResult:
+    """
+    一个可翻页的查询结果（如某域名的员工泄露列表），每页对应一次 API 分页请求
+
+    - 某一页只在用户翻到时才请求；用户开始翻页后，显示某页时在抓取线程池中预取下一页（按批量通道限速）。
+      第一页不预取：大多数列表查询不会翻页
+    - 最近看过的页缓存在结果集内（LRU，最多 cache_pages 页），来回翻页不再请求 API
+    - 请求失败的页不缓存，用户重试时重新请求
+    """
+
+    def __init__(self, result_id: str, chat_id: int, fetch_page: Callable[[int], Dict[str, Any]],
+                 render: Callable[[Dict[str, Any]], str], page_size: int,
+                 cache_pages: int = PAGED_CACHE_PAGES, ttl: int = PAGED_RESULT_TTL):
+        self.result_id = result_id
+        self.chat_id = chat_id
+        self.fetch_page = fetch_page
+        self.render = render
+        self.page_size = page_size
+        self.cache_pages = cache_pages
+        self.expires_at = time.time() + ttl
+        # 总页数，取得第一页后才知道
+        self.total_pages: Optional[int] = None
+        self._lock = threading.Lock()
+        # 页码 -> 该页的 Future（预取中的页也在这里，重复翻到时等待同一个请求）
+        self._pages: "OrderedDict[int, Future]" = OrderedDict()
+
+    def _fetch(self, page: int) -> Dict[str, Any]:
+        result = self.fetch_page(page)
+        if "error" not in result and "page" not in result:
+            # 格式化时按页码计算序号
+            result = {**result, "page": page, "page_size": self.page_size}
+        return result
+
+    def _load(self, page: int, background: bool = False) -> Future:
+        """取得某页的 Future：已缓存或预取中时直接返回，否则在当前线程请求（background 时交给抓取线程池）"""
+        with self._lock:
+            future = self._pages.get(page)
+            if future is not None:
+                self._pages.move_to_end(page)
+                return future
+            # 预取按批量通道限速，不占用交互查询保留的配额
+            future = submit_fetch(run_in_lane, "bulk", self._fetch, page) if background else Future()
+            self._pages[page] = future
+            while len(self._pages) > self.cache_pages:
+                self._pages.popitem(last=False)
+        if not background:
+            try:
+                future.set_result(self._fetch(page))
+            except Exception as e:
+                future.set_result({"error": f"查询失败: {e}"})
+        return future
+
+    def get(self, page: int) -> Dict[str, Any]:
+        """取得某页的 API 结果"""
+        result = self._load(page).result()
+        with self._lock:
+            if "error" in result:
+                self._pages.pop(page, None)
+            else:
+                total = result.get("total", 0) or 0
+                self.total_pages = max(1, math.ceil(total / self.page_size))
+        return result
+
+    def keyboard(self, page: int, retry: bool = False) -> Optional[Dict[str, Any]]:
+        """翻页按钮；retry 为 True 时加一个重试当前页的按钮"""
+        buttons = []
+        if page > 1:
+            buttons.append({"text": "⬅️ 上一页", "callback_data": f"pg:{self.result_id}:{page - 1}"})
+        if retry:
+            buttons.append({"text": "🔄 重试", "callback_data": f"pg:{self.result_id}:{page}"})
+        if self.total_pages and page < self.total_pages:
+            buttons.append({"text": "下一页 ➡️", "callback_data": f"pg:{self.result_id}:{page + 1}"})
+        return {"inline_keyboard": [buttons]} if buttons else None
+
+    def show(self, page: int, prefetch: bool = True) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """取得某页的消息文本和翻页按钮，prefetch 为 True 时预取下一页"""
+        result = self.get(page)
+        text = self.render(result)
+        if "error" in result:
+            return text, self.keyboard(page, retry=page > 1)
+        if self.total_pages > 1:
+            text += f"\n\n📄 第 {page}/{self.total_pages} 页"
+        if prefetch and page < self.total_pages:
+            self._load(page + 1, background=True)
+        return text, self.keyboard(page)
+
+class PagedResultStore:
+    """可翻页结果集的索引：按 ID 查找（ID 写在按钮的 callback_data 里），容量有限，过期的结果集不再可用"""
+
+    def __init__(self, max_results: int = PAGED_RESULTS_MAX):
+        self.max_results = max_results
+        self._lock = threading.Lock()
+        self._results: "OrderedDict[str, PagedResult]" = OrderedDict()
+
+    def create(self, chat_id: int, fetch_page: Callable[[int], Dict[str, Any]],
+               render: Callable[[Dict[str, Any]], str], page_size: int) -> PagedResult:
+        # callback_data 最长 64 字节，用短随机 ID（重启后旧按钮不会对应到新结果）
+        result = PagedResult(secrets.token_hex(4), chat_id, fetch_page, render, page_size)
+        with self._lock:
+            self._results[result.result_id] = result
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return result
+
+    def get(self, result_id: str) -> Optional[PagedResult]:
+        with self._lock:
+            result = self._results.get(result_id)
+            if result is None:
+                return None
+            if result.expires_at < time.time():
+                del self._results[result_id]
+                return None
+            self._results.move_to_end(result_id)
+            return result
+
+    def discard(self, result_id: str) -> None:
+        with self._lock:
+            self._results.pop(result_id, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._results)
+
+paged_results = PagedResultStore()
+metrics.gauge("paged_results", "可翻页的结果集数", lambda: len(paged_results))
+
+def send_paged_result(chat_id: int, fetch_page: Callable[[int], Dict[str, Any]],
+                      render: Callable[[Dict[str, Any]], str], page_size: int) -> None:
+    """发送查询结果的第一页，有多页时带翻页按钮（后续页在用户翻页时才请求）"""
+    result = paged_results.create(chat_id, fetch_page, render, page_size)
+    text, keyboard = result.show(1, prefetch=False)
+    if keyboard is None:
+        paged_results.discard(result.result_id)
+        send_message(chat_id, text)
+        return
+    # 排队中的「正在查询」提示可以并入这条消息，翻页时整条消息替换为新的一页
+    outbound_queue.send(chat_id, text, reply_markup=keyboard)
+
+# ============================================================================
+# 命令路由
+# ============================================================================
+
+# 命令消息的开头：/命令[@机器人用户名]，之后是参数（保留原始换行）
+COMMAND_PATTERN = re.compile(r'^/([A-Za-z0-9_]+)(?:@([A-Za-z0-9_]+))?(?=\s|$)')
+
+class CommandUsageError(Exception):
+    """命令参数不正确，异常消息即回复给用户的提示"""
+
+class CommandContext:
+    """一条消息的处理上下文，传给命令处理函数"""
+
+    def __init__(self, message: Dict[str, Any], text: str, command: str, rest: str, fresh: bool):
+        self.message = message
+        self.chat_id = message["chat"]["id"]
+        user = message.get("from", {})
+        self.user_id = user.get("id", 0)
+        self.user_name = user.get("first_name", "用户")
+        self.document = message.get("document")
+        # 去掉 @机器人用户名 和 !fresh 后的正文
+        self.text = text
+        # 命令名（小写，如 /export）；普通文本为空字符串
+        self.command = command
+        # 命令之后的原始内容；args 为解析后的参数（解析器在登记命令时确定）
+        self.rest = rest
+        self.args: Any = rest.strip()
+        self.fresh = fresh
+        # 内联按钮回调（callback_query），普通消息为 None
+        self.callback: Optional[Dict[str, Any]] = message.get("callback_query")
+        # 路由选中的处理函数，由中间件链最内层调用
+        self.handler: Optional[Callable[["CommandContext"], None]] = None
+
+def split_command(text: str) -> Tuple[str, str, str]:
+    """拆分命令消息，返回 (命令名, @ 的机器人用户名, 其余内容)；不是命令时命令名为空"""
+    match = COMMAND_PATTERN.match(text)
+    if not match:
+        return "", "", text
+    return "/" + match.group(1).lower(), match.group(2) or "", text[match.end():]
+
+def parse_domain_arg(ctx: CommandContext, usage: str) -> str:
+    """参数为一个域名：规范化并验证格式"""
+    if not ctx.args:
+        raise CommandUsageError(f"❌ 请提供域名\n例如: {usage}")
+    domain = normalize_domain(ctx.args)
+    if not is_valid_domain(domain):
+        raise CommandUsageError(f"❌ 域名格式无效: {ctx.args}")
+    return domain
+
+def parse_text_arg(ctx: CommandContext, usage: str) -> str:
+    """参数为必填的一段文字"""
+    if not ctx.args:
+        raise CommandUsageError(usage)
+    return ctx.args
+
+# 参数解析器：none 无参数，words 按空白拆分，text 必填文字，domain 域名，raw 原始内容（保留换行）
+ARG_PARSERS: Dict[str, Callable[[CommandContext, str], Any]] = {
+    "none": lambda ctx, usage: None,
+    "words": lambda ctx, usage: ctx.args.split(),
+    "text": parse_text_arg,
+    "domain": parse_domain_arg,
+    "raw": lambda ctx, usage: ctx.rest,
+}
+
+class CommandRouter:
+    """
+    命令路由表
+
+    - command() 登记命令处理函数，按命令名查表分发；参数解析器在登记时选定，处理函数拿到的 ctx.args 已解析
+    - fallback() 处理普通文本（域名查询），document() 处理上传的文件，callback() 按前缀处理内联按钮回调
+    - use() 登记中间件 middleware(ctx, call_next)，先登记的在外层（权限、计时、异常处理）
+    - 群组中 /命令@其他机器人 的消息直接忽略；bot_username 在启动时通过 getMe 获取
+    """
+
+    def __init__(self):
+        self.bot_username = ""
+        self._commands: Dict[str, Callable[[CommandContext], None]] = {}
+        self._fallback: Optional[Callable[[CommandContext], None]] = None
+        self._document: Optional[Callable[[CommandContext], None]] = None
+        self._callbacks: Dict[str, Callable[[CommandContext], None]] = {}
+        self._middleware: List[Callable[[CommandContext, Callable[[CommandContext], None]], None]] = []
+        self._chain: Callable[[CommandContext], None] = lambda ctx: ctx.handler(ctx)
+
+    def command(self, *names: str, args: str = "none", usage: str = ""):
+        """装饰器：登记命令，args 为参数解析器名称（见 ARG_PARSERS），usage 为缺少参数时的提示"""
+        parser = ARG_PARSERS[args]
+        
+        def register(handler: Callable[[CommandContext], None]) -> Callable[[CommandContext], None]:
+            def invoke(ctx: CommandContext) -> None:
+                ctx.args = parser(ctx, usage)
+                handler(ctx)
+            for name in names:
+                self._commands[name] = invoke
+            return handler
+        return register
+
+    def fallback(self, handler: Callable[[CommandContext], None]) -> Callable[[CommandContext], None]:
+        self._fallback = handler
+        return handler
+
+    def document(self, handler: Callable[[CommandContext], None]) -> Callable[[CommandContext], None]:
+        self._document = handler
+        return handler
+
+    def callback(self, prefix: str):
+        """装饰器：登记内联按钮回调，callback_data 为 "前缀:参数"，处理函数的 ctx.args 为参数部分"""
+        def register(handler: Callable[[CommandContext], None]) -> Callable[[CommandContext], None]:
+            self._callbacks[prefix] = handler
+            return handler
+        return register
+
+    def use(self, middleware: Callable[[CommandContext, Callable[[CommandContext], None]], None]):
+        # 登记时就把中间件组合好（先登记的在外层），分发时不再逐条包装
+        self._middleware.append(middleware)
+        chain = lambda ctx: ctx.handler(ctx)
+        for outer in reversed(self._middleware):
+            chain = (lambda outer, inner: lambda ctx: outer(ctx, inner))(outer, chain)
+        self._chain = chain
+        return middleware
+
+    def dispatch(self, message: Dict[str, Any]) -> None:
+        """解析消息并交给对应的处理函数（经过全部中间件）"""
+        callback = message.get("callback_query")
+        if callback:
+            data = callback.get("data") or ""
+            prefix, _, args = data.partition(":")
+            handler = self._callbacks.get(prefix)
+            if handler is None:
+                answer_callback_query(callback["id"])
+                return
+            ctx = CommandContext(message, data, "", args, False)
+            ctx.handler = handler
+            self._chain(ctx)
             return
         
-        send_message(chat_id, f"🔍 正在查询第三方泄露: {normalized_domain}\n请稍候...")
-        result = query_domain_leaks(normalized_domain, "third_parties")
-        formatted = format_leaks_list(result, "third_parties", normalized_domain)
-        send_message(chat_id, formatted)
-        print(f"[查询] 用户 {user_name} 查询第三方泄露: {normalized_domain}")
-    
-    # 处理 /email 命令
-    elif text.startswith("/email "):
-        email = text.replace("/email ", "").strip()
-        
-        if not email:
-            send_message(chat_id, "❌ 请输入邮箱或用户名\n例如：/email user@example.com")
+        text = message.get("text") or message.get("caption") or ""
+        command, mention, rest = split_command(text)
+        if mention:
+            if self.bot_username and mention.lower() != self.bot_username.lower():
+                # 群组中发给其他机器人的命令
+                return
+            text = command + rest
+        
+        # 末尾带 !fresh 时跳过缓存，直接查询最新数据（/pwcheck 的参数是密码，原样保留）
+        fresh = False
+        if command != "/pwcheck" and text.endswith(FRESH_SUFFIX):
+            fresh = True
+            text = text[:-len(FRESH_SUFFIX)].rstrip()
+            rest = text[len(command):] if command else text
+        
+        # 文件不带说明或说明为 /batch、/pwcheck 时交给文件处理函数，其余按说明文字处理
+        if message.get("document") and command in ("", "/batch", "/pwcheck"):
+            handler = self._document
+        elif command:
+            handler = self._commands.get(command)
+        else:
+            handler = self._fallback if text.strip() else None
+        if handler is None:
             return
         
-        send_message(chat_id, f"🔍 正在查询邮箱泄露: {email}\n请稍候...")
-        result = query_email_leaks(email)
-        formatted = format_email_result(result, email)
-        send_message(chat_id, formatted)
-        print(f"[查询] 用户 {user_name} 查询邮箱: {email}")
+        ctx = CommandContext(message, text.strip(), command, rest, fresh)
+        ctx.handler = handler
+        self._chain(ctx)
+
+router = CommandRouter()
+
+@router.use
+def auth_middleware(ctx: CommandContext, call_next: Callable[[CommandContext], None]) -> None:
+    """权限检查：设置了 ALLOWED_USERS 时只处理名单中的用户"""
+    if ALLOWED_USERS and ctx.user_id not in ALLOWED_USERS:
+        print(f"[拒绝] 未授权用户尝试访问: {ctx.user_name} ({ctx.user_id})")
+        # 只在用户发送命令时回复，避免在群组中过于频繁
+        if ctx.callback:
+            answer_callback_query(ctx.callback["id"], "❌ 没有权限")
+        elif ctx.command:
+            send_message(ctx.chat_id, "❌ 抱歉，您没有使用此机器人的权限。\n请联系管理员授权。")
+        return
+    call_next(ctx)
+
+@router.use
+def timing_middleware(ctx: CommandContext, call_next: Callable[[CommandContext], None]) -> None:
+    """记录收到的消息（密码检查的内容不写入日志）和处理耗时"""
+    shown = "/pwcheck ***" if ctx.command == "/pwcheck" else ctx.text
+    print(f"[消息] 用户 {ctx.user_name} ({ctx.user_id}): {shown}")
+    start = time.perf_counter()
+    try:
+        call_next(ctx)
+    finally:
+        label = ctx.command or ("callback" if ctx.callback else "domain_lookup")
+        print(f"[耗时] {label} {time.perf_counter() - start:.2f} 秒")
+
+@router.use
+def error_middleware(ctx: CommandContext, call_next: Callable[[CommandContext], None]) -> None:
+    """参数错误时回复用法提示；处理出错时告知用户，异常继续抛给调度器记录"""
+    try:
+        call_next(ctx)
+    except CommandUsageError as e:
+        send_message(ctx.chat_id, str(e))
+    except Exception:
+        send_message(ctx.chat_id, "❌ 处理请求时出错，请稍后重试")
+        raise
+
+@router.document
+def cmd_document(ctx: CommandContext) -> None:
+    """上传的文件：说明为 /pwcheck 时批量检查密码，否则（不带说明或说明为 /batch）按批量查询处理"""
+    if ctx.command == "/pwcheck":
+        content = read_batch_input(ctx.chat_id, ctx.document, "")
+        delete_message(ctx.chat_id, ctx.message["message_id"])
+        if content is not None:
+            handle_password_batch(ctx.chat_id, content)
+            print(f"[密码] 用户 {ctx.user_name} 批量检查密码")
+        return
+    content = read_batch_input(ctx.chat_id, ctx.document, "")
+    if content is not None:
+        handle_batch(ctx.chat_id, content, batch_mode(ctx.text), ctx.fresh)
+        print(f"[批量] 用户 {ctx.user_name} 上传列表文件: {ctx.document.get('file_name', '')}")
+
+@router.command("/start")
+def cmd_start(ctx: CommandContext) -> None:
+    welcome_message = (
+        f"你好 {ctx.user_name}！我是lysir_bot账密泄露查询机器人🔍\n\n"
+        "📋 使用说明：\n"
+        "• 直接发送域名即可查询账密泄露情况\n"
+        "• 例如：example.com 或 www.example.com\n\n"
+        "💡 提示：\n"
+        "• 我会自动处理域名格式，支持带 http:// 或 www. 的域名\n"
+        "• 查询结果包括员工、第三方和客户的泄露统计\n"
+        "• 完整版本会显示密码强度统计信息\n\n"
+        "📖 输入 /help 查看详细帮助"
+    )
+    send_message(ctx.chat_id, welcome_message)
+    print(f"[回复] 发送欢迎消息给用户 {ctx.user_name}")
+
+@router.command("/help")
+def cmd_help(ctx: CommandContext) -> None:
+    help_message = (
+        "📖 lysir_bot 账密泄露查询机器人帮助\n\n"
+        "🔍 查询方式：\n\n"
+        "1️⃣ 域名泄露报告（默认）\n"
+        "直接发送域名即可查询，例如：\n"
+        "• example.com\n"
+        "• www.example.com\n\n"
+        "2️⃣ 查询详细泄露列表\n"
+        "• /employees <domain> - 查询员工泄露列表\n"
+        "• /customers <domain> - 查询客户泄露列表\n"
+        "• /thirdparties <domain> - 查询第三方泄露列表\n\n"
+        "3️⃣ 邮箱/用户名查询\n"
+        "• /email <邮箱或用户名> - 查询邮箱泄露\n"
+        "例如：/email user@example.com\n\n"
+        "4️⃣ 子域名查询\n"
+        "• /subdomains <domain> - 查询子域名列表\n\n"
+        "5️⃣ URL 查询\n"
+        "• /urls <domain> - 查询相关 URL 列表\n\n"
+        "6️⃣ CSV 导出功能\n"
+        "• /export <domain> - 导出全部泄露 CSV\n"
+        "• /export email <email> - 导出邮箱泄露 CSV\n"
+        "• /export new <domain> - 只导出上次导出后新增的记录\n"
+        "• /serverexport <domain> - 由服务端生成导出文件，完成后自动发送\n"
+        "• /exports - 查看服务端导出任务\n\n"
+        "7️⃣ 批量查询\n"
+        "• 上传 .txt/.csv 域名或邮箱列表文件（每行一个）\n"
+        "• 或 /batch 后每行输入一个域名\n"
+        "• /batch email 后每行输入一个邮箱/用户名\n"
+        "完成后发送汇总 CSV\n\n"
+        "8️⃣ 域名监控\n"
+        "• /watch <domain> - 监控域名，泄露数量变化时通知\n"
+        "• /unwatch <domain> - 取消监控\n"
+        "• /watchlist - 查看监控列表\n\n"
+        "9️⃣ 密码泄露检查\n"
+        "• /pwcheck <密码> - 检查密码是否出现在泄露数据中\n"
+        "• /pwcheck 后每行一个密码，或上传说明为 /pwcheck 的文件 - 批量检查\n"
+        "密码只在本地哈希，不会发送原文\n\n"
+        "⚙️ 命令列表：\n"
+        "/start - 开始使用\n"
+        "/help - 显示帮助信息\n\n"
+        "💡 提示：\n"
+        "• 列表结果超过一页时，点击消息下方的按钮翻页\n"
+        "• 查询结果会缓存几分钟，在命令末尾加 !fresh 可获取最新数据\n"
+        "  例如：example.com !fresh\n"
+        "• 导出任务完成后会自动发送 CSV 文件\n"
+        "• 查询结果可能包含敏感信息，请谨慎使用"
+    )
+    send_message(ctx.chat_id, help_message)
+    print(f"[回复] 发送帮助信息给用户 {ctx.user_name}")
+
+# 详细泄露列表命令 -> (泄露类型, 名称)
+LEAK_LIST_COMMANDS = {
+    "/employees": ("employees", "员工"),
+    "/customers": ("customers", "客户"),
+    "/thirdparties": ("third_parties", "第三方"),
+    "/third_parties": ("third_parties", "第三方"),
+}
+
+@router.command(*LEAK_LIST_COMMANDS, args="domain", usage="/employees example.com")
+def cmd_leak_list(ctx: CommandContext) -> None:
+    """/employees、/customers、/thirdparties：查询详细泄露列表"""
+    leak_type, type_name = LEAK_LIST_COMMANDS[ctx.command]
+    normalized_domain = ctx.args
+    send_message(ctx.chat_id, f"🔍 正在查询{type_name}泄露: {normalized_domain}\n请稍候...")
+    send_paged_result(
+        ctx.chat_id,
+        lambda page: query_domain_leaks(normalized_domain, leak_type, page=page, page_size=10, fresh=ctx.fresh),
+        lambda result: format_leaks_list(result, leak_type, normalized_domain),
+        page_size=10
+    )
+    print(f"[查询] 用户 {ctx.user_name} 查询{type_name}泄露: {normalized_domain}")
+
+@router.command("/email", args="text", usage="❌ 请输入邮箱或用户名\n例如：/email user@example.com")
+def cmd_email(ctx: CommandContext) -> None:
+    email = ctx.args
+    send_message(ctx.chat_id, f"🔍 正在查询邮箱泄露: {email}\n请稍候...")
+    result = query_email_leaks(email, fresh=ctx.fresh)
+    formatted = format_email_result(result, email)
+    send_message(ctx.chat_id, formatted)
+    print(f"[查询] 用户 {ctx.user_name} 查询邮箱: {email}")
+
+@router.command("/subdomains", args="domain", usage="/subdomains example.com")
+def cmd_subdomains(ctx: CommandContext) -> None:
+    normalized_domain = ctx.args
+    send_message(ctx.chat_id, f"🔍 正在查询子域名: {normalized_domain}\n请稍候...")
+    send_paged_result(
+        ctx.chat_id,
+        lambda page: query_domain_subdomains(normalized_domain, page=page, page_size=20, fresh=ctx.fresh),
+        lambda result: format_subdomains_result(result, normalized_domain),
+        page_size=20
+    )
+    print(f"[查询] 用户 {ctx.user_name} 查询子域名: {normalized_domain}")
+
+@router.command("/urls", args="domain", usage="/urls example.com")
+def cmd_urls(ctx: CommandContext) -> None:
+    normalized_domain = ctx.args
+    send_message(ctx.chat_id, f"🔍 正在查询 URL: {normalized_domain}\n请稍候...")
+    send_paged_result(
+        ctx.chat_id,
+        lambda page: query_domain_urls(normalized_domain, page=page, page_size=20, fresh=ctx.fresh),
+        lambda result: format_urls_result(result, normalized_domain),
+        page_size=20
+    )
+    print(f"[查询] 用户 {ctx.user_name} 查询 URL: {normalized_domain}")
+
+@router.command("/export", args="words")
+def cmd_export(ctx: CommandContext) -> None:
+    """/export：边获取边生成 CSV 发送，/export new 只导出上次导出后新增的记录"""
+    parts = ctx.args
+    # /export new ... 只导出上次导出后新增的记录
+    delta = bool(parts) and parts[0].lower() == "new"
+    if delta:
+        parts = parts[1:]
+    if not parts:
+        send_message(ctx.chat_id, 
+            "❌ 命令格式错误\n\n"
+            "正确格式：\n"
+            "/export <domain> (导出全部)\n"
+            "或 /export <type> <domain/email>\n\n"
+            "示例：\n"
+            "/export example.com (推荐)\n"
+            "/export new example.com (只导出上次导出后新增的记录)\n"
+            "/export email user@example.com"
+        )
+        return
     
-    # 处理 /subdomains 命令
-    elif text.startswith("/subdomains "):
-        domain = text.replace("/subdomains ", "").strip()
-        normalized_domain = normalize_domain(domain)
-        
-        if not is_valid_domain(normalized_domain):
-            send_message(chat_id, f"❌ 域名格式无效: {domain}")
+    # 检查第一个参数是否为已知类型
+    known_types = ["employees", "customers", "thirdparties", "third_parties", "all", "email"]
+    first_arg = parts[0].lower()
+    
+    if first_arg in known_types:
+        # 如果指定了类型，必须有第二个参数（目标）
+        if len(parts) < 2:
+            send_message(ctx.chat_id, f"❌ 请提供域名或邮箱\n例如: /export {first_arg} example.com")
             return
-        
-        send_message(chat_id, f"🔍 正在查询子域名: {normalized_domain}\n请稍候...")
-        result = query_domain_subdomains(normalized_domain)
-        formatted = format_subdomains_result(result, normalized_domain)
-        send_message(chat_id, formatted)
-        print(f"[查询] 用户 {user_name} 查询子域名: {normalized_domain}")
+        export_type = first_arg
+        target = " ".join(parts[1:])
+    else:
+        # 如果第一个参数不是类型，则默认为导出全部 (all)，且该参数就是域名
+        export_type = "all"
+        target = " ".join(parts)
     
-    # 处理 /urls 命令
-    elif text.startswith("/urls "):
-        domain = text.replace("/urls ", "").strip()
-        normalized_domain = normalize_domain(domain)
+    # 处理 /export all 命令 - 导出全部泄露类型
+    if export_type == "all":
+        normalized_domain = normalize_domain(target)
         
         if not is_valid_domain(normalized_domain):
-            send_message(chat_id, f"❌ 域名格式无效: {domain}")
-            return
-        
-        send_message(chat_id, f"🔍 正在查询 URL: {normalized_domain}\n请稍候...")
-        result = query_domain_urls(normalized_domain)
-        formatted = format_urls_result(result, normalized_domain)
-        send_message(chat_id, formatted)
-        print(f"[查询] 用户 {user_name} 查询 URL: {normalized_domain}")
-    
-    # 处理 /export 命令 - 导出域名泄露为 CSV
-    elif text.startswith("/export "):
-        parts = text.replace("/export ", "").strip().split()
-        if not parts:
-            send_message(chat_id, 
-                "❌ 命令格式错误\n\n"
-                "正确格式：\n"
-                "/export <domain> (导出全部)\n"
-                "或 /export <type> <domain/email>\n\n"
-                "示例：\n"
-                "/export example.com (推荐)\n"
-                "/export email user@example.com"
-            )
+            send_message(ctx.chat_id, f"❌ 域名格式无效: {target}")
             return
         
-        # 检查第一个参数是否为已知类型
-        known_types = ["employees", "customers", "thirdparties", "third_parties", "all", "email"]
-        first_arg = parts[0].lower()
+        leak_types = [
+            ("employees", "员工"),
+            ("customers", "客户"),
+            ("third_parties", "第三方")
+        ]
         
-        if first_arg in known_types:
-            # 如果指定了类型，必须有第二个参数（目标）
-            if len(parts) < 2:
-                send_message(chat_id, f"❌ 请提供域名或邮箱\n例如: /export {first_arg} example.com")
-                return
-            export_type = first_arg
-            target = " ".join(parts[1:])
-        else:
-            # 如果第一个参数不是类型，则默认为导出全部 (all)，且该参数就是域名
-            export_type = "all"
-            target = " ".join(parts)
+        completed_count = 0
         
-        # 处理 /export all 命令 - 导出全部泄露类型
-        if export_type == "all":
-            normalized_domain = normalize_domain(target)
-            
-            if not is_valid_domain(normalized_domain):
-                send_message(chat_id, f"❌ 域名格式无效: {target}")
-                return
-            
-            send_message(chat_id, 
-                f"📥 正在后台处理全部泄露导出: {normalized_domain}\n"
-                f"任务耗时可能较长，请耐心等待文件发送..."
-            )
+        # 进度消息：每个类型一行，原地更新
+        with progress_message(ctx.chat_id, f"📥 正在后台处理全部泄露导出: {normalized_domain}\n"
+                                       f"任务耗时可能较长，请耐心等待文件发送...") as progress:
+            for _, type_name in leak_types:
+                progress.section(type_name)
+                progress.update("⏳ 等待中")
             
-            leak_types = [
-                ("employees", "员工"),
-                ("customers", "客户"),
-                ("third_parties", "第三方")
-            ]
-            
-            completed_count = 0
+            # 1. 需要解锁的类型一次性提交解锁任务，由服务端并行处理
+            unlock_tasks = {
+                leak_type: start_domain_unlock_if_needed(normalized_domain, leak_type)
+                for leak_type, _ in leak_types
+            }
             
             for leak_type, type_name in leak_types:
-                # 1. 解锁
-                print(f"[解锁] 正在解锁 {type_name} 数据: {normalized_domain}")
-                unlock_result = unlock_domain_leaks(normalized_domain, leak_type, max_items=10000)
-                
-                unlocked_count = 0
-                if isinstance(unlock_result, list):
-                    unlocked_count = len(unlock_result)
-                    print(f"[解锁] 成功解锁 {unlocked_count} 条 {type_name} 数据")
-                elif isinstance(unlock_result, dict) and "error" in unlock_result:
-                    print(f"[解锁] {type_name} 解锁失败: {unlock_result['error']}")
-                
-                # 2. Fetch all data
-                items = fetch_all_domain_leaks(normalized_domain, leak_type)
+                # 2. 该类型解锁完成后立即同步并生成 CSV 上传
+                progress.section(type_name)
+                try:
+                    count = export_domain_type(ctx.chat_id, normalized_domain, leak_type, type_name,
+                                               unlock_tasks[leak_type], delta)
+                except FetchError as e:
+                    progress.update(f"❌ 获取数据失败: {e}")
+                    continue
                 
-                if items:
-                    # 3. Create CSV
-                    file_path = create_csv_file(items, f"{normalized_domain}_{leak_type}")
-                    if file_path:
-                        caption = (
-                        f"📥 CSV 导出文件\n\n"
-                        f"域名: {normalized_domain}\n"
-                        f"类型: {type_name}\n"
-                        f"记录数: {len(items)}"
-                    )
-                        if send_document(chat_id, file_path, caption):
-                            completed_count += 1
-                            try:
-                                os.remove(file_path)
-                            except:
-                                pass
+                if count:
+                    completed_count += 1
+                    progress.update(f"✅ 已发送 {count} 条")
+                elif count == 0:
+                    print(f"[导出] {type_name} 没有{'新增' if delta else ''}数据")
+                    progress.update("✅ 没有新增记录" if delta else "⚠️ 没有数据")
                 else:
-                    print(f"[导出] {type_name} 没有数据")
+                    progress.update("❌ 发送失败")
             
             if completed_count > 0:
-                send_message(chat_id, f"✅ 已发送 {completed_count} 个 CSV 文件")
+                progress.finish(f"✅ 已发送 {completed_count} 个 CSV 文件")
+            elif delta:
+                progress.finish("✅ 上次导出后没有新增记录")
             else:
-                send_message(chat_id, "⚠️ 未找到任何数据或导出失败")
+                progress.finish("⚠️ 未找到任何数据或导出失败")
+        return
+    
+    if export_type == "email":
+        if delta:
+            send_message(ctx.chat_id, "❌ 增量导出仅支持域名，邮箱请使用 /export email <email>")
             return
-        
-        if export_type == "email":
-            # 导出邮箱泄露
-            # send_message(chat_id, f"📥 正在处理邮箱导出: {target}\n正在解锁并获取数据，请稍候...")
-            send_message(chat_id, f"📥 已接收邮箱导出任务: {target}\n请稍候...")
-            
+        # 导出邮箱泄露
+        # send_message(ctx.chat_id, f"📥 正在处理邮箱导出: {target}\n正在解锁并获取数据，请稍候...")
+        with progress_message(ctx.chat_id, f"📥 已接收邮箱导出任务: {target}\n请稍候...") as progress:
             # 1. 解锁
-            unlock_email_leaks(target)
+            log_unlock_result(start_email_unlock(target).wait(report=True), "邮箱")
             
-            # 2. Fetch
-            items = fetch_all_email_leaks(target)
+            # 2. 边获取边生成 CSV 并直接上传
+            try:
+                count = send_csv_export(
+                    ctx.chat_id,
+                    lambda: iter_email_leak_pages(target),
+                    f"email_{target}",
+                    lambda count: f"📥 CSV 导出文件\n\n邮箱: {target}\n记录数: {count}"
+                )
+            except FetchError as e:
+                progress.finish(f"❌ 获取数据失败: {e}")
+                return
             
-            if items:
-                file_path = create_csv_file(items, f"email_{target}")
-                if file_path:
-                    caption = f"📥 CSV 导出文件\n\n邮箱: {target}\n记录数: {len(items)}"
-                    if send_document(chat_id, file_path, caption):
-                        send_message(chat_id, f"✅ CSV 文件已发送")
-                        try:
-                            os.remove(file_path)
-                        except:
-                            pass
-                    else:
-                        send_message(chat_id, f"❌ 发送文件失败")
+            if count:
+                progress.finish(f"✅ CSV 文件已发送（{count} 条）")
+            elif count == 0:
+                progress.finish("⚠️ 未找到相关数据")
             else:
-                send_message(chat_id, "⚠️ 未找到相关数据")
+                progress.finish(f"❌ 发送文件失败")
+    
+    elif export_type in ["employees", "customers", "thirdparties", "third_parties"]:
+        # 导出域名泄露
+        normalized_domain = normalize_domain(target)
+        
+        if not is_valid_domain(normalized_domain):
+            send_message(ctx.chat_id, f"❌ 域名格式无效: {target}")
+            return
+        
+        leak_type = export_type if export_type != "thirdparties" else "third_parties"
+        type_names = {
+            "employees": "员工",
+            "customers": "客户",
+            "third_parties": "第三方"
+        }
+        type_name = type_names.get(leak_type, leak_type)
         
-        elif export_type in ["employees", "customers", "thirdparties", "third_parties"]:
-            # 导出域名泄露
-            normalized_domain = normalize_domain(target)
+        with progress_message(ctx.chat_id, f"📥 正在后台处理{type_name}泄露导出: {normalized_domain}\n请稍候...") as progress:
+            # 1. 解锁（有未解锁的记录时）
+            unlock = start_domain_unlock_if_needed(normalized_domain, leak_type)
             
-            if not is_valid_domain(normalized_domain):
-                send_message(chat_id, f"❌ 域名格式无效: {target}")
+            # 2. 同步并生成 CSV 上传
+            try:
+                count = export_domain_type(ctx.chat_id, normalized_domain, leak_type, type_name, unlock, delta)
+            except FetchError as e:
+                progress.finish(f"❌ 获取数据失败: {e}")
                 return
             
-            leak_type = export_type if export_type != "thirdparties" else "third_parties"
-            type_names = {
-                "employees": "员工",
-                "customers": "客户",
-                "third_parties": "第三方"
-            }
-            type_name = type_names.get(leak_type, leak_type)
-            
-            send_message(chat_id, f"📥 正在后台处理{type_name}泄露导出: {normalized_domain}\n请稍候...")
-            
-            # 1. 解锁
-            unlock_result = unlock_domain_leaks(normalized_domain, leak_type, max_items=10000)
-            unlocked_count = 0
-            if isinstance(unlock_result, list):
-                unlocked_count = len(unlock_result)
-                print(f"[解锁] 成功解锁 {unlocked_count} 条 {type_name} 数据")
-            elif isinstance(unlock_result, dict) and "error" in unlock_result:
-                print(f"[解锁] {type_name} 解锁失败: {unlock_result['error']}")
-            
-            # 2. Fetch
-            items = fetch_all_domain_leaks(normalized_domain, leak_type)
-            
-            if items:
-                file_path = create_csv_file(items, f"{normalized_domain}_{leak_type}")
-                if file_path:
-                    caption = (
-                        f"📥 CSV 导出文件\n\n"
-                        f"域名: {normalized_domain}\n"
-                        f"类型: {type_name}\n"
-                        f"记录数: {len(items)}"
-                    )
-                    if send_document(chat_id, file_path, caption):
-                        send_message(chat_id, f"✅ CSV 文件已发送")
-                        try:
-                            os.remove(file_path)
-                        except:
-                            pass
-                    else:
-                        send_message(chat_id, f"❌ 发送文件失败")
+            if count:
+                progress.finish(f"✅ CSV 文件已发送（{count} 条）")
+            elif count == 0:
+                progress.finish("✅ 上次导出后没有新增记录" if delta else "⚠️ 未找到相关数据")
             else:
-                send_message(chat_id, "⚠️ 未找到相关数据")
-        elif export_type == "all":
-            # all 类型已经在上面处理了，这里不应该到达
-            pass
+                progress.finish(f"❌ 发送文件失败")
+    elif export_type == "all":
+        # all 类型已经在上面处理了，这里不应该到达
+        pass
+    else:
+        send_message(ctx.chat_id, 
+            "❌ 无效的导出类型\n\n"
+            "支持的类型：\n"
+            "• employees - 员工泄露\n"
+            "• customers - 客户泄露\n"
+            "• thirdparties - 第三方泄露\n"
+            "• all - 导出全部（员工+客户+第三方）\n"
+            "• email - 邮箱泄露"
+        )
+
+@router.command("/serverexport", args="words")
+def cmd_serverexport(ctx: CommandContext) -> None:
+    """/serverexport：由服务端生成导出文件，完成后自动发送"""
+    parts = ctx.args
+    if not parts:
+        send_message(ctx.chat_id, "❌ 请提供域名或邮箱\n例如: /serverexport example.com")
+        return
+    
+    first_arg = parts[0].lower()
+    type_names = {
+        "employees": "员工",
+        "customers": "客户",
+        "third_parties": "第三方"
+    }
+    
+    # 确定要创建的导出任务: (说明, 创建函数)
+    if first_arg == "email" and len(parts) > 1:
+        target = " ".join(parts[1:])
+        jobs = [(f"邮箱: {target}", lambda: create_email_export(target))]
+    else:
+        if first_arg in ("employees", "customers", "thirdparties", "third_parties") and len(parts) > 1:
+            leak_types = ["third_parties" if first_arg == "thirdparties" else first_arg]
+            target = " ".join(parts[1:])
         else:
-            send_message(chat_id, 
-                "❌ 无效的导出类型\n\n"
-                "支持的类型：\n"
-                "• employees - 员工泄露\n"
-                "• customers - 客户泄露\n"
-                "• thirdparties - 第三方泄露\n"
-                "• all - 导出全部（员工+客户+第三方）\n"
-                "• email - 邮箱泄露"
-            )
-    
-    # 处理 /exports 命令 - 查看导出任务列表
-    elif text == "/exports":
-        send_message(chat_id, "📋 正在获取导出任务列表...")
-        result = get_exports_list(page=1, page_size=10)
+            leak_types = list(type_names)
+            target = " ".join(parts)
+        normalized_domain = normalize_domain(target)
+        if not is_valid_domain(normalized_domain):
+            send_message(ctx.chat_id, f"❌ 域名格式无效: {target}")
+            return
+        jobs = [
+            (f"域名: {normalized_domain}\n类型: {type_names[leak_type]}",
+             lambda leak_type=leak_type: create_domain_export(normalized_domain, leak_type))
+            for leak_type in leak_types
+        ]
+    
+    created = []
+    for description, create in jobs:
+        result = create()
+        export_id = result.get("export_id")
+        if "error" in result or export_id is None:
+            send_message(ctx.chat_id, f"❌ 创建导出任务失败\n\n{description}\n错误: {result.get('error', result)}")
+            continue
+        export_tracker.track(
+            export_id,
+            lambda status, export_id=export_id, description=description:
+                deliver_server_export(ctx.chat_id, export_id, description, status)
+        )
+        created.append(str(export_id))
+    
+    if created:
+        send_message(ctx.chat_id,
+            f"📥 已创建 {len(created)} 个服务端导出任务 (ID: {', '.join(created)})\n"
+            f"完成后会自动发送文件，可用 /exports 查看进度"
+        )
+    print(f"[导出] 用户 {ctx.user_name} 创建服务端导出: {', '.join(created) or '无'}")
+
+@router.command("/batch", args="raw")
+def cmd_batch(ctx: CommandContext) -> None:
+    """/batch：批量查询消息中的域名 / 邮箱列表"""
+    content = ctx.args.strip()
+    mode = batch_mode(ctx.text)
+    if mode:
+        content = content.split(None, 1)[1] if len(content.split(None, 1)) > 1 else ""
+    if not content:
+        send_message(ctx.chat_id,
+            "📋 批量查询域名\n\n"
+            "• 直接上传 .txt/.csv 文件（每行一个域名）\n"
+            "• 或发送 /batch 后换行输入域名，例如：\n"
+            "/batch\nexample.com\nexample.org\n\n"
+            "📧 批量查询邮箱/用户名：\n"
+            "/batch email\nalice@example.com\nbob@example.com\n\n"
+            "未指定类型时根据内容自动识别"
+        )
+        return
+    handle_batch(ctx.chat_id, content, mode, ctx.fresh)
+    print(f"[批量] 用户 {ctx.user_name} 批量查询 ({mode or '自动识别'})")
+
+@router.command("/pwcheck", args="raw")
+def cmd_pwcheck(ctx: CommandContext) -> None:
+    """/pwcheck：检查密码是否泄露（本地哈希，只发送前缀）"""
+    # 立即删除包含密码的消息
+    delete_message(ctx.chat_id, ctx.message["message_id"])
+    # 命令后的一个空格或换行是分隔符，其余字符（包括首尾空白）都属于密码
+    content = ctx.rest[1:]
+    if not content.strip():
+        send_message(ctx.chat_id,
+            "🔑 检查密码是否泄露\n\n"
+            "• /pwcheck <密码>\n"
+            "• 批量：/pwcheck 后每行输入一个密码，或上传说明为 /pwcheck 的 .txt 文件\n\n"
+            "密码只在本地做 SHA-1，发送给 API 的只有哈希前 5 位"
+        )
+        return
+    lines = [line for line in content.split("\n") if line.strip()]
+    if "\n" in content:
+        # 多行（或密码写在下一行）按批量处理，每行只去掉行尾的 \r
+        handle_password_batch(ctx.chat_id, content)
+    else:
+        password_hash = hash_password(content.rstrip("\r"))
+        send_message(ctx.chat_id, format_password_result(check_password_hashes([password_hash])[password_hash]))
+    print(f"[密码] 用户 {ctx.user_name} 检查 {len(lines)} 个密码")
+
+@router.command("/watch", args="domain", usage="/watch example.com")
+def cmd_watch(ctx: CommandContext) -> None:
+    """/watch：监控域名，泄露数量变化时推送提醒"""
+    normalized_domain = ctx.args
+    watchlist = get_watchlist()
+    if watchlist.count(ctx.chat_id) >= WATCH_MAX_PER_CHAT:
+        send_message(ctx.chat_id, f"❌ 每个会话最多监控 {WATCH_MAX_PER_CHAT} 个域名，请先用 /unwatch 移除")
+        return
+    
+    # 以当前数量作为基线，之后只在数量变化时提醒
+    report = query_leak_api(normalized_domain, fresh=ctx.fresh)
+    if "error" in report:
+        send_message(ctx.chat_id, f"❌ 获取基线数据失败\n\n域名: {normalized_domain}\n错误: {report['error']}")
+        return
+    counts = report_counts(report)
+    if not watchlist.add(ctx.chat_id, normalized_domain, counts,
+                         next_watch_time(watch_scheduler.interval_for(normalized_domain))):
+        send_message(ctx.chat_id, f"ℹ️ 已在监控中: {normalized_domain}")
+        return
+    
+    summary = "\n".join(f"{type_name}泄露: {counts[leak_type]} 条" for leak_type, _, type_name in WATCH_COUNT_FIELDS)
+    send_message(ctx.chat_id,
+        f"👁 已开始监控: {normalized_domain}\n\n{summary}\n\n"
+        f"约每 {watch_scheduler.interval_for(normalized_domain) / 3600:g} 小时检查一次，泄露数量变化时会通知你"
+    )
+    print(f"[监控] 用户 {ctx.user_name} 监控域名: {normalized_domain}")
+
+@router.command("/unwatch", args="text", usage="❌ 请提供域名\n例如: /unwatch example.com")
+def cmd_unwatch(ctx: CommandContext) -> None:
+    normalized_domain = normalize_domain(ctx.args)
+    if get_watchlist().remove(ctx.chat_id, normalized_domain):
+        send_message(ctx.chat_id, f"✅ 已取消监控: {normalized_domain}")
+    else:
+        send_message(ctx.chat_id, f"ℹ️ 未监控该域名: {normalized_domain}")
+    print(f"[监控] 用户 {ctx.user_name} 取消监控: {normalized_domain}")
+
+@router.command("/watchlist")
+def cmd_watchlist(ctx: CommandContext) -> None:
+    watches = get_watchlist().list(ctx.chat_id)
+    if not watches:
+        send_message(ctx.chat_id, "📋 暂无监控的域名\n使用 /watch <domain> 添加")
+        return
+    message_parts = [f"👁 监控列表（共 {len(watches)} 个）", "=" * 30]
+    for i, watch in enumerate(watches, 1):
+        counts = " / ".join(str(watch[leak_type] or 0) for leak_type, _, _ in WATCH_COUNT_FIELDS)
+        checked = time.strftime("%m-%d %H:%M", time.localtime(watch["last_checked"])) if watch["last_checked"] else "-"
+        message_parts.append(f"{i}. {watch['domain']}\n   员工/客户/第三方: {counts}\n   上次检查: {checked}")
+    result_message = "\n".join(message_parts)
+    if len(result_message) > 4000:
+        result_message = result_message[:3900] + "\n\n... (内容过长，已截断)"
+    send_message(ctx.chat_id, result_message)
+
+@router.command("/exports")
+def cmd_exports(ctx: CommandContext) -> None:
+    send_message(ctx.chat_id, "📋 正在获取导出任务列表...")
+    result = get_exports_list(page=1, page_size=10)
+    
+    if "error" in result:
+        send_message(ctx.chat_id, f"❌ 获取导出列表失败\n\n错误: {result['error']}")
+    else:
+        items = result.get("items", [])
+        total = result.get("total", 0)
         
-        if "error" in result:
-            send_message(chat_id, f"❌ 获取导出列表失败\n\n错误: {result['error']}")
+        if not items:
+            send_message(ctx.chat_id, "📋 暂无导出任务")
         else:
-            items = result.get("items", [])
-            total = result.get("total", 0)
+            message_parts = [f"📋 导出任务列表（共 {total} 个）\n", "=" * 40]
             
-            if not items:
-                send_message(chat_id, "📋 暂无导出任务")
-            else:
-                message_parts = [f"📋 导出任务列表（共 {total} 个）\n", "=" * 40]
-                
-                for i, item in enumerate(items[:10], 1):
-                    export_id = item.get("id")
-                    filename = item.get("filename", "N/A")
-                    status = item.get("status", "UNKNOWN")
-                    timestamp = item.get("timestamp", "")
-                    finished_at = item.get("finished_at")
-                    
-                    status_emoji = {
-                        "COMPLETED": "✅",
-                        "PENDING": "⏳",
-                        "IN_PROGRESS": "🔄",
-                        "FAILED": "❌"
-                    }.get(status.upper(), "❓")
-                    
-                    message_parts.append(f"\n{i}. {status_emoji} {filename}")
-                    message_parts.append(f"   ID: {export_id}")
-                    message_parts.append(f"   状态: {status}")
-                    if finished_at:
-                        message_parts.append(f"   完成时间: {finished_at}")
+            for i, item in enumerate(items[:10], 1):
+                export_id = item.get("id")
+                filename = item.get("filename", "N/A")
+                status = item.get("status", "UNKNOWN")
+                timestamp = item.get("timestamp", "")
+                finished_at = item.get("finished_at")
                 
-                if total > 10:
-                    message_parts.append(f"\n... 还有 {total - 10} 个任务未显示")
+                status_emoji = {
+                    "COMPLETED": "✅",
+                    "PENDING": "⏳",
+                    "IN_PROGRESS": "🔄",
+                    "FAILED": "❌"
+                }.get(status.upper(), "❓")
                 
-                send_message(chat_id, "\n".join(message_parts))
-                print(f"[查询] 用户 {user_name} 查看导出列表")
+                message_parts.append(f"\n{i}. {status_emoji} {filename}")
+                message_parts.append(f"   ID: {export_id}")
+                message_parts.append(f"   状态: {status}")
+                if finished_at:
+                    message_parts.append(f"   完成时间: {finished_at}")
+            
+            if total > 10:
+                message_parts.append(f"\n... 还有 {total - 10} 个任务未显示")
+            
+            send_message(ctx.chat_id, "\n".join(message_parts))
+            print(f"[查询] 用户 {ctx.user_name} 查看导出列表")
+
+@router.callback("pg")
+def cb_page(ctx: CommandContext) -> None:
+    """翻页按钮：callback_data 为 pg:<结果集 ID>:<页码>，编辑原消息显示该页"""
+    result_id, _, page = ctx.args.partition(":")
+    result = paged_results.get(result_id)
+    if result is None or result.chat_id != ctx.chat_id or not page.isdigit():
+        answer_callback_query(ctx.callback["id"], "结果已过期，请重新查询")
+        return
+    text, keyboard = result.show(int(page))
+    outbound_queue.replace(ctx.chat_id, ctx.message["message_id"], text, reply_markup=keyboard)
+    answer_callback_query(ctx.callback["id"])
+
+@router.fallback
+def cmd_domain_lookup(ctx: CommandContext) -> None:
+    """普通文本消息：查询域名泄露报告"""
+    text = ctx.text
+    # 规范化域名
+    normalized_domain = normalize_domain(text)
     
-    # 处理域名查询（普通文本消息且不是命令）
-    elif text and not text.startswith("/"):
-        # 规范化域名
-        normalized_domain = normalize_domain(text)
-        
-        # 验证域名格式
-        if not is_valid_domain(normalized_domain):
-            error_message = (
-                f"❌ 域名格式无效\n\n"
-                f"你输入的: {text}\n\n"
-                "请输入有效的域名，例如：\n"
-                "• example.com\n"
-                "• www.example.com"
-            )
-            send_message(chat_id, error_message)
-            print(f"[回复] 域名格式错误: {text}")
-            return
-        
-        # 发送查询中的提示
-        send_message(chat_id, f"🔍 正在查询域名: {normalized_domain}\n请稍候...")
-        print(f"[查询] 用户 {user_name} 查询域名: {normalized_domain}")
-        
-        # 调用 API 查询
-        api_result = query_leak_api(normalized_domain)
-        
-        # 格式化并发送结果
-        formatted_result = format_api_result(api_result, normalized_domain)
-        send_message(chat_id, formatted_result)
-        print(f"[回复] 发送查询结果给用户 {user_name}")
+    # 验证域名格式
+    if not is_valid_domain(normalized_domain):
+        error_message = (
+            f"❌ 域名格式无效\n\n"
+            f"你输入的: {text}\n\n"
+            "请输入有效的域名，例如：\n"
+            "• example.com\n"
+            "• www.example.com"
+        )
+        send_message(ctx.chat_id, error_message)
+        print(f"[回复] 域名格式错误: {text}")
+        return
+    
+    # 发送查询中的提示
+    send_message(ctx.chat_id, f"🔍 正在查询域名: {normalized_domain}\n请稍候...")
+    print(f"[查询] 用户 {ctx.user_name} 查询域名: {normalized_domain}")
+    
+    # 调用 API 查询
+    api_result = query_leak_api(normalized_domain, fresh=ctx.fresh)
+    
+    # 格式化并发送结果
+    formatted_result = format_api_result(api_result, normalized_domain)
+    send_message(ctx.chat_id, formatted_result)
+    print(f"[回复] 发送查询结果给用户 {ctx.user_name}")
+
+def handle_message(message: Dict[str, Any]) -> None:
+    """处理接收到的消息（按命令路由表分发）"""
+    router.dispatch(message)
+
+# ============================================================================
+# 并发调度
+# ============================================================================
+
+def command_name(text: str) -> str:
+    """提取消息对应的命令名（用作指标标签），普通文本视为域名查询"""
+    if not text.startswith("/"):
+        return "domain_lookup"
+    return split_command(text)[0] or text.split()[0].lower()
+
+def message_text(message: Dict[str, Any]) -> str:
+    """消息正文；上传文件时为说明文字"""
+    return message.get("text") or message.get("caption") or ""
+
+def message_command(message: Dict[str, Any]) -> str:
+    """消息对应的命令名，不带说明的文件视为 /batch"""
+    if "callback_query" in message:
+        return "callback"
+    if "document" in message and not message_text(message):
+        return "/batch"
+    return command_name(message_text(message))
+
+def command_lane(message: Dict[str, Any]) -> str:
+    """
+    判断消息属于哪个调度通道
+
+    导出、批量查询、上传的文件和多行 /pwcheck 为 bulk，其余（查询、帮助等）为 interactive
+    """
+    command = message_command(message)
+    if "document" in message or command in BULK_COMMANDS:
+        return "bulk"
+    if command == "/pwcheck" and "\n" in message_text(message).strip():
+        return "bulk"
+    return "interactive"
+
+class UpdateDispatcher:
+    """
+    消息调度器，位于 getUpdates 轮询循环与 handle_message 之间
+
+    - 消息分为交互通道（查询、帮助等）和批量通道（导出、批量查询），两个通道各有线程池，
+      批量任务再多也不会占用交互通道的工作线程；批量通道的 LeakRadar 请求另有限速，为交互查询保留配额
+    - 同一会话同一通道内的消息按到达顺序逐条处理，保证回复顺序不乱
+    - 批量通道按用户加权公平排队（WFQ）：每个任务按提交用户的权重计算虚拟完成时间，
+      空闲工作线程总是取虚拟完成时间最小的任务，一个用户连发多个导出也只会轮流占用批量线程
+    - 两个通道都限制单个会话的在途任务数（群组中多个用户的批量任务合计），并按通道限制单个用户的在途任务数，
+      超出时直接提示用户稍后再试
+    """
+
+    LANES = ("interactive", "bulk")
+
+    def __init__(self, handler, max_workers: int = DISPATCH_WORKERS,
+                 bulk_workers: int = BULK_WORKERS,
+                 max_per_chat: int = MAX_INFLIGHT_PER_CHAT,
+                 max_per_user: int = MAX_INFLIGHT_PER_USER,
+                 max_bulk_per_user: int = MAX_BULK_PER_USER,
+                 user_weights: Optional[Dict[int, float]] = None):
+        self.handler = handler
+        self.max_per_chat = max_per_chat
+        self.max_per_user = max_per_user
+        self.max_bulk_per_user = max_bulk_per_user
+        self.bulk_workers = max(1, min(bulk_workers, max_workers - 1))
+        self.user_weights = user_weights if user_weights is not None else BULK_USER_WEIGHTS
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers - self.bulk_workers),
+                                           thread_name_prefix="dispatch")
+        self.bulk_executor = ThreadPoolExecutor(max_workers=self.bulk_workers, thread_name_prefix="dispatch-bulk")
+        self._lock = threading.Lock()
+        # 交互通道：chat_id -> 等待处理的 (消息, 完成回调)
+        self._chat_queues: Dict[int, deque] = {}
+        # 交互通道中正在处理消息的会话（每个会话同一时间只占用一个工作线程）
+        self._active_chats = set()
+        # 批量通道：chat_id -> 等待处理的 (虚拟完成时间, 消息, 完成回调)
+        self._bulk_queues: Dict[int, deque] = {}
+        self._bulk_active_chats = set()
+        self._bulk_running = 0
+        # WFQ 虚拟时间（最近开始处理的任务的虚拟完成时间）与每个用户最后一个任务的虚拟完成时间
+        self._virtual_time = 0.0
+        self._user_tags: Dict[int, float] = {}
+        # (user_id, 通道) -> 在途任务数
+        self._user_inflight: Dict[Tuple[int, str], int] = {}
+
+    def submit(self, message: Dict[str, Any], on_done: Optional[Callable[[], None]] = None) -> bool:
+        """
+        提交一条消息，返回是否被接受
+
+        on_done 在消息处理结束（包括出错或被拒绝）后调用，用于在更新日志中标记完成
+        """
+        chat_id = message["chat"]["id"]
+        user_id = message.get("from", {}).get("id", 0)
+        lane = command_lane(message)
+        rejected = None
+        schedule = False
+        queued_ahead = 0
+
+        with self._lock:
+            user_inflight = self._user_inflight.get((user_id, lane), 0)
+            if lane == "bulk":
+                chat_inflight = (len(self._bulk_queues.get(chat_id, ()))
+                                 + (1 if chat_id in self._bulk_active_chats else 0))
+                if chat_inflight >= self.max_per_chat:
+                    rejected = "当前会话还有批量任务正在处理或排队，"
+                elif user_inflight >= self.max_bulk_per_user:
+                    rejected = f"您已有 {user_inflight} 个批量任务在处理或排队，"
+                else:
+                    start = max(self._virtual_time, self._user_tags.get(user_id, 0.0))
+                    tag = start + 1.0 / self.user_weights.get(user_id, 1.0)
+                    self._user_tags[user_id] = tag
+                    self._bulk_queues.setdefault(chat_id, deque()).append((tag, message, on_done))
+                    queued_ahead = sum(1 for q in self._bulk_queues.values() for item in q if item[0] < tag)
+            else:
+                queue = self._chat_queues.setdefault(chat_id, deque())
+                chat_inflight = len(queue) + (1 if chat_id in self._active_chats else 0)
+                if chat_inflight >= self.max_per_chat:
+                    rejected = "当前会话还有任务正在处理，"
+                elif user_inflight >= self.max_per_user:
+                    rejected = "您还有任务正在处理，"
+                else:
+                    queue.append((message, on_done))
+                    if chat_id not in self._active_chats:
+                        self._active_chats.add(chat_id)
+                        schedule = True
+                if not queue and chat_id not in self._active_chats:
+                    del self._chat_queues[chat_id]
+            if not rejected:
+                self._user_inflight[(user_id, lane)] = user_inflight + 1
+
+        if rejected:
+            print(f"[调度] 拒绝消息: chat={chat_id} user={user_id} lane={lane}，在途任务已达上限")
+            send_message(chat_id, f"⏳ {rejected}请等待完成后再发送新的请求")
+            if on_done:
+                on_done()
+            return False
+
+        if lane == "bulk":
+            started = self._schedule_bulk()
+            if chat_id not in started and queued_ahead:
+                send_message(chat_id, f"📥 已加入批量任务队列，前面还有 {queued_ahead} 个任务，轮到时会自动开始")
+        elif schedule:
+            self.executor.submit(self._run_next, chat_id)
+        return True
+
+    def _process(self, message: Dict[str, Any], on_done: Optional[Callable[[], None]], lane: str) -> None:
+        """执行处理函数并记录指标，结束后调用完成回调、释放用户的在途计数"""
+        command = message_command(message)
+        status = "ok"
+        start = time.perf_counter()
+        token = current_lane.set(lane)
+        try:
+            self.handler(message)
+        except Exception as e:
+            status = "error"
+            print(f"[调度] 处理消息出错: {e}")
+            traceback.print_exc()
+        finally:
+            current_lane.reset(token)
+            metrics.observe("bot_command_duration_seconds", time.perf_counter() - start,
+                            {"command": command, "lane": lane})
+            metrics.inc("bot_commands_total", {"command": command, "lane": lane, "status": status})
+            if on_done:
+                try:
+                    on_done()
+                except Exception as e:
+                    print(f"[调度] 完成回调出错: {e}")
+            user_id = message.get("from", {}).get("id", 0)
+            with self._lock:
+                remaining = self._user_inflight.get((user_id, lane), 1) - 1
+                if remaining > 0:
+                    self._user_inflight[(user_id, lane)] = remaining
+                else:
+                    self._user_inflight.pop((user_id, lane), None)
+                    if lane == "bulk" and self._user_tags.get(user_id, 0.0) <= self._virtual_time:
+                        self._user_tags.pop(user_id, None)
+
+    def _run_next(self, chat_id: int) -> None:
+        """处理交互通道中指定会话的下一条消息，完成后再调度同一会话的后续消息"""
+        with self._lock:
+            message, on_done = self._chat_queues[chat_id].popleft()
+
+        try:
+            self._process(message, on_done, "interactive")
+        finally:
+            with self._lock:
+                queue = self._chat_queues.get(chat_id)
+                reschedule = bool(queue)
+                if not reschedule:
+                    self._active_chats.discard(chat_id)
+                    self._chat_queues.pop(chat_id, None)
+
+        # 重新排队而不是在当前线程循环处理，让其他会话也有机会获得工作线程
+        if reschedule:
+            self.executor.submit(self._run_next, chat_id)
+
+    def _schedule_bulk(self) -> set:
+        """有空闲的批量线程时，按虚拟完成时间取出任务开始处理，返回本次开始处理的会话"""
+        started = set()
+        with self._lock:
+            while self._bulk_running < self.bulk_workers:
+                candidates = [
+                    (queue[0][0], chat_id) for chat_id, queue in self._bulk_queues.items()
+                    if queue and chat_id not in self._bulk_active_chats
+                ]
+                if not candidates:
+                    break
+                tag, chat_id = min(candidates)
+                _, message, on_done = self._bulk_queues[chat_id].popleft()
+                self._bulk_active_chats.add(chat_id)
+                self._bulk_running += 1
+                self._virtual_time = max(self._virtual_time, tag)
+                started.add(chat_id)
+                self.bulk_executor.submit(self._run_bulk, chat_id, message, on_done)
+        return started
+
+    def _run_bulk(self, chat_id: int, message: Dict[str, Any], on_done: Optional[Callable[[], None]]) -> None:
+        try:
+            self._process(message, on_done, "bulk")
+        finally:
+            with self._lock:
+                self._bulk_active_chats.discard(chat_id)
+                self._bulk_running -= 1
+                if not self._bulk_queues.get(chat_id):
+                    self._bulk_queues.pop(chat_id, None)
+            self._schedule_bulk()
+
+    def pending(self, lane: Optional[str] = None) -> int:
+        """返回排队中（尚未开始处理）的消息数"""
+        with self._lock:
+            interactive = sum(len(q) for q in self._chat_queues.values())
+            bulk = sum(len(q) for q in self._bulk_queues.values())
+        return {"interactive": interactive, "bulk": bulk}.get(lane, interactive + bulk)
+
+    def active(self) -> int:
+        """返回正在处理消息的会话数"""
+        with self._lock:
+            return len(self._active_chats | self._bulk_active_chats)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait=wait)
+        self.bulk_executor.shutdown(wait=wait)
+
+# ============================================================================
+# 更新日志（持久化 offset + 至少一次处理）
+# ============================================================================
+
+def journal_payload(update: Dict[str, Any]) -> str:
+    """
+    写入更新日志的内容
+
+    /pwcheck 消息只保留命令本身（去掉密码文本和密码文件），密码不会落盘；
+    重启后重新处理这类未完成的更新时，用户会收到用法提示，需要重新发送
+    """
+    message = update.get("message")
+    if message and split_command(message_text(message))[0] == "/pwcheck":
+        message = {key: value for key, value in message.items() if key not in ("text", "caption", "document")}
+        message["text"] = "/pwcheck"
+        update = {**update, "message": message}
+    return json.dumps(update, ensure_ascii=False)
+
+class UpdateJournal:
+    """
+    更新日志
+
+    - 收到的更新先写入 SQLite（WAL 模式）再处理，同时持久化 offset
+    - 处理完成后标记为 done；重启时重新处理仍为 pending 的更新
+    - update_id 为主键，重复收到的更新（例如重启前未确认的）会被忽略，已完成的不会重跑
+    - 完成后清空消息内容，只保留 update_id 用于去重；/pwcheck 消息写入时就去掉密码（见 journal_payload）
+    """
+
+    def __init__(self, db_path: str = STATE_DB_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS updates ("
+            "update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', received_at REAL, finished_at REAL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        # 旧版本保留了已完成更新的完整内容（可能包含密码），启动时清空
+        self._db.execute("UPDATE updates SET payload = '{}' WHERE status = 'done' AND payload != '{}'")
+        self._db.commit()
+
+    def get_offset(self) -> int:
+        """返回已落盘的最大 update_id（没有时为 0）"""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM state WHERE key = 'last_update_id'").fetchone()
+        return int(row[0]) if row else 0
+
+    def record(self, updates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        在一个事务中写入更新并推进 offset
+
+        Returns:
+            此前未见过的更新（需要处理的）
+        """
+        fresh_updates = []
+        now = time.time()
+        with self._lock:
+            last_id = 0
+            with self._db:
+                for update in updates:
+                    update_id = update["update_id"]
+                    last_id = max(last_id, update_id)
+                    cursor = self._db.execute(
+                        "INSERT OR IGNORE INTO updates (update_id, payload, received_at) VALUES (?, ?, ?)",
+                        (update_id, journal_payload(update), now)
+                    )
+                    if cursor.rowcount:
+                        fresh_updates.append(update)
+                if last_id:
+                    self._db.execute(
+                        "INSERT INTO state (key, value) VALUES ('last_update_id', ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+                        (last_id,)
+                    )
+        return fresh_updates
+
+    def mark_done(self, update_id: int) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "UPDATE updates SET status = 'done', finished_at = ?, payload = '{}' WHERE update_id = ?",
+                    (time.time(), update_id)
+                )
+
+    def pending(self) -> List[Dict[str, Any]]:
+        """返回尚未处理完成的更新（按 update_id 排序）"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT payload FROM updates WHERE status = 'pending' ORDER BY update_id"
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def prune(self, retention_days: int = JOURNAL_RETENTION_DAYS) -> None:
+        """删除过期的已完成记录"""
+        cutoff = time.time() - retention_days * 86400
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM updates WHERE status = 'done' AND finished_at < ?", (cutoff,))
+
+def dispatch_update(update: Dict[str, Any], dispatcher: UpdateDispatcher, journal: UpdateJournal) -> None:
+    """把一条已落盘的更新交给调度器，处理完成后在日志中标记"""
+    update_id = update["update_id"]
+    message = update.get("message")
+    callback = update.get("callback_query")
+    if callback and callback.get("message"):
+        # 按钮回调包装成消息的形式：会话和消息 ID 取自按钮所在的消息，用户为点击按钮的人
+        message = {
+            "chat": callback["message"]["chat"],
+            "message_id": callback["message"]["message_id"],
+            "from": callback.get("from", {}),
+            "callback_query": callback,
+        }
+    if message and ("text" in message or "document" in message or "callback_query" in message):
+        dispatcher.submit(message, on_done=lambda: journal.mark_done(update_id))
+    else:
+        # 暂不处理的更新类型直接标记完成
+        journal.mark_done(update_id)
+
+def make_webhook_server(on_update: Callable[[Dict[str, Any]], None], host: str = WEBHOOK_LISTEN,
+                        port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                        secret_token: str = WEBHOOK_SECRET) -> ThreadingHTTPServer:
+    """
+    创建接收 Telegram 推送的 HTTP 服务
+
+    校验路径与 X-Telegram-Bot-Api-Secret-Token 头后，把更新交给 on_update 并立即返回 200，
+    实际处理由调度器异步完成，避免 Telegram 因等待超时而重复推送。
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status: int, body: bytes = b"{}") -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path.split("?")[0] != path:
+                self._reply(404)
+                return
+            received_token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if secret_token and not hmac.compare_digest(received_token, secret_token):
+                print(f"[Webhook] 拒绝密钥不匹配的请求: {self.client_address[0]}")
+                self._reply(403)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                update = json.loads(self.rfile.read(length))
+            except (ValueError, json.JSONDecodeError):
+                self._reply(400)
+                return
+            if not isinstance(update, dict) or "update_id" not in update:
+                self._reply(400)
+                return
+            try:
+                on_update(update)
+            except Exception as e:
+                # 返回 500 让 Telegram 稍后重发，更新日志会去重
+                print(f"[Webhook] 处理更新失败: {e}")
+                self._reply(500)
+                return
+            self._reply(200)
+
+    return ThreadingHTTPServer((host, port), WebhookHandler)
+
+def start_heartbeat(dispatcher: UpdateDispatcher, interval: int = HEARTBEAT_INTERVAL) -> None:
+    """后台线程定期打印运行状态"""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            print(f"[心跳] 正在运行中... (处理中会话 {dispatcher.active()}, "
+                  f"排队 {dispatcher.pending()}, API 配额利用率 {leak_rate_limiter.utilization():.0%}, "
+                  f"缓存命中率 {result_cache.hit_rate():.0%})", flush=True)
+
+    threading.Thread(target=run, name="heartbeat", daemon=True).start()
+
+def run_polling(dispatcher: UpdateDispatcher, journal: UpdateJournal) -> None:
+    """
+    长轮询模式
+
+    getUpdates 使用较长的 timeout：没有消息时请求挂起，有消息时立即返回，
+    因此两次轮询之间不需要休眠，消息延迟只取决于网络往返。
+    """
+    global last_update_id
+    
+    while True:
+        # 如果 last_update_id 为 0，不传 offset 以获取所有未确认消息
+        if last_update_id == 0:
+            result = get_updates(timeout=POLL_TIMEOUT)
+        else:
+            result = get_updates(timeout=POLL_TIMEOUT, offset=last_update_id + 1)
+        
+        if not result.get("ok"):
+            print(f"获取更新失败: {result}")
+            time.sleep(5)
+            continue
+        
+        updates = result.get("result", [])
+        if updates:
+            print(f"收到 {len(updates)} 条新消息")
+            # 先落盘（同时持久化 offset），再交给调度器并发处理
+            new_updates = journal.record(updates)
+            last_update_id = max(last_update_id, max(u["update_id"] for u in updates))
+            for update in new_updates:
+                dispatch_update(update, dispatcher, journal)
+
+def run_webhook(dispatcher: UpdateDispatcher, journal: UpdateJournal) -> None:
+    """Webhook 模式：Telegram 主动推送更新，无需轮询"""
+    secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+    def on_update(update: Dict[str, Any]) -> None:
+        for new_update in journal.record([update]):
+            dispatch_update(new_update, dispatcher, journal)
+
+    server = make_webhook_server(on_update, secret_token=secret_token)
+    print(f"✓ Webhook 服务已启动: http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    if not set_webhook(WEBHOOK_URL, secret_token):
+        server.server_close()
+        return
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 def main():
     """主函数"""
@@ -1624,16 +5881,22 @@ def main():
     print(f"Telegram API 地址: {API_BASE_URL}")
     print(f"API 地址: {LEAK_API_BASE_URL}")
     print(f"API Key: {LEAK_API_KEY[:5]}..." if LEAK_API_KEY else "Not Set")
+    print(f"运行模式: {BOT_MODE}")
     print("=" * 60)
     
-    # 清除 Webhook
-    delete_webhook()
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        print("❌ 错误: webhook 模式需要设置 WEBHOOK_URL 环境变量")
+        return
+    
+    # 读取持久化的 offset
+    journal = UpdateJournal()
+    journal.prune()
+    last_update_id = journal.get_offset()
+    print(f"✓ 更新日志: {STATE_DB_PATH} (offset={last_update_id})")
 
     # 测试连接
     print("正在测试 Telegram API 连接...")
-    # test_result = get_updates(timeout=1, offset=0)
-    # 使用 offset=-1 获取最新消息（不确认之前的）
-    test_result = get_updates(timeout=1)
+    test_result = get_me()
     
     if not test_result.get("ok"):
         print("❌ 无法连接到 Telegram API，请检查：")
@@ -1643,6 +5906,8 @@ def main():
         return
     
     print("✓ 成功连接到 Telegram API")
+    # 群组中只处理 /命令@本机器人 或不带 @ 的命令
+    router.bot_username = test_result["result"].get("username", "")
     print("✓ 机器人已启动，等待消息...")
     print("=" * 60)
     print("按 Ctrl+C 停止机器人")
@@ -1654,46 +5919,38 @@ def main():
     proxies = urllib.request.getproxies()
     print(f"当前系统代理设置: {proxies}")
     
+    dispatcher = UpdateDispatcher(handle_message)
+    print(f"✓ 并发调度已启用: {DISPATCH_WORKERS} 个工作线程")
+    
+    # 继续处理上次停止前未完成的更新
+    unfinished = journal.pending()
+    if unfinished:
+        print(f"[恢复] 继续处理 {len(unfinished)} 条未完成的更新")
+        for update in unfinished:
+            dispatch_update(update, dispatcher, journal)
+    
+    start_heartbeat(dispatcher)
+    watch_scheduler.start()
+    
+    metrics.gauge("bot_dispatch_queue_depth", "排队等待处理的交互消息数", lambda: dispatcher.pending("interactive"))
+    metrics.gauge("bot_dispatch_bulk_queue_depth", "排队等待处理的批量任务数", lambda: dispatcher.pending("bulk"))
+    metrics.gauge("bot_dispatch_active_chats", "正在处理消息的会话数", dispatcher.active)
+    if METRICS_PORT:
+        start_metrics_server()
+    
     try:
-        loop_count = 0
-        while True:
-            loop_count += 1
-            if loop_count % 10 == 0:  # 每10次循环（约5秒）打印一次心跳
-                print(f"[心跳] 正在运行中... (Loop {loop_count})", flush=True)
-                
-            # 获取更新
-            # print(f"正在获取更新 (offset={last_update_id + 1})...")
-            
-            # 如果是第一次循环且 last_update_id 为 0，不传 offset 以获取默认未确认消息
-            if last_update_id == 0:
-                result = get_updates(timeout=5)
-            else:
-                result = get_updates(timeout=5, offset=last_update_id + 1)
-            
-            if not result.get("ok"):
-                print(f"获取更新失败: {result}")
-                time.sleep(5)
-                continue
-            
-            updates = result.get("result", [])
-            if updates:
-                print(f"收到 {len(updates)} 条新消息")
-            
-            for update in updates:
-                update_id = update.get("update_id")
-                last_update_id = max(last_update_id, update_id)
-                
-                # 处理消息
-                if "message" in update:
-                    message = update["message"]
-                    if "text" in message:
-                        handle_message(message)
-            
-            # 短暂休眠，避免频繁请求
-            time.sleep(0.5)
+        if BOT_MODE == "webhook":
+            run_webhook(dispatcher, journal)
+        else:
+            # 清除 Webhook，确保 getUpdates 可用
+            delete_webhook()
+            run_polling(dispatcher, journal)
     
     except KeyboardInterrupt:
         print("\n\n收到中断信号，正在关闭机器人...")
+        dispatcher.shutdown(wait=False)
+        if not outbound_queue.flush(timeout=10):
+            print(f"⚠ 还有 {outbound_queue.pending()} 条消息未发送")
         print("机器人已停止")
     except Exception as e:
         print(f"\n❌ 发生错误: {e}")